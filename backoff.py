@@ -0,0 +1,29 @@
+import random
+import time
+
+
+def delays(initial=0.5, factor=2.0, maximum=30.0, jitter=0.25):
+    # Exponential backoff; each delay is spread by +/- jitter so that
+    # concurrent waiters do not poll in lockstep.
+    delay = initial
+    while True:
+        yield delay * random.uniform(1.0 - jitter, 1.0 + jitter)
+        delay = min(delay * factor, maximum)
+
+
+def poll(check, timeout, initial=0.5, factor=2.0, maximum=30.0,
+         immediate=True):
+    # Calls check() until it returns a value other than None or the
+    # deadline passes. Returns (value, waited_seconds).
+    start = time.monotonic()
+    deadline = start + timeout
+    for delay in delays(initial, factor, maximum):
+        if immediate is True:
+            value = check()
+            if value is not None:
+                return value, time.monotonic() - start
+        immediate = True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None, time.monotonic() - start
+        time.sleep(min(delay, remaining))
@@ -0,0 +1,244 @@
+import backoff
+import contextlib
+import json
+import metrics
+import os
+import rate_limit
+import sys
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Constants
+BATCH_CONCURRENCY = int(os.getenv("LLM_BATCH_CONCURRENCY", "4"))
+# Requests per second and provider (0: unlimited).
+BATCH_RATE = float(os.getenv("LLM_BATCH_RATE", "0"))
+BATCH_RETRIES = int(os.getenv("LLM_BATCH_RETRIES", "5"))
+PROMPT_FIELDS = ["prompt", "text", "body"]
+ID_FIELDS = ["id", "request_id", "custom_id"]
+# Results waiting to be written (ordered output) or in flight, per worker.
+WINDOW_PER_WORKER = 4
+
+
+def parse_line(line, number):
+    # Returns (id, prompt). A line is either a JSON object or plain text.
+    text = line.strip()
+    if text == '':
+        return None, None
+    record = None
+    if text.startswith('{'):
+        try:
+            record = json.loads(text)
+        except json.JSONDecodeError:
+            record = None
+    if not isinstance(record, dict):
+        return str(number), text
+
+    item_id = next((str(record[key]) for key in ID_FIELDS
+                    if key in record), str(number))
+    prompt = next((record[key] for key in PROMPT_FIELDS
+                   if isinstance(record.get(key), str)), None)
+    if prompt is not None and 'title' in record and 'prompt' not in record:
+        prompt = f"{record['title']}\n\n{prompt}"
+    return item_id, prompt
+
+
+def read_items(lines):
+    for number, line in enumerate(lines, 1):
+        item_id, prompt = parse_line(line, number)
+        if item_id is not None:
+            yield item_id, prompt
+
+
+def completed_ids(path):
+    # Items with a successful or permanently failed result in an earlier
+    # run's output.
+    done = set()
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn last line after an interruption.
+                    continue
+                if result.get('status') == 'ok' or \
+                        result.get('retryable') is False:
+                    done.add(str(result.get('id')))
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def is_retryable(status):
+    # No response at all (connection errors, timeouts), rate limiting and
+    # server errors are retried.
+    return status is None or status == 429 or status >= 500
+
+
+class BatchRunner():
+
+    def __init__(self, make_client, provider, concurrency=BATCH_CONCURRENCY,
+                 rate=BATCH_RATE, retries=BATCH_RETRIES):
+        self.make_client = make_client
+        self.concurrency = max(1, concurrency)
+        self.bucket = rate_limit.get_bucket(provider, rate)
+        self.retries = retries
+        self.clients = threading.local()
+        self.counts = {"ok": 0, "error": 0, "skipped": 0, "retries": 0}
+        self.counts_lock = threading.Lock()
+        # Set on interruption: running prompts are not retried any more.
+        self.stopped = threading.Event()
+
+    def _client(self):
+        # Clients keep per-call state (last_status), so each worker
+        # thread has its own.
+        client = getattr(self.clients, "client", None)
+        if client is None:
+            client = self.make_client()
+            # Failed prompts are retried here, not inside each call.
+            client.retries = 0
+            self.clients.client = client
+        return client
+
+    def _count(self, key):
+        with self.counts_lock:
+            self.counts[key] += 1
+
+    def process(self, item_id, prompt):
+        result = {"id": item_id}
+        if prompt is None:
+            result.update(status="error", error="no prompt",
+                          retryable=False)
+            return result
+
+        client = self._client()
+        data = client.append_to_data(None, prompt)
+        start = time.perf_counter()
+        delays = backoff.delays(initial=1.0, maximum=60.0)
+        for attempt in range(1, self.retries + 2):
+            self.bucket.acquire()
+            turn = metrics.begin_turn(client.MODEL)
+            content, usage, _ = client._send(data, None)
+            metrics.end_turn(turn, usage)
+            status = client.last_status
+            if content is not None:
+                result.update(status="ok", response=content, usage=usage)
+                break
+            if not is_retryable(status):
+                result.update(status="error", http_status=status,
+                              retryable=False)
+                break
+            if attempt > self.retries or self.stopped.is_set():
+                result.update(status="error", http_status=status,
+                              retryable=True)
+                break
+            self._count("retries")
+            if self.stopped.wait(next(delays)):
+                result.update(status="error", http_status=status,
+                              retryable=True)
+                break
+        result["attempts"] = attempt
+        result["latency"] = round(time.perf_counter() - start, 3)
+        return result
+
+    def run(self, items, output, ordered=True, skip=frozenset()):
+        window = self.concurrency * WINDOW_PER_WORKER
+        pending = {}
+        finished = {}
+        next_seq = 0
+        seq = 0
+
+        def write(result):
+            output.write(json.dumps(result, ensure_ascii=False))
+            output.write('\n')
+            output.flush()
+            self._count(result["status"])
+
+        def collect(block):
+            nonlocal next_seq
+            if len(pending) == 0:
+                return
+            done, _ = wait(list(pending),
+                           timeout=None if block else 0,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                number = pending.pop(future)
+                if ordered:
+                    finished[number] = future.result()
+                else:
+                    write(future.result())
+            while next_seq in finished:
+                write(finished.pop(next_seq))
+                next_seq += 1
+
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            for item_id, prompt in items:
+                if item_id in skip:
+                    self._count("skipped")
+                    continue
+                while len(pending) + len(finished) >= window:
+                    collect(True)
+                future = executor.submit(self.process, item_id, prompt)
+                pending[future] = seq
+                seq += 1
+                collect(False)
+            while len(pending) > 0:
+                collect(True)
+        except KeyboardInterrupt:
+            # Queued prompts are dropped and running ones stop retrying;
+            # results that are already in are written, so that a rerun
+            # with the same output does not send them again.
+            self.stopped.set()
+            for future, number in pending.items():
+                if not future.cancel() and future.done():
+                    finished[number] = future.result()
+            for number in sorted(finished):
+                write(finished[number])
+            raise
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return self.counts
+
+
+def run_batch(make_client, provider, input_path, output_path,
+              concurrency=BATCH_CONCURRENCY, rate=BATCH_RATE,
+              retries=BATCH_RETRIES, ordered=True):
+    # Prompts are read lazily from input_path ('-': stdin); results are
+    # written as JSON lines to output_path (None: stdout). An existing
+    # output file is the checkpoint: items already answered are skipped
+    # and new results are appended.
+    skip = frozenset()
+    if output_path is not None:
+        skip = completed_ids(output_path)
+
+    runner = BatchRunner(make_client, provider, concurrency, rate, retries)
+    start = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if input_path == '-':
+            lines = sys.stdin
+        else:
+            lines = stack.enter_context(open(input_path, 'r',
+                                             encoding='utf-8'))
+        if output_path is None:
+            output = sys.stdout
+        else:
+            output = stack.enter_context(open(output_path, 'a',
+                                              encoding='utf-8'))
+        # Provider error messages go to stderr, away from the results.
+        stack.enter_context(contextlib.redirect_stdout(sys.stderr))
+        try:
+            counts = runner.run(read_items(lines), output, ordered, skip)
+        except KeyboardInterrupt:
+            counts = runner.counts
+            print("Interrupted; rerun with the same output to resume.",
+                  file=sys.stderr)
+
+    print(f"batch: {counts['ok']} ok, {counts['error']} failed, "
+          + f"{counts['skipped']} skipped, {counts['retries']} retries, "
+          + f"{time.perf_counter() - start:.1f} s, "
+          + f"rate limited {runner.bucket.waited:.1f} s",
+          file=sys.stderr)
+    return counts
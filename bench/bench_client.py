@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+# Offline benchmarks for the chat clients against bench/mock_server.py.
+#
+#   python bench/bench_client.py
+#   python bench/bench_client.py --turns 100 --growth-turns 500 --json
+#
+# Reports p50/p99 turn latency, CPU time per turn and resident memory for
+# single turns, streamed turns, source loading and a growing conversation.
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import deque
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # ru_maxrss is the peak, in KiB on Linux and bytes on macOS.
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def start_server(args):
+    command = [sys.executable, os.path.join(BENCH_DIR, 'mock_server.py'),
+               '--port', '0',
+               '--latency', str(args.latency),
+               '--token-rate', str(args.token_rate),
+               '--response-tokens', str(args.response_tokens),
+               '--page-bytes', str(args.page_bytes)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = server.stdout.readline()
+    if not line.startswith('Listening on '):
+        server.kill()
+        print("Error: Mock server failed to start.")
+        exit(1)
+    return server, line.split()[-1]
+
+
+def configure_environment(base_url, cache_dir):
+    os.environ.setdefault("GOOGLE_API_KEY", "bench")
+    os.environ.setdefault("GEMINI_MODEL", "bench-model")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ.setdefault("OPENAI_MODEL", "bench-model")
+    os.environ["GEMINI_API_BASE"] = base_url
+    os.environ["OPENAI_API_BASE"] = base_url
+    os.environ["GEMINI_CONTEXT_CACHE"] = "0"
+    os.environ["LLM_CACHE_DIR"] = cache_dir
+    os.environ.pop("LLM_METRICS_LOG", None)
+    os.environ.pop("LLM_REQUEST_DEBUG_LOG", None)
+    sys.path.insert(0, ROOT_DIR)
+
+
+def measure(name, func, count):
+    latencies = []
+    cpu = []
+    rss_before = rss_bytes()
+    for i in range(count):
+        cpu_start = cpu_seconds()
+        start = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - start)
+        cpu.append(cpu_seconds() - cpu_start)
+    return {
+        "name": name,
+        "count": count,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "cpu_ms_per_op": round(sum(cpu) / max(1, count) * 1000, 2),
+        "rss_mb": round(rss_bytes() / 1024 / 1024, 1),
+        "rss_delta_mb": round((rss_bytes() - rss_before) / 1024 / 1024, 1),
+        "latencies": latencies,
+    }
+
+
+def single_turn(client, llm_cli, stream):
+    def run(i):
+        llm_cli.STREAM = stream
+        client.conversation = deque()
+        client.send_and_print(client.append_to_data(None, f"question {i}"))
+    return run
+
+
+def growing_conversation(client, llm_cli):
+    client.conversation = deque()
+
+    def run(i):
+        llm_cli.STREAM = False
+        client.send_and_print(client.append_to_data(None, f"question {i}"))
+    return run
+
+
+def load_pages(client, llm_cli, base_url, pages):
+    client.stdout = True
+
+    def run(i):
+        llm_cli.STREAM = False
+        client.conversation = deque()
+        sources = [f"{base_url}/page/{i}-{n}" for n in range(pages)]
+        client.process_sources(sources + ["summarize the pages"])
+    return run
+
+
+def run_benchmarks(args, base_url):
+    import llm_cli
+    import gemini
+    import openai
+
+    llm_cli.PLAIN_TEXT = not args.render
+    clients = {
+        "gemini": gemini.Gemini(gemini.MODEL),
+        "openai": openai.OPENAI(openai.MODEL),
+    }
+
+    results = []
+    for name, client in clients.items():
+        if args.provider not in (None, name):
+            continue
+        results.append(measure(f"{name}.turn",
+                               single_turn(client, llm_cli, False),
+                               args.turns))
+        results.append(measure(f"{name}.stream",
+                               single_turn(client, llm_cli, True),
+                               args.turns))
+        results.append(measure(f"{name}.sources",
+                               load_pages(client, llm_cli, base_url,
+                                          args.pages),
+                               args.source_rounds))
+        growth = measure(f"{name}.growth",
+                         growing_conversation(client, llm_cli),
+                         args.growth_turns)
+        growth["first_turn_ms"] = round(growth["latencies"][0] * 1000, 2)
+        growth["last_turn_ms"] = round(growth["latencies"][-1] * 1000, 2)
+        results.append(growth)
+    return results
+
+
+def print_table(results):
+    header = f"{'benchmark':<16}{'n':>6}{'p50 ms':>10}{'p99 ms':>10}" \
+        + f"{'cpu ms':>10}{'rss MB':>9}{'Δrss MB':>9}"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        print(f"{result['name']:<16}{result['count']:>6}"
+              + f"{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+              + f"{result['cpu_ms_per_op']:>10.2f}"
+              + f"{result['rss_mb']:>9.1f}{result['rss_delta_mb']:>9.1f}")
+        if 'first_turn_ms' in result:
+            print(f"{'':<16}turn 1: {result['first_turn_ms']:.2f} ms, "
+                  + f"turn {result['count']}: "
+                  + f"{result['last_turn_ms']:.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the chat clients against a local mock server.")
+    parser.add_argument('--turns', type=int, default=50,
+                        help="Turns per single-turn benchmark.")
+    parser.add_argument('--growth-turns', type=int, default=200,
+                        help="Turns in the growing conversation benchmark.")
+    parser.add_argument('--pages', type=int, default=8,
+                        help="Pages loaded per source benchmark round.")
+    parser.add_argument('--source-rounds', type=int, default=5,
+                        help="Rounds of the source benchmark.")
+    parser.add_argument('--provider', choices=['gemini', 'openai'],
+                        help="Only benchmark one client.")
+    parser.add_argument('--render', action='store_true',
+                        help="Render markdown instead of plain text.")
+    parser.add_argument('--json', action='store_true',
+                        help="Print results as JSON.")
+    parser.add_argument('--latency', type=float, default=0.005)
+    parser.add_argument('--token-rate', type=float, default=0)
+    parser.add_argument('--response-tokens', type=int, default=200)
+    parser.add_argument('--page-bytes', type=int, default=20000)
+    args = parser.parse_args()
+
+    server, base_url = start_server(args)
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            configure_environment(base_url, cache_dir)
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = run_benchmarks(args, base_url)
+    finally:
+        server.terminate()
+        server.wait()
+
+    for result in results:
+        del result["latencies"]
+    if args.json is True:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
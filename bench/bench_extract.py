@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+# HTML extraction benchmark over a corpus of saved pages.
+#
+#   python bench/bench_extract.py ~/saved-pages
+#   python bench/bench_extract.py --pages 100 --json
+#
+# Without a directory, synthetic pages with navigation, sidebars, comments
+# and footers around an article are used. Reports parse time and output
+# size (estimated tokens) for the old BeautifulSoup get_text() extraction
+# and for html_extract with each available parser.
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+import html_extract  # noqa: E402
+from bench_client import percentile  # noqa: E402
+
+# Constants
+CHARS_PER_TOKEN = 4.0
+WORDS = ("the of and to in is that for it as with was on be by this are "
+         + "from or an at which data model request cache latency server "
+         + "client response token page parser content value system").split()
+
+
+def sentence(rng, words):
+    text = ' '.join(rng.choice(WORDS) for _ in range(words))
+    return text.capitalize() + '.'
+
+
+def synthetic_page(rng):
+    links = ''.join(f'<li><a href="/section/{i}">Section {i}</a></li>'
+                    for i in range(rng.randint(20, 60)))
+    paragraphs = ''.join(
+        f"<p>{' '.join(sentence(rng, rng.randint(8, 25)) for _ in range(4))}"
+        + "</p>\n" for _ in range(rng.randint(5, 30)))
+    comments = ''.join(
+        f'<div class="comment"><span class="author">user{i}</span>'
+        + f"<p>{sentence(rng, 12)}</p></div>"
+        for i in range(rng.randint(0, 20)))
+    related = ''.join(f'<a href="/post/{i}">{sentence(rng, 6)}</a>'
+                      for i in range(10))
+    return (
+        "<!DOCTYPE html><html><head><meta charset=\"utf-8\">"
+        + f"<title>{sentence(rng, 6)}</title>"
+        + "<style>body{font-family:sans-serif}.nav{display:flex}</style>"
+        + "<script>window.analytics={track:function(){}};" * 5
+        + "</script></head><body>"
+        + f'<div class="cookie-banner"><p>{sentence(rng, 20)}</p>'
+        + "<button>Accept</button></div>"
+        + f'<header><nav class="nav"><ul>{links}</ul></nav></header>'
+        + '<div class="layout"><div id="content">'
+        + f"<h1>{sentence(rng, 8)}</h1>{paragraphs}"
+        + f'<div class="comments">{comments}</div></div>'
+        + f'<aside class="sidebar"><ul>{links}</ul>{related}</aside></div>'
+        + f"<footer><p>{sentence(rng, 15)}</p><ul>{links}</ul></footer>"
+        + "</body></html>").encode('utf-8')
+
+
+def load_corpus(directory, count, seed):
+    if directory is None:
+        rng = random.Random(seed)
+        return [(f"synthetic-{i}", synthetic_page(rng))
+                for i in range(count)]
+    pages = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if name.lower().endswith(('.html', '.htm', '.xhtml')):
+                path = os.path.join(root, name)
+                with open(path, 'rb') as f:
+                    pages.append((path, f.read()))
+    return pages
+
+
+def beautifulsoup_text(content):
+    # The extraction used before html_extract.
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(content, 'html.parser').get_text(' ', strip=True)
+
+
+def engines():
+    result = [("bs4 get_text", beautifulsoup_text)]
+    parsers = ["html.parser"]
+    if html_extract.parser_name("auto") == "lxml":
+        parsers.append("lxml")
+    for parser in parsers:
+        for extractor in html_extract.EXTRACTORS:
+            result.append((f"{extractor} ({parser})",
+                           lambda content, extractor=extractor,
+                           parser=parser: html_extract.extract(
+                               content, "text/html", extractor, parser)))
+    return result
+
+
+def run_benchmarks(pages, repeat):
+    total_bytes = sum(len(content) for _, content in pages)
+    results = []
+    for name, extract in engines():
+        timings = []
+        chars = 0
+        for _, content in pages:
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                text = extract(content)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings.append(best)
+            chars += len(text)
+        total = sum(timings)
+        results.append({
+            "engine": name,
+            "pages": len(pages),
+            "total_s": round(total, 4),
+            "p50_ms": round(percentile(timings, 50) * 1000, 3),
+            "p99_ms": round(percentile(timings, 99) * 1000, 3),
+            "mb_per_s": round(total_bytes / 1e6 / total, 2) if total else 0,
+            "tokens": round(chars / CHARS_PER_TOKEN),
+        })
+    baseline = results[0]
+    for result in results:
+        result["speedup"] = round(baseline["total_s"] / result["total_s"], 2) \
+            if result["total_s"] else 0
+        result["token_reduction"] = round(
+            1 - result["tokens"] / baseline["tokens"], 3) \
+            if baseline["tokens"] else 0
+    return results
+
+
+def print_table(results):
+    print(f"{'engine':<22}{'p50':>10}{'p99':>10}{'MB/s':>8}{'speedup':>9}"
+          + f"{'tokens':>10}{'reduction':>11}")
+    for result in results:
+        print(f"{result['engine']:<22}"
+              + f"{result['p50_ms']:>7.2f} ms"
+              + f"{result['p99_ms']:>7.2f} ms"
+              + f"{result['mb_per_s']:>8.1f}"
+              + f"{result['speedup']:>8.2f}x"
+              + f"{result['tokens']:>10}"
+              + f"{result['token_reduction'] * 100:>10.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark HTML extraction over saved pages.")
+    parser.add_argument('corpus', nargs='?',
+                        help="Directory of saved .html pages "
+                             + "(default: synthetic pages).")
+    parser.add_argument('--pages', type=int, default=50,
+                        help="Number of synthetic pages.")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Runs per page; the fastest is kept.")
+    parser.add_argument('--json', action='store_true',
+                        help="Print results as JSON.")
+    args = parser.parse_args()
+
+    pages = load_corpus(args.corpus, args.pages, args.seed)
+    if len(pages) == 0:
+        print(f"Error: No .html pages in {args.corpus}.")
+        exit(1)
+    results = run_benchmarks(pages, args.repeat)
+    if args.json is True:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
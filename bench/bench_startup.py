@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+# Cold start benchmark for the non-interactive path (a prompt piped through
+# stdin), based on `python -X importtime`.
+#
+#   python bench/bench_startup.py
+#   python bench/bench_startup.py --budget-ms 250 --runs 10 --json
+#
+# Fails (exit status 1) when importing a client module takes longer than
+# the budget, or when it pulls in a module that only the interactive,
+# rendering or source loading paths need.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from bench_client import percentile, start_server  # noqa: E402
+
+# Constants
+BUDGET_MS = float(os.getenv("LLM_STARTUP_BUDGET_MS", "300"))
+DEFERRED_MODULES = ["bs4", "filetype", "html_extract", "PIL",
+                    "prompt_toolkit", "pypdf", "rich"]
+PROVIDERS = ["gemini", "openai"]
+
+
+def environment(base_url, cache_dir):
+    env = dict(os.environ)
+    env.update({
+        "GOOGLE_API_KEY": env.get("GOOGLE_API_KEY", "bench"),
+        "GEMINI_MODEL": env.get("GEMINI_MODEL", "bench-model"),
+        "OPENAI_API_KEY": env.get("OPENAI_API_KEY", "bench"),
+        "OPENAI_MODEL": env.get("OPENAI_MODEL", "bench-model"),
+        "GEMINI_API_BASE": base_url,
+        "OPENAI_API_BASE": base_url,
+        "GEMINI_CONTEXT_CACHE": "0",
+        "LLM_CACHE_DIR": cache_dir,
+    })
+    for name in ["LLM_METRICS_LOG", "LLM_REQUEST_DEBUG_LOG", "LLM_CHAT_LOG"]:
+        env.pop(name, None)
+    return env
+
+
+def parse_importtime(stderr):
+    # Returns {module: cumulative microseconds}.
+    cumulative = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        cumulative[fields[2].strip()] = int(fields[1])
+    return cumulative
+
+
+def measure_import(provider, env):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {provider}'],
+        cwd=ROOT_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"Error: import {provider} failed.\n{result.stderr}")
+        exit(1)
+    cumulative = parse_importtime(result.stderr)
+    deferred = sorted({module.split('.')[0] for module in cumulative}
+                      & set(DEFERRED_MODULES))
+    return cumulative.get(provider, 0) / 1000, deferred
+
+
+def measure_oneshot(provider, env):
+    # Whole process: interpreter start, imports and one turn.
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, f'{provider}.py', '-p', '-s'],
+        cwd=ROOT_DIR, env=env, input="Say hello.",
+        capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        print(f"Error: {provider}.py failed.\n{result.stderr}")
+        exit(1)
+    return elapsed * 1000
+
+
+def run_benchmarks(args, env):
+    results = []
+    for provider in PROVIDERS if args.provider is None else [args.provider]:
+        imports = []
+        deferred = set()
+        oneshots = []
+        for _ in range(args.runs):
+            elapsed, loaded = measure_import(provider, env)
+            imports.append(elapsed)
+            deferred.update(loaded)
+            oneshots.append(measure_oneshot(provider, env))
+        results.append({
+            "provider": provider,
+            "import_p50_ms": round(percentile(imports, 50), 1),
+            "import_max_ms": round(max(imports), 1),
+            "oneshot_p50_ms": round(percentile(oneshots, 50), 1),
+            "deferred_imported": sorted(deferred),
+        })
+    return results
+
+
+def print_table(results, budget):
+    print(f"{'provider':<10}{'import p50':>12}{'import max':>12}"
+          + f"{'one-shot p50':>14}  deferred modules imported")
+    for result in results:
+        print(f"{result['provider']:<10}"
+              + f"{result['import_p50_ms']:>9.1f} ms"
+              + f"{result['import_max_ms']:>9.1f} ms"
+              + f"{result['oneshot_p50_ms']:>11.1f} ms  "
+              + (', '.join(result['deferred_imported']) or '-'))
+    print(f"budget: {budget:.0f} ms (import p50)")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the cold start of the non-interactive path.")
+    parser.add_argument('--budget-ms', type=float, default=BUDGET_MS,
+                        help="Largest acceptable median import time.")
+    parser.add_argument('--runs', type=int, default=5,
+                        help="Cold starts per client.")
+    parser.add_argument('--provider', choices=PROVIDERS,
+                        help="Only benchmark one client.")
+    parser.add_argument('--json', action='store_true',
+                        help="Print results as JSON.")
+    args = parser.parse_args()
+
+    server_args = argparse.Namespace(latency=0.0, token_rate=0,
+                                     response_tokens=20, page_bytes=1000)
+    server, base_url = start_server(server_args)
+    try:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            results = run_benchmarks(args, environment(base_url, cache_dir))
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json is True:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results, args.budget_ms)
+
+    failed = False
+    for result in results:
+        if result["import_p50_ms"] > args.budget_ms:
+            print(f"{result['provider']}: import takes "
+                  + f"{result['import_p50_ms']:.1f} ms, over the "
+                  + f"{args.budget_ms:.0f} ms budget.", file=sys.stderr)
+            failed = True
+        if len(result["deferred_imported"]) > 0:
+            print(f"{result['provider']}: imports "
+                  + f"{', '.join(result['deferred_imported'])} at startup.",
+                  file=sys.stderr)
+            failed = True
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
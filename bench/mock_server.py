@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the Gemini and OpenAI endpoints used by the client.
+#
+#   POST /v1beta/models/<model>:generateContent
+#   POST /v1beta/models/<model>:streamGenerateContent?alt=sse
+#   POST /v1/chat/completions            ("stream": true for SSE)
+#   GET  /page/<n>                       HTML page for source loading
+#
+# Batch APIs (a job completes --batch-delay seconds after it is created):
+#
+#   POST /v1/files, GET /v1/files/<id>/content
+#   POST /v1/batches, GET /v1/batches/<id>
+#   POST /upload/v1beta/files            resumable upload protocol
+#   GET  /v1beta/files/<id>
+#   POST /v1beta/models/<model>:batchGenerateContent
+#   GET  /v1beta/batches/<id>
+#   GET  /download/v1beta/files/<id>:download
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur",
+         "adipiscing", "elit", "sed", "do", "eiusmod", "tempor"]
+
+
+def make_text(tokens):
+    return ' '.join(WORDS[i % len(WORDS)] for i in range(tokens))
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length > 0 else b''
+        self.server.requests += 1
+        self.server.bytes_received += len(body)
+        return body
+
+    def _send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_events(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def _send_event(self, obj):
+        data = b'data: ' + obj.encode('utf-8') + b'\n\n'
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def _end_events(self):
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def _deltas(self):
+        # Yields the response in small pieces at the configured token rate.
+        config = self.server.config
+        tokens = config.response_tokens
+        step = max(1, config.chunk_tokens)
+        for start in range(0, tokens, step):
+            count = min(step, tokens - start)
+            if config.token_rate > 0:
+                time.sleep(count / config.token_rate)
+            yield make_text(count) + ' '
+
+    def _host(self):
+        return f"http://{self.headers.get('Host')}"
+
+    def _new_id(self, prefix):
+        with self.server.lock:
+            self.server.next_id += 1
+            return f"{prefix}{self.server.next_id}"
+
+    def _batch_outputs(self, batch):
+        # Answers every request line of the input file.
+        lines = []
+        text = make_text(self.server.config.response_tokens)
+        for line in self.server.files[batch["input"]].splitlines():
+            request = json.loads(line)
+            prompt_tokens = len(line) // 4
+            if batch["provider"] == "openai":
+                lines.append({
+                    "id": self._new_id("resp_"),
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": {
+                        "choices": [{"index": 0, "message": {
+                            "role": "assistant", "content": text}}],
+                        "usage": {
+                            "prompt_tokens": prompt_tokens,
+                            "completion_tokens":
+                                self.server.config.response_tokens},
+                    }},
+                    "error": None,
+                })
+            else:
+                lines.append({
+                    "key": request["key"],
+                    "response": {
+                        "candidates": [{"content": {
+                            "role": "model", "parts": [{"text": text}]},
+                            "finishReason": "STOP"}],
+                        "usageMetadata": {
+                            "promptTokenCount": prompt_tokens,
+                            "candidatesTokenCount":
+                                self.server.config.response_tokens},
+                    },
+                })
+        return ''.join(json.dumps(line) + '\n' for line in lines) \
+            .encode('utf-8')
+
+    def _finish_batch(self, batch):
+        if batch.get("output") is None and \
+                time.time() - batch["created"] >= \
+                self.server.config.batch_delay:
+            output = self._new_id("file-")
+            self.server.files[output] = self._batch_outputs(batch)
+            batch["output"] = output
+        return batch.get("output")
+
+    def _openai_batch(self, batch_id):
+        batch = self.server.batches[batch_id]
+        total = len(self.server.files[batch["input"]].splitlines())
+        output = self._finish_batch(batch)
+        return {
+            "id": batch_id,
+            "object": "batch",
+            "status": "in_progress" if output is None else "completed",
+            "input_file_id": batch["input"],
+            "output_file_id": output,
+            "error_file_id": None,
+            "request_counts": {"total": total,
+                               "completed": 0 if output is None else total,
+                               "failed": 0},
+        }
+
+    def _gemini_batch(self, batch_id):
+        batch = self.server.batches[batch_id]
+        total = len(self.server.files[batch["input"]].splitlines())
+        output = self._finish_batch(batch)
+        state = "BATCH_STATE_RUNNING" if output is None \
+            else "BATCH_STATE_SUCCEEDED"
+        operation = {
+            "name": f"batches/{batch_id}",
+            "metadata": {
+                "name": f"batches/{batch_id}",
+                "state": state,
+                "batchStats": {
+                    "requestCount": str(total),
+                    "successfulRequestCount":
+                        str(0 if output is None else total),
+                    "pendingRequestCount":
+                        str(total if output is None else 0),
+                },
+            },
+            "done": output is not None,
+        }
+        if output is not None:
+            operation["metadata"]["output"] = {
+                "responsesFile": f"files/{output}"}
+            operation["response"] = {"responsesFile": f"files/{output}"}
+        return operation
+
+    def _gemini_file(self, file_id):
+        return {
+            "name": f"files/{file_id}",
+            "uri": f"{self._host()}/v1beta/files/{file_id}",
+            "mimeType": "application/jsonl",
+            "sizeBytes": str(len(self.server.files[file_id])),
+            "state": "ACTIVE",
+            "expirationTime": "2999-01-01T00:00:00Z",
+        }
+
+    def _send_bytes(self, data, content_type='application/octet-stream'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _batch_get(self, path):
+        parts = path.strip('/').split('/')
+        if path.startswith('/v1/batches/') and \
+                parts[-1] in self.server.batches:
+            self._send_json(200, self._openai_batch(parts[-1]))
+        elif path.startswith('/v1/files/') and path.endswith('/content') \
+                and parts[2] in self.server.files:
+            self._send_bytes(self.server.files[parts[2]],
+                             'application/jsonl')
+        elif path.startswith('/v1beta/batches/') and \
+                parts[-1] in self.server.batches:
+            self._send_json(200, self._gemini_batch(parts[-1]))
+        elif path.startswith('/v1beta/files/') and \
+                parts[-1] in self.server.files:
+            self._send_json(200, self._gemini_file(parts[-1]))
+        elif path.startswith('/download/v1beta/files/') and \
+                path.endswith(':download') and \
+                parts[-1][:-len(':download')] in self.server.files:
+            self._send_bytes(
+                self.server.files[parts[-1][:-len(':download')]],
+                'application/jsonl')
+        else:
+            return False
+        return True
+
+    def _multipart_file(self, body):
+        boundary = self.headers.get('Content-Type', '') \
+            .split('boundary=')[-1].encode('ascii')
+        for part in body.split(b'--' + boundary):
+            head, _, content = part.partition(b'\r\n\r\n')
+            if b'name="file"' in head:
+                return content[:-2] if content.endswith(b'\r\n') \
+                    else content
+        return None
+
+    def _batch_post(self, path, query, body):
+        if path == '/v1/files':
+            file_id = self._new_id("file-")
+            self.server.files[file_id] = self._multipart_file(body) or b''
+            self._send_json(200, {"id": file_id, "object": "file",
+                                  "bytes": len(self.server.files[file_id]),
+                                  "purpose": "batch"})
+        elif path == '/v1/batches':
+            request = json.loads(body)
+            batch_id = self._new_id("batch_")
+            self.server.batches[batch_id] = {
+                "provider": "openai",
+                "input": request["input_file_id"],
+                "created": time.time(),
+            }
+            self._send_json(200, self._openai_batch(batch_id))
+        elif path == '/upload/v1beta/files':
+            command = self.headers.get('X-Goog-Upload-Command', '')
+            if command == 'start':
+                upload_id = self._new_id("upload")
+                self.server.uploads[upload_id] = b''
+                self.send_response(200)
+                self.send_header('X-Goog-Upload-URL',
+                                 f"{self._host()}/upload/v1beta/files"
+                                 + f"?upload_id={upload_id}")
+                self.send_header('X-Goog-Upload-Chunk-Granularity', '1')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return True
+            upload_id = query.get('upload_id', [''])[0]
+            if upload_id not in self.server.uploads:
+                self._send_json(404, {"error": {"message": "no upload"}})
+                return True
+            if command == 'query':
+                self.send_response(200)
+                self.send_header('X-Goog-Upload-Status', 'active')
+                self.send_header('X-Goog-Upload-Size-Received',
+                                 str(len(self.server.uploads[upload_id])))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return True
+            offset = int(self.headers.get('X-Goog-Upload-Offset', '0'))
+            self.server.uploads[upload_id] = \
+                self.server.uploads[upload_id][:offset] + body
+            if 'finalize' not in command:
+                self._send_json(200, {})
+                return True
+            file_id = self._new_id("file")
+            self.server.files[file_id] = self.server.uploads.pop(upload_id)
+            self._send_json(200, {"file": self._gemini_file(file_id)})
+        elif path.endswith(':batchGenerateContent'):
+            request = json.loads(body)
+            input_file = request["batch"]["input_config"]["file_name"]
+            batch_id = self._new_id("batch")
+            self.server.batches[batch_id] = {
+                "provider": "gemini",
+                "input": input_file.split('/')[-1],
+                "created": time.time(),
+            }
+            self._send_json(200, self._gemini_batch(batch_id))
+        else:
+            return False
+        return True
+
+    def do_GET(self):
+        config = self.server.config
+        if self._batch_get(urllib.parse.urlsplit(self.path).path):
+            return
+        if self.path.startswith('/page/'):
+            time.sleep(config.latency)
+            paragraph = f"<p>{make_text(50)}</p>\n"
+            body = ("<html><head><title>Page</title></head><body>"
+                    + "<nav>Home | Docs | About</nav><article>"
+                    + paragraph * max(1, config.page_bytes // len(paragraph))
+                    + "</article><footer>footer</footer></body></html>")
+            body = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', f'"{config.page_bytes}"')
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        body = self._read_body()
+        config = self.server.config
+        prompt_tokens = len(body) // 4
+        time.sleep(config.latency)
+
+        url = urllib.parse.urlsplit(self.path)
+        if self._batch_post(url.path, urllib.parse.parse_qs(url.query),
+                            body):
+            return
+
+        if random.random() < config.error_rate:
+            status = random.choice([429, 503])
+            self._send_json(status, {"error": {"code": status,
+                                               "message": "injected"}})
+            return
+
+        if ':generateContent' in self.path:
+            text = ''.join(self._deltas())
+            self._send_json(200, {
+                "candidates": [{
+                    "content": {"role": "model", "parts": [{"text": text}]},
+                    "finishReason": "STOP",
+                }],
+                "usageMetadata": {
+                    "promptTokenCount": prompt_tokens,
+                    "candidatesTokenCount": config.response_tokens,
+                },
+            })
+        elif ':streamGenerateContent' in self.path:
+            self._start_events()
+            for delta in self._deltas():
+                self._send_event(json.dumps({
+                    "candidates": [{
+                        "content": {"role": "model",
+                                    "parts": [{"text": delta}]},
+                    }],
+                }))
+            self._send_event(json.dumps({
+                "candidates": [{
+                    "content": {"role": "model", "parts": [{"text": ""}]},
+                    "finishReason": "STOP",
+                }],
+                "usageMetadata": {
+                    "promptTokenCount": prompt_tokens,
+                    "candidatesTokenCount": config.response_tokens,
+                },
+            }))
+            self._end_events()
+        elif self.path.startswith('/v1/chat/completions'):
+            request = json.loads(body or b'{}')
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": config.response_tokens,
+            }
+            if request.get('stream') is True:
+                self._start_events()
+                for delta in self._deltas():
+                    self._send_event(json.dumps({
+                        "choices": [{"index": 0,
+                                     "delta": {"content": delta}}],
+                    }))
+                self._send_event(json.dumps({"choices": [],
+                                             "usage": usage}))
+                self._send_event('[DONE]')
+                self._end_events()
+            else:
+                self._send_json(200, {
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant",
+                                    "content": ''.join(self._deltas())},
+                    }],
+                    "usage": usage,
+                })
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+
+class MockServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that cancel a stream close the connection mid-response.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.05,
+                        help="Seconds before the first byte of a response.")
+    parser.add_argument('--token-rate',
+                        type=float,
+                        default=0,
+                        help="Generated tokens per second (0: no delay).")
+    parser.add_argument('--response-tokens',
+                        type=int,
+                        default=200,
+                        help="Tokens in each response.")
+    parser.add_argument('--chunk-tokens',
+                        type=int,
+                        default=5,
+                        help="Tokens per streamed event.")
+    parser.add_argument('--error-rate',
+                        type=float,
+                        default=0,
+                        help="Fraction of POST requests answered with "
+                             + "429 or 503.")
+    parser.add_argument('--batch-delay',
+                        type=float,
+                        default=2,
+                        help="Seconds until a batch job completes.")
+    parser.add_argument('--page-bytes',
+                        type=int,
+                        default=20000,
+                        help="Approximate size of /page/<n> responses.")
+
+
+def start(config, port=0):
+    server = MockServer(("127.0.0.1", port), MockHandler)
+    server.config = config
+    server.requests = 0
+    server.bytes_received = 0
+    server.lock = threading.Lock()
+    server.next_id = 0
+    server.files = {}
+    server.uploads = {}
+    server.batches = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock LLM API server")
+    parser.add_argument('-p', '--port', type=int, default=8089)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = start(args, args.port)
+    print(f"Listening on http://127.0.0.1:{server.server_port}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,221 @@
+import os
+
+# Constants
+CONTEXT_BUDGET = int(os.getenv("LLM_CONTEXT_BUDGET", "0"))
+CONTEXT_POLICY = os.getenv("LLM_CONTEXT_POLICY", "sliding")
+POLICIES = ["sliding", "attachments", "summarize"]
+CHARS_PER_TOKEN = 4.0
+ATTACHMENT_TOKENS = 258
+BASE64_BYTES_PER_TOKEN = 1000
+SUMMARY_PROMPT = "Summarize the following conversation concisely. " \
+    + "Keep facts, decisions, open questions and any details that " \
+    + "later questions may refer to.\n\n"
+
+
+def _text_size(value):
+    return len(value) if isinstance(value, str) else 0
+
+
+def _is_attachment(part):
+    if 'inlineData' in part or 'file_data' in part:
+        return True
+    return part.get('type') == 'image_url'
+
+
+def _attachment_size(part):
+    if 'inlineData' in part:
+        return len(part['inlineData'].get('data', ''))
+    if part.get('type') == 'image_url':
+        return len(part['image_url'].get('url', ''))
+    return 0
+
+
+def _parts(message):
+    if 'parts' in message:
+        return message['parts']
+    content = message.get('content')
+    if isinstance(content, list):
+        return content
+    return []
+
+
+def message_text(message):
+    if isinstance(message.get('content'), str):
+        return message['content']
+    texts = []
+    for part in _parts(message):
+        if 'text' in part:
+            texts.append(part['text'])
+    return '\n'.join(texts)
+
+
+def raw_estimate(message):
+    chars = 0
+    tokens = 0
+    if isinstance(message.get('content'), str):
+        chars += len(message['content'])
+    for part in _parts(message):
+        if _is_attachment(part):
+            tokens += ATTACHMENT_TOKENS \
+                + _attachment_size(part) / BASE64_BYTES_PER_TOKEN
+        else:
+            chars += _text_size(part.get('text'))
+    return chars / CHARS_PER_TOKEN + tokens
+
+
+def prompt_tokens(usage):
+    if usage is None:
+        return None
+    if 'promptTokenCount' in usage:
+        return usage['promptTokenCount']
+    if 'prompt_tokens' in usage:
+        return usage['prompt_tokens']
+    return None
+
+
+class ContextWindow():
+
+    def __init__(self, budget=CONTEXT_BUDGET, policy=CONTEXT_POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown context policy: {policy}")
+        self.budget = budget
+        self.policy = policy
+        # Ratio of provider-reported prompt tokens to the raw estimate.
+        self.scale = 1.0
+        self.trimmed_messages = 0
+        self.stripped_attachments = 0
+        self.summaries = 0
+        self._raw = {}
+
+    def _raw_estimate(self, message):
+        cached = self._raw.get(id(message))
+        if cached is not None and cached[0] is message:
+            return cached[1]
+        estimate = raw_estimate(message)
+        self._raw[id(message)] = (message, estimate)
+        return estimate
+
+    def estimate(self, message):
+        return self._raw_estimate(message) * self.scale
+
+    def total(self, conversation):
+        return sum(self.estimate(message) for message in conversation)
+
+    def estimate_data(self, data):
+        chars = 0
+        tokens = 0
+        for item in data or []:
+            content_type = item.get('content_type')
+            if content_type is None or 'text' in content_type:
+                chars += _text_size(item.get('content'))
+            else:
+                tokens += ATTACHMENT_TOKENS \
+                    + len(item.get('content', '')) / BASE64_BYTES_PER_TOKEN
+        return (chars / CHARS_PER_TOKEN + tokens) * self.scale
+
+    def calibrate(self, conversation, usage):
+        actual = prompt_tokens(usage)
+        if actual is None or len(conversation) < 2:
+            return
+        # The last message is the reply; everything before it was sent.
+        sent = list(conversation)[:-1]
+        raw = sum(self._raw_estimate(message) for message in sent)
+        if raw <= 0:
+            return
+        ratio = min(max(actual / raw, 0.1), 10.0)
+        self.scale = 0.5 * self.scale + 0.5 * ratio
+        self._raw = {id(m): self._raw[id(m)] for m in conversation
+                     if id(m) in self._raw}
+
+    def fit(self, conversation, reserve=0, make_message=None,
+            summarize=None):
+        if self.budget <= 0:
+            return
+        budget = self.budget - reserve
+        if self.total(conversation) <= budget:
+            return
+        if self.policy == "attachments":
+            self._strip_attachments(conversation, budget)
+        elif self.policy == "summarize" and summarize is not None \
+                and make_message is not None:
+            self._summarize(conversation, budget, make_message, summarize)
+        self._slide(conversation, budget)
+
+    def _slide(self, conversation, budget):
+        while len(conversation) > 0 and self.total(conversation) > budget:
+            conversation.popleft()
+            self.trimmed_messages += 1
+            # A conversation should start with a user message.
+            while len(conversation) > 0 and \
+                    conversation[0].get('role') != 'user':
+                conversation.popleft()
+                self.trimmed_messages += 1
+
+    def _strip_attachments(self, conversation, budget):
+        for i in range(len(conversation)):
+            if self.total(conversation) <= budget:
+                return
+            message = conversation[i]
+            parts = _parts(message)
+            if not any(_is_attachment(part) for part in parts):
+                continue
+            stripped = dict(message)
+            new_parts = []
+            for part in parts:
+                if _is_attachment(part):
+                    new_parts.append(self._placeholder(message))
+                    self.stripped_attachments += 1
+                else:
+                    new_parts.append(part)
+            if 'parts' in message:
+                stripped['parts'] = new_parts
+            else:
+                stripped['content'] = new_parts
+            conversation[i] = stripped
+
+    def _placeholder(self, message):
+        text = "[attachment removed from the context]"
+        if 'parts' in message:
+            return {"text": text}
+        return {"type": "text", "text": text}
+
+    def _summarize(self, conversation, budget, make_message, summarize):
+        # Older turns are replaced by one synthetic message; the last
+        # two messages are always kept verbatim.
+        messages = list(conversation)
+        kept = 0
+        tokens = 0
+        for message in reversed(messages):
+            estimate = self.estimate(message)
+            if kept >= 2 and tokens + estimate > budget * 0.5:
+                break
+            tokens += estimate
+            kept += 1
+        older = messages[:len(messages) - kept]
+        if len(older) < 2:
+            return
+
+        transcript = '\n\n'.join(
+                f"({message.get('role')}): {message_text(message)}"
+                for message in older)
+        summary = summarize(SUMMARY_PROMPT + transcript)
+        if summary is None:
+            return
+
+        for _ in older:
+            conversation.popleft()
+        conversation.appendleft(make_message(
+            "Summary of the earlier conversation:\n" + summary))
+        self.trimmed_messages += len(older)
+        self.summaries += 1
+
+    def stats(self, conversation):
+        return {
+            "budget": self.budget,
+            "policy": self.policy,
+            "estimated_tokens": int(self.total(conversation)),
+            "scale": round(self.scale, 3),
+            "trimmed_messages": self.trimmed_messages,
+            "stripped_attachments": self.stripped_attachments,
+            "summaries": self.summaries,
+        }
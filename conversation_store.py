@@ -0,0 +1,361 @@
+import base64
+import binascii
+import json
+import os
+import shutil
+import source_cache
+import streaming_body
+import tempfile
+
+from collections import deque
+
+# Constants
+# Strings at least this long that decode as base64 are stored out of line.
+BLOB_MIN_CHARS = int(os.getenv("LLM_HISTORY_BLOB_MIN_CHARS",
+                               str(64 * 1024)))
+# Only the newest messages are loaded; older ones stay in the log until
+# requested with load_older() (0: load everything).
+HISTORY_TAIL = int(os.getenv("LLM_HISTORY_TAIL", "0"))
+# The log is rewritten when it holds this many times more records than
+# messages.
+COMPACT_RATIO = 4
+COMPACT_MIN_RECORDS = 200
+BLOB_KEY = "$blob"
+
+
+def blob_directory(path):
+    return path + ".blobs"
+
+
+def split_data_url(value):
+    # ("data:image/png;base64,", "iVBOR...") or ("", value)
+    if value.startswith("data:"):
+        head, sep, rest = value[:256].partition(";base64,")
+        if sep != "":
+            prefix = head + sep
+            return prefix, value[len(prefix):]
+    return "", value
+
+
+class ConversationLog():
+
+    # Append-only JSON lines log of the operations applied to a
+    # conversation. Every record holds one operation:
+    #
+    #   {"op": "append", "message": {...}}
+    #   {"op": "insert", "index": 0, "message": {...}}
+    #   {"op": "set", "index": 3, "message": {...}}
+    #   {"op": "delete", "index": 0}
+    #   {"op": "clear"}
+    #
+    # Base64 attachments are written once to <path>.blobs/<sha256> as raw
+    # bytes and replaced by {"$blob": <sha256>, "prefix": ...}.
+
+    def __init__(self, path):
+        self.path = path
+        self.blobs = blob_directory(path)
+        self.records = 0
+        self._file = None
+
+    def _open(self):
+        if self._file is None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        return self._file
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blobs, digest)
+
+    def _store_blob(self, digest, write):
+        path = self._blob_path(digest)
+        if os.path.exists(path):
+            return
+        os.makedirs(self.blobs, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.blobs)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+    def _blob_ref(self, value):
+        if isinstance(value, streaming_body.Base64File):
+            if os.path.dirname(value.path) == self.blobs:
+                # Loaded from this log; the file name is the digest.
+                return {BLOB_KEY: os.path.basename(value.path),
+                        "prefix": value.prefix}
+            digest = source_cache.digest_file(value.path)
+
+            def copy(f):
+                with open(value.path, "rb") as src:
+                    shutil.copyfileobj(src, f)
+
+            self._store_blob(digest, copy)
+            return {BLOB_KEY: digest, "prefix": value.prefix}
+        prefix, encoded = split_data_url(value)
+        try:
+            raw = base64.b64decode(encoded, validate=True)
+        except (binascii.Error, ValueError):
+            return None
+        digest = source_cache.digest_bytes(raw)
+        self._store_blob(digest, lambda f: f.write(raw))
+        return {BLOB_KEY: digest, "prefix": prefix}
+
+    def externalize(self, obj):
+        if isinstance(obj, dict):
+            return {key: self.externalize(value)
+                    for key, value in obj.items()}
+        if isinstance(obj, list):
+            return [self.externalize(value) for value in obj]
+        if isinstance(obj, streaming_body.Base64File) or \
+                (isinstance(obj, str) and len(obj) >= BLOB_MIN_CHARS):
+            ref = self._blob_ref(obj)
+            if ref is not None:
+                return ref
+        return obj
+
+    def internalize(self, obj):
+        if isinstance(obj, dict):
+            if BLOB_KEY in obj:
+                path = self._blob_path(obj[BLOB_KEY])
+                if not os.path.exists(path):
+                    print(f"Error: Missing attachment {obj[BLOB_KEY]}.")
+                    return ""
+                return streaming_body.Base64File(path, obj.get("prefix", ""))
+            return {key: self.internalize(value)
+                    for key, value in obj.items()}
+        if isinstance(obj, list):
+            return [self.internalize(value) for value in obj]
+        return obj
+
+    def write(self, op, index=None, message=None):
+        record = {"op": op}
+        if index is not None:
+            record["index"] = index
+        if message is not None:
+            record["message"] = self.externalize(message)
+        try:
+            f = self._open()
+            f.write(json.dumps(record, ensure_ascii=False))
+            f.write("\n")
+            f.flush()
+            self.records += 1
+        except (OSError, TypeError) as e:
+            print(f"Error: Failed to save history. {e}")
+
+    def replay(self):
+        # Returns the messages with their blob references unresolved.
+        messages = []
+        self.records = 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Torn last line after a crash.
+                        continue
+                    self.records += 1
+                    op = record.get("op")
+                    if op == "append":
+                        messages.append(record["message"])
+                    elif op == "insert":
+                        messages.insert(record["index"], record["message"])
+                    elif op == "set":
+                        messages[record["index"]] = record["message"]
+                    elif op == "delete":
+                        del messages[record["index"]]
+                    elif op == "clear":
+                        messages.clear()
+        except FileNotFoundError:
+            pass
+        return messages
+
+    def rewrite(self, messages):
+        # Writes messages (already externalized) as a fresh log and drops
+        # blobs that are no longer referenced.
+        self.close()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        referenced = set()
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            for message in messages:
+                text = json.dumps({"op": "append", "message": message},
+                                  ensure_ascii=False)
+                _collect_blobs(message, referenced)
+                f.write(text)
+                f.write("\n")
+        os.replace(tmp_path, self.path)
+        self.records = len(messages)
+        if os.path.isdir(self.blobs):
+            for name in os.listdir(self.blobs):
+                if name not in referenced:
+                    os.unlink(self._blob_path(name))
+
+
+def _collect_blobs(obj, digests):
+    if isinstance(obj, dict):
+        if BLOB_KEY in obj:
+            digests.add(obj[BLOB_KEY])
+            return
+        for value in obj.values():
+            _collect_blobs(value, digests)
+    elif isinstance(obj, list):
+        for value in obj:
+            _collect_blobs(value, digests)
+
+
+class PersistentConversation(deque):
+
+    # A conversation deque that logs every change as it happens. Messages
+    # older than the loaded window are kept (unresolved) in self.older and
+    # are counted in the indexes written to the log.
+
+    def __init__(self, log, messages=(), older=None):
+        super().__init__(messages)
+        self.log = log
+        self.older = older if older is not None else []
+
+    def _index(self, i):
+        if i < 0:
+            i += len(self)
+        return len(self.older) + i
+
+    def append(self, message):
+        super().append(message)
+        self.log.write("append", message=message)
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def appendleft(self, message):
+        super().appendleft(message)
+        self.log.write("insert", index=len(self.older), message=message)
+
+    def insert(self, i, message):
+        index = self._index(min(max(i, -len(self)), len(self)))
+        super().insert(i, message)
+        self.log.write("insert", index=index, message=message)
+
+    def pop(self):
+        message = super().pop()
+        self.log.write("delete", index=len(self.older) + len(self))
+        return message
+
+    def popleft(self):
+        message = super().popleft()
+        self.log.write("delete", index=len(self.older))
+        return message
+
+    def __setitem__(self, i, message):
+        super().__setitem__(i, message)
+        self.log.write("set", index=self._index(i), message=message)
+
+    def __delitem__(self, i):
+        index = self._index(i)
+        super().__delitem__(i)
+        self.log.write("delete", index=index)
+
+    def clear(self):
+        super().clear()
+        self.older = []
+        self.log.write("clear")
+
+    def load_older(self, count=None):
+        # Moves up to count older messages in front of the loaded window.
+        if count is None:
+            count = len(self.older)
+        count = min(count, len(self.older))
+        if count < len(self.older):
+            count = len(self.older) - turn_start(self.older,
+                                                 len(self.older) - count)
+        if count == 0:
+            return 0
+        moved = self.older[len(self.older) - count:]
+        del self.older[len(self.older) - count:]
+        for message in reversed(moved):
+            super().appendleft(self.log.internalize(message))
+        return count
+
+    def compact(self):
+        messages = list(self.older) \
+            + [self.log.externalize(message) for message in self]
+        try:
+            self.log.rewrite(messages)
+        except OSError as e:
+            print(f"Error: Failed to compact history. {e}")
+            return False
+        return True
+
+    def close(self):
+        self.log.close()
+
+
+def _starts_turn(message):
+    # A user message that is not a function response (whose call would be
+    # in the message before it).
+    if message.get('role') != 'user':
+        return False
+    parts = message.get('parts', message.get('content'))
+    return not isinstance(parts, list) or \
+        not any(isinstance(part, dict) and 'functionResponse' in part
+                for part in parts)
+
+
+def turn_start(messages, index):
+    # The first index at or after index where a turn starts; a loaded
+    # window must not begin with a model reply or a function response.
+    while index < len(messages) and not _starts_turn(messages[index]):
+        index += 1
+    return index
+
+
+def _load_legacy(path):
+    # History files written before the log format: one JSON array.
+    with open(path, "r", encoding="utf-8") as f:
+        head = f.read(1)
+        while head.isspace():
+            head = f.read(1)
+        if head != "[":
+            return None
+        f.seek(0)
+        return json.load(f)
+
+
+def open_conversation(path, tail=HISTORY_TAIL):
+    log = ConversationLog(path)
+    legacy = None
+    try:
+        legacy = _load_legacy(path)
+    except FileNotFoundError:
+        pass
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Error: Failed to load history. {e}")
+
+    if legacy is not None:
+        messages = [log.externalize(message) for message in legacy]
+        log.rewrite(messages)
+    else:
+        messages = log.replay()
+
+    split = len(messages) - tail if tail > 0 else 0
+    split = turn_start(messages, max(split, 0)) if split > 0 else 0
+    conversation = PersistentConversation(
+        log,
+        [log.internalize(message) for message in messages[split:]],
+        messages[:split])
+
+    if log.records >= COMPACT_MIN_RECORDS and \
+            log.records > COMPACT_RATIO * max(1, len(messages)):
+        conversation.compact()
+    return conversation
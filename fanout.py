@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+import argparse
+import importlib
+import llm_cli
+import metrics
+import os
+import queue
+import source_cache
+import sys
+import threading
+import time
+
+from rich.columns import Columns
+from rich.markdown import Markdown
+from rich.panel import Panel
+from rich.table import Table
+
+# Constants
+# Comma separated provider:model pairs, e.g.
+# "gemini:gemini-2.0-flash,openai:gpt-4o-mini"
+FANOUT_MODELS = os.getenv("LLM_FANOUT_MODELS", None)
+POLICIES = ["race", "compare"]
+PROVIDERS = {
+    "gemini": ("gemini", "Gemini", "GEMINI_MODEL"),
+    "openai": ("openai", "OPENAI", "OPENAI_MODEL"),
+}
+
+console = llm_cli.get_console()
+
+
+class Result():
+
+    def __init__(self, provider, model):
+        self.provider = provider
+        self.model = model
+        self.status = "pending"
+        self.content = None
+        self.usage = None
+        self.first_token = None
+        self.elapsed = None
+
+    def label(self):
+        return f"{self.provider}:{self.model}"
+
+    def stats(self):
+        prompt, completion = metrics.token_counts(self.usage)
+        elapsed = "-" if self.elapsed is None else f"{self.elapsed:.2f} s"
+        return f"{elapsed}, {prompt} → {completion} tokens"
+
+
+def parse_models(specs):
+    models = []
+    for spec in specs:
+        for item in spec.split(','):
+            item = item.strip()
+            if item == '':
+                continue
+            provider, sep, model = item.partition(':')
+            if sep == '' or provider not in PROVIDERS or model == '':
+                print(f"Error: Invalid model '{item}'. "
+                      + "Use provider:model with provider one of "
+                      + f"{', '.join(PROVIDERS)}.")
+                exit(1)
+            models.append((provider, model))
+    return models
+
+
+def default_models():
+    models = []
+    for provider, (_, _, env_name) in PROVIDERS.items():
+        model = os.getenv(env_name)
+        if model is not None:
+            models.append((provider, model))
+    return models
+
+
+def create_client(provider, model):
+    module_name, class_name, _ = PROVIDERS[provider]
+    module = importlib.import_module(module_name)
+    return getattr(module, class_name)(model)
+
+
+def run_model(client, result, data, cancel, results):
+    # Streams one answer; stops reading (and closes the connection) as
+    # soon as cancel is set.
+    turn = metrics.begin_turn(client.MODEL)
+    start = time.perf_counter()
+    deltas = client._send_stream(data, None)
+    try:
+        while True:
+            if cancel.is_set():
+                deltas.close()
+                result.status = "cancelled"
+                return
+            try:
+                next(deltas)
+            except StopIteration as e:
+                if e.value is not None:
+                    result.content, result.usage, _ = e.value
+                break
+            if result.first_token is None:
+                result.first_token = time.perf_counter() - start
+        result.status = "failed" if result.content is None else "done"
+    except Exception as e:
+        print(f"ERROR:{e}")
+        result.status = "failed"
+    finally:
+        result.elapsed = time.perf_counter() - start
+        metrics.end_turn(turn, result.usage)
+        results.put(result)
+
+
+def fan_out(clients, data, policy):
+    cancel = threading.Event()
+    results = queue.Queue()
+    pending = []
+    for provider, client in clients:
+        result = Result(provider, client.MODEL)
+        pending.append(result)
+        # Daemon threads: cancelled requests still waiting for their
+        # first byte do not hold up the exit.
+        threading.Thread(target=run_model,
+                         args=(client, result, data, cancel, results),
+                         daemon=True).start()
+
+    remaining = len(pending)
+    with console.status(f"Waiting for {remaining} models..."):
+        while remaining > 0:
+            result = results.get()
+            remaining -= 1
+            if policy == "race" and result.status == "done":
+                cancel.set()
+                break
+    for result in pending:
+        if result.status == "pending":
+            result.status = "cancelled"
+    return pending
+
+
+def print_results(results, policy):
+    done = [result for result in results if result.status == "done"]
+    if policy == "race" and len(done) > 1:
+        done = [min(done, key=lambda result: result.elapsed)]
+
+    if llm_cli.PLAIN_TEXT is True:
+        for result in done:
+            print(f"({result.label()}) [{result.stats()}]")
+            print(result.content)
+            print()
+    elif policy == "race":
+        for result in done:
+            console.print(Markdown(f"**({result.label()}):**"))
+            console.print(Markdown(result.content))
+    else:
+        console.print(Columns(
+            [Panel(Markdown(result.content),
+                   title=result.label(),
+                   subtitle=result.stats())
+             for result in done],
+            equal=True,
+            expand=True))
+
+    table = Table()
+    table.add_column("model")
+    table.add_column("status")
+    table.add_column("first token", justify="right")
+    table.add_column("total", justify="right")
+    table.add_column("prompt tokens", justify="right")
+    table.add_column("completion tokens", justify="right")
+    for result in sorted(results, key=lambda result:
+                         float('inf') if result.elapsed is None
+                         else result.elapsed):
+        prompt, completion = metrics.token_counts(result.usage)
+        table.add_row(
+            result.label(),
+            result.status,
+            "-" if result.first_token is None
+            else f"{result.first_token:.2f} s",
+            "-" if result.status == "cancelled" or result.elapsed is None
+            else f"{result.elapsed:.2f} s",
+            str(prompt) if result.usage is not None else "-",
+            str(completion) if result.usage is not None else "-")
+    console.print(table)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Send one prompt to several models concurrently.")
+    parser.add_argument('sources',
+                        nargs='*',
+                        help="URLs, file paths or prompt text.")
+    parser.add_argument('-m',
+                        '--model',
+                        action='append',
+                        default=[],
+                        help="provider:model, may be repeated or comma "
+                             + "separated (default: LLM_FANOUT_MODELS, "
+                             + "else GEMINI_MODEL and OPENAI_MODEL).")
+    parser.add_argument('--policy',
+                        choices=POLICIES,
+                        default="compare",
+                        help="race: show the first complete answer and "
+                             + "cancel the rest; compare: show all answers "
+                             + "side by side.")
+    parser.add_argument('-p',
+                        '--plain_text',
+                        action='store_true',
+                        help="Display plain text.")
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help="Bypass the source cache.")
+    args = parser.parse_args()
+
+    specs = args.model
+    if len(specs) == 0 and FANOUT_MODELS is not None:
+        specs = [FANOUT_MODELS]
+    models = parse_models(specs) if len(specs) > 0 else default_models()
+    if len(models) < 2:
+        print("At least two models are needed.")
+        exit(1)
+
+    if args.plain_text is True:
+        llm_cli.PLAIN_TEXT = True
+
+    if args.no_cache is True:
+        source_cache.get_cache().enabled = False
+
+    clients = [(provider, create_client(provider, model))
+               for provider, model in models]
+
+    data, _ = clients[0][1].load_sources(args.sources)
+    if not sys.stdin.isatty():
+        data = clients[0][1].append_to_data(data, sys.stdin.read())
+    if len(data) == 0:
+        print("No prompt.")
+        exit(1)
+
+    results = fan_out(clients, data, args.policy)
+    print_results(results, args.policy)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,61 @@
 #!/usr/bin/env python3
 
+import atexit
+import backoff
 import json
 import llm_cli
+import metrics
 import mimetypes
 import os
 import requests
+import resilience
+import source_cache
+import streaming_body
+import threading
 import time
+import transport
+import upload_registry
 
 API_KEY = os.getenv("GOOGLE_API_KEY")
 if API_KEY is None:
     print("GOOGLE_API_KEY environment variable must be set.")
     exit(1)
 MODEL = os.getenv("GEMINI_MODEL")
-if MODEL is None:
-    print("GEMINI_MODEL environment variable must be set.")
-    exit(1)
-API_URL = "https://generativelanguage.googleapis.com/v1beta/models/" \
-        + MODEL + ":generateContent?key=" + API_KEY
-UPLOAD_URL = "https://generativelanguage.googleapis.com/upload/v1beta/files" \
+API_BASE = os.getenv("GEMINI_API_BASE",
+                     "https://generativelanguage.googleapis.com")
+UPLOAD_URL = API_BASE + "/upload/v1beta/files" \
         + "?key=" + API_KEY
-FILES_URL = "https://generativelanguage.googleapis.com/v1beta/files"
+FILES_URL = API_BASE + "/v1beta/files"
+UPLOAD_CHUNK_SIZE = int(os.getenv("GEMINI_UPLOAD_CHUNK_SIZE",
+                                str(8 * 1024 * 1024)))
+UPLOAD_RETRIES = int(os.getenv("GEMINI_UPLOAD_RETRIES", "5"))
+PROCESSING_TIMEOUT = float(os.getenv("GEMINI_PROCESSING_TIMEOUT", "900"))
+CACHE_URL = API_BASE + "/v1beta/cachedContents"
+CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "1") != "0"
+CONTEXT_CACHE_MIN_BYTES = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_BYTES",
+                                        "100000"))
+CONTEXT_CACHE_TTL = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL", "600"))
+CONTEXT_CACHE_REFRESH_MARGIN = 60
 
 
 class Gemini(llm_cli.Chat):
 
-    def _send(self, data, conversation):
+    # Larger images are cropped into 768 x 768 tiles; 1536 px keeps the
+    # longer side within two tiles.
+    image_max_dimension = 1536
 
-        if conversation is None:
-            messages = []
-        else:
-            messages = list(conversation)
+    context_cache = None
+
+    context_cache_stats = None
+
+    processing_stats = None
 
+    processing_lock = threading.Lock()
+
+    def _model_url(self, method):
+        return f"{API_BASE}/v1beta/models/{self.MODEL}:{method}"
+
+    def _build_user_message(self, data):
         user_message = {
             "role": "user",
             "parts": [
@@ -57,30 +82,218 @@ class Gemini(llm_cli.Chat):
                             "data": item['content']
                         }
                     })
+        return user_message
+
+    def _build_model_message(self, content):
+        return {"role": "model", "parts": [{"text": content}]}
+
+    def _build_request(self, data, conversation):
+
+        cache_name = None
+        if conversation is not None:
+            if len(conversation) == 0:
+                self._delete_context_cache()
+                data = self._create_context_cache(data, conversation)
+            cache_name = self._use_context_cache(conversation)
+
+        if conversation is None:
+            messages = []
+        else:
+            messages = list(conversation)
+
+        user_message = self._build_user_message(data)
 
         messages.append(user_message)
         self.write_chat_log(user_message)
         if conversation is not None:
             conversation.append(user_message)
 
-        content = ''
-        grounding_chunks = None
-        try:
-            headers = {
-                'Content-Type': 'application/json',
-            }
+        headers = {
+            'Content-Type': 'application/json',
+        }
+
+        return headers, self._build_body(messages, cache_name)
 
+    def _build_body(self, messages, cache_name=None):
+        # Request body for messages; no logging or conversation changes.
+        if cache_name is not None:
+            # The cached prefix is referenced by name instead of resent.
+            data = {
+                'cachedContent': cache_name,
+                'contents': messages[1:]
+            }
+        else:
             data = {
                 'contents': messages
             }
 
-            if self.grounding is True:
-                data['tools'] = [{'google_search': {}}]
+        if self.grounding is True:
+            data['tools'] = [{'google_search': {}}]
+
+        return data
+
+    def _create_context_cache(self, data, conversation):
+        # Large attachments of the first turn are registered once as
+        # cachedContents; the remaining item is sent as a normal message.
+        if CONTEXT_CACHE is False or self.grounding is True or \
+                len(data) < 2 or \
+                self.calc_data_size(data[:-1]) < CONTEXT_CACHE_MIN_BYTES:
+            return data
+
+        stats = self._context_cache_stats()
+        message = self._build_user_message(data[:-1])
+        body = {
+            'model': f"models/{self.MODEL}",
+            'contents': [message],
+            'ttl': f"{CONTEXT_CACHE_TTL}s",
+        }
+        try:
+            response = transport.post(f"{CACHE_URL}?key={API_KEY}",
+                                      headers={
+                                          'Content-Type': 'application/json'
+                                      },
+                                      data=streaming_body.dumps(body))
+            if response.status_code != 200:
+                print("Context cache is not available: "
+                      + response.json().get('error', {}).get('message', ''))
+                stats['misses'] += 1
+                return data
+            result = response.json()
+        except Exception as e:
+            print(f"Context cache is not available: {e}")
+            stats['misses'] += 1
+            return data
+
+        if stats['created'] == 0:
+            atexit.register(self._delete_context_cache)
+        self.context_cache = {
+            'name': result['name'],
+            'message': message,
+            'expires': time.time() + CONTEXT_CACHE_TTL,
+            # The turn that creates the cache pays for the whole prefix.
+            'new': True,
+        }
+        stats['created'] += 1
+        stats['cached_tokens'] = \
+            result.get('usageMetadata', {}).get('totalTokenCount', 0)
+
+        self.write_chat_log(message)
+        conversation.append(message)
+        return data[-1:]
+
+    def _use_context_cache(self, conversation):
+        cache = self.context_cache
+        if cache is None:
+            return None
+
+        if len(conversation) == 0 or conversation[0] is not cache['message']:
+            # The cached prefix is no longer part of the conversation.
+            self._context_cache_stats()['misses'] += 1
+            self._delete_context_cache()
+            return None
+
+        if cache['expires'] - time.time() < CONTEXT_CACHE_REFRESH_MARGIN:
+            try:
+                response = transport.patch(
+                        f"{CACHE_URL}/{cache['name'].split('/')[-1]}"
+                        + f"?key={API_KEY}&updateMask=ttl",
+                        headers={'Content-Type': 'application/json'},
+                        data=json.dumps({'ttl': f"{CONTEXT_CACHE_TTL}s"}))
+                response.raise_for_status()
+            except Exception as e:
+                print(f"Failed to refresh context cache: {e}")
+                self._context_cache_stats()['misses'] += 1
+                self.context_cache = None
+                return None
+            cache['expires'] = time.time() + CONTEXT_CACHE_TTL
+            self._context_cache_stats()['refreshed'] += 1
+
+        if cache.pop('new', False) is True:
+            self._context_cache_stats()['misses'] += 1
+        else:
+            self._context_cache_stats()['hits'] += 1
+        return cache['name']
+
+    def _delete_context_cache(self):
+        cache = self.context_cache
+        if cache is None:
+            return
+        self.context_cache = None
+        try:
+            transport.delete(
+                f"{CACHE_URL}/{cache['name'].split('/')[-1]}"
+                + f"?key={API_KEY}",
+                timeout=(5.0, 5.0))
+        except Exception:
+            pass
+
+    def _context_cache_stats(self):
+        if self.context_cache_stats is None:
+            self.context_cache_stats = {
+                'created': 0,
+                'refreshed': 0,
+                'hits': 0,
+                'misses': 0,
+                'cached_tokens': 0,
+                'saved_tokens': 0,
+            }
+        return self.context_cache_stats
+
+    def _count_cached_tokens(self, usage):
+        if usage is not None and 'cachedContentTokenCount' in usage:
+            self._context_cache_stats()['saved_tokens'] += \
+                usage['cachedContentTokenCount']
+
+    def print_info(self, sources, data_size):
+        super().print_info(sources, data_size)
+        print("uploads: ", end="")
+        print(json.dumps(upload_registry.get_registry().stats(),
+                         indent=2, ensure_ascii=False))
+        if self.processing_stats is not None:
+            stats = dict(self.processing_stats)
+            stats['wait_seconds'] = round(stats['wait_seconds'], 1)
+            print("file processing: ", end="")
+            print(json.dumps(stats, indent=2, ensure_ascii=False))
+        if self.context_cache_stats is not None:
+            stats = dict(self.context_cache_stats)
+            if self.context_cache is not None:
+                stats['name'] = self.context_cache['name']
+                stats['expires_in'] = \
+                    int(self.context_cache['expires'] - time.time())
+            print("context cache: ", end="")
+            print(json.dumps(stats, indent=2, ensure_ascii=False))
+
+    def _finish(self, content, finish_reason, conversation):
+        if content is not None:
+            content = content.rstrip(" \n")
+            if content.startswith("'content'"):
+                print(content)
+        else:
+            content = "ERROR: Failed to get contents in the response. " \
+                 + f"Reason: {finish_reason}"
+        model_message = self._build_model_message(content)
 
-            response = requests.post(API_URL,
-                                     headers=headers,
-                                     data=json.dumps(data))
+        self.write_chat_log(model_message)
+        if conversation is not None:
+            conversation.append(model_message)
+        return content
+
+    def _send(self, data, conversation):
 
+        headers, data = self._build_request(data, conversation)
+        self.last_status = None
+
+        url = self._model_url("generateContent?key=" + API_KEY)
+        content = ''
+        grounding_chunks = None
+        try:
+            with metrics.span("provider_call"):
+                response = resilience.post(url,
+                                           headers=headers,
+                                           retries=self.retries,
+                                           data=streaming_body.dumps(data))
+
+            self.last_status = response.status_code
             self.write_request_debug_log(headers, data, response)
 
             if response.status_code != 200:
@@ -92,46 +305,219 @@ class Gemini(llm_cli.Chat):
 
             result = response.json()
 
-            if 'content' in result['candidates'][0]:
-                content = \
-                    result['candidates'][0]['content']['parts'][0]['text']
-                content = content.rstrip(" \n")
-                if content.startswith("'content'"):
-                    print(content)
-                model_message = {"role": "model", "parts": [{"text": content}]}
+            candidate = result['candidates'][0]
+            if 'content' in candidate:
+                content = candidate['content']['parts'][0]['text']
 
-                if 'groundingMetadata' in result['candidates'][0]:
-                    gr_metadata = result['candidates'][0]['groundingMetadata']
+                if 'groundingMetadata' in candidate:
+                    gr_metadata = candidate['groundingMetadata']
                     if 'groundingChunks' in gr_metadata:
                         grounding_chunks = gr_metadata['groundingChunks']
-
             else:
-                content = "ERROR: Failed to get contents in the response. " \
-                     + f"Reason: {result['candidates'][0]['finishReason']}"
-                model_message = {"role": "model", "parts": [{"text": content}]}
+                content = None
+
+            content = self._finish(content,
+                                   candidate.get('finishReason'),
+                                   conversation)
 
             usage = result['usageMetadata']
+            self._count_cached_tokens(usage)
 
-            self.write_chat_log(model_message)
-            if conversation is not None:
-                conversation.append(model_message)
+        except Exception as e:
+            print(f"ERROR:{e}")
+            return None, None, None
+        return content, usage, grounding_chunks
+
+    def _send_stream(self, data, conversation):
+
+        headers, data = self._build_request(data, conversation)
+        self.last_status = None
+
+        url = self._model_url("streamGenerateContent?alt=sse&key=" + API_KEY)
+        parts = []
+        usage = None
+        grounding_chunks = None
+        finish_reason = None
+        response = None
+        try:
+            start = time.perf_counter()
+            response = resilience.post(url,
+                                       headers=headers,
+                                       retries=self.retries,
+                                       data=streaming_body.dumps(data),
+                                       stream=True)
+
+            self.last_status = response.status_code
+            if response.status_code != 200:
+                self.write_request_debug_log(headers, data, response)
+                json_str = json.dumps(response.json(),
+                                      ensure_ascii=False,
+                                      indent=2)
+                print(json_str)
+                return None, None, None
+
+            # Server-Sent Events: one GenerateContentResponse per event.
+            response.encoding = 'utf-8'
+            chunks = []
+            for line in response.iter_lines(decode_unicode=True):
+                metrics.add_bytes(received=len(line) + 1)
+                if not line or not line.startswith('data:'):
+                    continue
+                chunk = json.loads(line[5:])
+                chunks.append(chunk)
+
+                if 'usageMetadata' in chunk:
+                    usage = chunk['usageMetadata']
+                if 'candidates' not in chunk:
+                    continue
+                candidate = chunk['candidates'][0]
+                finish_reason = candidate.get('finishReason', finish_reason)
+                if 'groundingMetadata' in candidate:
+                    gr_metadata = candidate['groundingMetadata']
+                    if 'groundingChunks' in gr_metadata:
+                        grounding_chunks = gr_metadata['groundingChunks']
+                for part in candidate.get('content', {}).get('parts', []):
+                    if 'text' in part:
+                        parts.append(part['text'])
+                        yield part['text']
+
+            metrics.record("provider_call", time.perf_counter() - start)
+            self.write_request_debug_log(headers, data, response, chunks)
+
+            content = self._finish(''.join(parts) if parts else None,
+                                   finish_reason,
+                                   conversation)
+            self._count_cached_tokens(usage)
 
         except Exception as e:
             print(f"ERROR:{e}")
             return None, None, None
+        finally:
+            if response is not None:
+                response.close()
         return content, usage, grounding_chunks
 
-    def _upload_file(self, path):
+    def _get_file(self, name):
+        try:
+            response = transport.get(
+                    f"{FILES_URL}/{name}?key={API_KEY}", timeout=10)
+            response.raise_for_status()
+            file_info = response.json()
+        except requests.exceptions.RequestException as e:
+            print(f"Error checking file status: {e}")
+            return None
+        # files.get returns the File itself, the upload response wraps it.
+        return file_info.get("file", file_info)
+
+    def _reuse_upload(self, registry, digest, entry):
+        if upload_registry.is_reusable(entry):
+            registry.count("reused")
+            return entry
+
+        # Stale or still processing: revalidate with a single GET.
+        name = entry.get("name", "").split('/')[-1]
+        file_info = self._get_file(name) if name != '' else None
+        registry.count("revalidated")
+        if file_info is None or file_info.get("state") == "FAILED":
+            registry.remove(digest)
+            return None
+        entry = upload_registry.entry_from_file_info(file_info,
+                                                     entry.get("size"))
+        registry.put(digest, entry)
+        if upload_registry.is_reusable(entry) or \
+                entry["state"] == "PROCESSING":
+            return entry
+        registry.remove(digest)
+        return None
+
+    def _upload_file(self, path, mime_type=None):
 
         # --- 1. Determine MIME Type and File Size ---
-        mime_type = mimetypes.guess_type(path)[0]
+        if mime_type is None:
+            mime_type = mimetypes.guess_type(path)[0]
         if mime_type is None:
             print(f"Error: Could not determine MIME type for {path}")
             return None, None
         num_bytes = os.path.getsize(path)
         display_name = os.path.basename(path)
 
-        # --- 2. Initiate Resumable Upload ---
+        # --- 2. Reuse a Previous Upload of the Same Content ---
+        registry = upload_registry.get_registry()
+        digest = source_cache.get_cache().file_digest(path)
+        entry = registry.get(digest)
+        if entry is not None and entry.get("state") != "UPLOADING":
+            entry = self._reuse_upload(registry, digest, entry)
+            if entry is not None:
+                file_uri = entry["file_uri"]
+                state = entry["state"]
+                if state == "PROCESSING":
+                    state = self._wait_for_file(file_uri, digest, num_bytes)
+                    if state is None:
+                        return None, None
+                print(f"Reusing uploaded file url: {file_uri}")
+                return file_uri, num_bytes
+
+        # --- 3. Initiate or Resume the Resumable Upload ---
+        upload_url = None
+        granularity = 1
+        offset = 0
+        if entry is not None and entry.get("state") == "UPLOADING":
+            upload_url = entry.get("upload_url")
+            granularity = entry.get("granularity", 1)
+            offset = self._query_upload_offset(upload_url)
+            if offset is None:
+                upload_url = None
+                offset = 0
+            else:
+                print(f"Resuming upload of {display_name} at {offset} bytes")
+
+        if upload_url is None:
+            upload_url, granularity = self._start_upload(
+                    mime_type, num_bytes, display_name)
+            if upload_url is None:
+                return None, None
+            registry.put(digest, {
+                "state": "UPLOADING",
+                "upload_url": upload_url,
+                "granularity": granularity,
+                "size": num_bytes,
+                "expiration_time": time.time() + 7 * 24 * 3600,
+            })
+
+        # --- 4. Upload the Data in Chunks ---
+        file_info = self._upload_chunks(path, upload_url, offset,
+                                        num_bytes, granularity,
+                                        display_name)
+        if file_info is None:
+            return None, None
+
+        # --- 5. Check File Status and Wait for Processing ---
+        file_info = file_info.get("file", {})
+        file_uri = file_info.get("uri")
+        if not file_uri:
+            print("Error: 'file.uri' not found in file_info.")
+            print("file_info:", file_info)
+            return None, None
+
+        state = file_info.get("state")
+        if not state:
+            print("Error: 'file.state' not found.")
+            return None, None
+
+        registry.count("uploaded")
+        registry.put(digest,
+                     upload_registry.entry_from_file_info(file_info,
+                                                          num_bytes))
+
+        if state == "PROCESSING":
+            state = self._wait_for_file(file_uri, digest, num_bytes)
+            if state is None:
+                return None, None
+
+        print(f"Uploaded file url: {file_uri}")
+        return file_uri, num_bytes
+
+    def _start_upload(self, mime_type, num_bytes, display_name):
         headers = {
             "X-Goog-Upload-Protocol": "resumable",
             "X-Goog-Upload-Command": "start",
@@ -142,9 +528,9 @@ class Gemini(llm_cli.Chat):
         data = {"file": {"display_name": display_name}}
 
         try:
-            response = requests.post(UPLOAD_URL,
-                                     headers=headers,
-                                     json=data, timeout=10)
+            response = transport.post(UPLOAD_URL,
+                                      headers=headers,
+                                      json=data, timeout=10)
             response.raise_for_status()
         except requests.exceptions.RequestException as e:
             print(f"Error initiating upload: {e}")
@@ -155,57 +541,128 @@ class Gemini(llm_cli.Chat):
             print("Error: 'X-Goog-Upload-URL' not found in response headers.")
             print("Response Headers:", response.headers)
             return None, None
+        granularity = int(response.headers.get(
+            "X-Goog-Upload-Chunk-Granularity", "1"))
+        return upload_url, granularity
 
-        # --- 3. Upload the Data ---
-        upload_headers = {
-            "Content-Length": str(num_bytes),
-            "X-Goog-Upload-Offset": "0",
-            "X-Goog-Upload-Command": "upload, finalize",
-        }
-
+    def _query_upload_offset(self, upload_url):
         try:
-            with open(path, "rb") as f:
-                response = requests.post(upload_url,
-                                         headers=upload_headers,
-                                         data=f,
-                                         timeout=300)
-                response.raise_for_status()
-                file_info = response.json()
+            response = transport.post(upload_url,
+                                      headers={
+                                          "X-Goog-Upload-Command": "query",
+                                      },
+                                      timeout=10)
+            response.raise_for_status()
         except requests.exceptions.RequestException as e:
-            print(f"Error uploading video data: {e}")
-            return None, None
-
-        # --- 4. Check File Status and Wait for Processing ---
-        file_uri = file_info.get("file", {}).get("uri")
-        if not file_uri:
-            print("Error: 'file.uri' not found in file_info.")
-            print("file_info:", file_info)
-            return None, None
-
-        state = file_info.get("file", {}).get("state")
-        if not state:
-            print("Error: 'file.state' not found.")
-            return None, None
-
+            print(f"Error querying upload status: {e}")
+            return None
+        if response.headers.get("X-Goog-Upload-Status") != "active":
+            return None
+        return int(response.headers.get("X-Goog-Upload-Size-Received", "0"))
+
+    def _upload_chunks(self, path, upload_url, offset, num_bytes,
+                       granularity, display_name):
+        # Every chunk except the last must be a multiple of the
+        # granularity announced by the server.
+        chunk_size = max(UPLOAD_CHUNK_SIZE // granularity, 1) * granularity
+        failures = 0
+        with open(path, "rb") as f, \
+                llm_cli.progress_task(display_name, num_bytes) as update:
+            update(offset)
+            while True:
+                f.seek(offset)
+                chunk = f.read(chunk_size)
+                last = offset + len(chunk) >= num_bytes
+                upload_headers = {
+                    "Content-Length": str(len(chunk)),
+                    "X-Goog-Upload-Offset": str(offset),
+                    "X-Goog-Upload-Command":
+                        "upload, finalize" if last else "upload",
+                }
+                try:
+                    response = transport.post(upload_url,
+                                              headers=upload_headers,
+                                              data=chunk,
+                                              timeout=300)
+                    response.raise_for_status()
+                except requests.exceptions.RequestException as e:
+                    status = getattr(e.response, "status_code", None) \
+                        if isinstance(e, requests.exceptions.HTTPError) \
+                        else None
+                    failures += 1
+                    if failures > UPLOAD_RETRIES or \
+                            (status is not None and status < 500
+                             and status != 429):
+                        print(f"Error uploading video data: {e}")
+                        return None
+                    time.sleep(min(2 ** failures, 30))
+                    # Continue from what the server actually received.
+                    received = self._query_upload_offset(upload_url)
+                    if received is None:
+                        print(f"Error uploading video data: {e}")
+                        return None
+                    offset = received
+                    update(offset)
+                    continue
+
+                offset += len(chunk)
+                update(offset)
+                if last:
+                    return response.json()
+
+    def _wait_for_file(self, file_uri, digest, num_bytes):
+        # Polls with exponential backoff and jitter until the deadline;
+        # other sources keep loading on the worker pool meanwhile.
         name = file_uri.split('/')[-1]
-        while state == "PROCESSING":
-            print("Processing file...")
-            time.sleep(3)
-            try:
-                response = requests.get(f"{FILES_URL}/{name}?key={API_KEY}",
-                                        timeout=10)
-                response.raise_for_status()
-                file_info = response.json()
-                state = file_info.get("file", {}).get("state")
-            except requests.exceptions.RequestException as e:
-                print(f"Error checking file status: {e}")
-                return None, None
-
-        print(f"Uploaded file url: {file_uri}")
-        return file_uri, num_bytes
+        print(f"Processing file {name}...")
+        polls = 0
+        last_info = None
+
+        def check():
+            nonlocal polls, last_info
+            polls += 1
+            file_info = self._get_file(name)
+            if file_info is None or file_info.get("state") == "PROCESSING":
+                return None
+            last_info = file_info
+            return file_info.get("state")
+
+        state, waited = backoff.poll(check, PROCESSING_TIMEOUT,
+                                     initial=1.0, factor=1.5, maximum=15.0,
+                                     immediate=False)
+        file_info = last_info
+
+        with self.processing_lock:
+            if self.processing_stats is None:
+                self.processing_stats = {
+                    'files': 0,
+                    'polls': 0,
+                    'wait_seconds': 0.0,
+                }
+            self.processing_stats['files'] += 1
+            self.processing_stats['polls'] += polls
+            self.processing_stats['wait_seconds'] += waited
+
+        if state is None:
+            print(f"Error: file {name} is still processing after "
+                  + f"{waited:.0f} seconds.")
+            return None
+
+        registry = upload_registry.get_registry()
+        if state != "ACTIVE":
+            print(f"Error: file processing ended in state {state}.")
+            registry.remove(digest)
+            return None
+        registry.put(digest,
+                     upload_registry.entry_from_file_info(file_info,
+                                                          num_bytes))
+        return state
 
 
 # CLI Interface
 if __name__ == "__main__":
+    if MODEL is None:
+        print("GEMINI_MODEL environment variable must be set.")
+        exit(1)
     gemini = Gemini(MODEL)
     gemini.main()
@@ -3,13 +3,15 @@
 import argparse
 import json
 import os
-import requests
+import transport
 
 API_KEY = os.getenv("GOOGLE_API_KEY")
 if API_KEY is None:
     print("GOOGLE_API_KEY environment variable must be set.")
     exit(1)
-API_URL = "https://generativelanguage.googleapis.com/v1beta/models" \
+API_BASE = os.getenv("GEMINI_API_BASE",
+                     "https://generativelanguage.googleapis.com")
+API_URL = API_BASE + "/v1beta/models" \
           + "?key=" + API_KEY
 
 parser = argparse.ArgumentParser()
@@ -20,7 +22,7 @@ parser.add_argument("-v",
 args = parser.parse_args()
 verbose = args.v
 
-response = requests.get(API_URL)
+response = transport.get(API_URL)
 
 if response.status_code == 200:
     result = response.json()
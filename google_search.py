@@ -1,10 +1,15 @@
 import argparse
 import json
+import llm_cli
 import os
-import requests
+import queue
 import sys
+import threading
+import transport
 import urllib.parse
 
+from collections import deque
+from concurrent.futures import Future
 from prompt_toolkit.application import Application
 from prompt_toolkit.application.current import get_app
 from prompt_toolkit.key_binding.bindings.focus \
@@ -17,6 +22,7 @@ from prompt_toolkit.layout.containers import HSplit
 from prompt_toolkit.shortcuts import dialogs, prompt
 from prompt_toolkit.widgets import Button, Dialog, Label, RadioList
 from rich.console import Console
+from rich.markdown import Markdown
 from rich.rule import Rule
 
 
@@ -35,16 +41,172 @@ if HELPER_CLASS is None:
 
 if HELPER_CLASS == "openai":
     import openai
-    search_helper = openai.OPENAI(os.getenv("OPENAI_MODEL"))
+    if openai.MODEL is None:
+        print("OPENAI_MODEL environment variable must be set.")
+        exit(1)
+    search_helper = openai.OPENAI(openai.MODEL)
 else:
     import gemini
-    search_helper = gemini.Gemini(os.getenv("GEMINI_MODEL"))
+    if gemini.MODEL is None:
+        print("GEMINI_MODEL environment variable must be set.")
+        exit(1)
+    search_helper = gemini.Gemini(gemini.MODEL)
+
+# Result pages are fetched while the result list is shown; with
+# summaries, a short answer for each page is generated as well.
+PREFETCH = os.getenv("SEARCH_PREFETCH", "1") != "0"
+PREFETCH_SUMMARIES = os.getenv("SEARCH_PREFETCH_SUMMARIES", "0") == "1"
+SUMMARY_WORKERS = int(os.getenv("SEARCH_SUMMARY_WORKERS", "4"))
+SUMMARY_PROMPT = os.getenv("SEARCH_SUMMARY_PROMPT",
+                           "Summarize this page briefly.")
 
 # rich
 console = Console()
 separator = Rule()
 
 
+class DaemonExecutor():
+
+    # A minimal ThreadPoolExecutor with daemon threads: a summary that is
+    # still being generated does not keep the program from exiting.
+
+    def __init__(self, max_workers):
+        self.max_workers = max(1, max_workers)
+        self.tasks = queue.SimpleQueue()
+        for _ in range(self.max_workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            future, function, args = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def submit(self, function, *args):
+        future = Future()
+        self.tasks.put((future, function, args))
+        return future
+
+    def shutdown(self):
+        # Queued calls are cancelled; running ones are abandoned.
+        while True:
+            try:
+                task = self.tasks.get_nowait()
+            except queue.Empty:
+                break
+            if task is not None:
+                task[0].cancel()
+        for _ in range(self.max_workers):
+            self.tasks.put(None)
+
+
+class CapturedOutput():
+
+    # Stands in for sys.stdout and sys.stderr while pages are prefetched.
+    # Output of the prefetch threads would garble the full-screen result
+    # list, so it is kept until the list is closed; other threads write
+    # through.
+
+    def __init__(self, stream, messages):
+        self.stream = stream
+        self.messages = messages
+
+    def write(self, text):
+        if getattr(_capture, "enabled", False):
+            self.messages.put(text)
+            return len(text)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+_capture = threading.local()
+
+
+class Prefetcher():
+
+    def __init__(self, helper, summaries=False):
+        self.helper = helper
+        self.summaries = summaries
+        self.loader = DaemonExecutor(llm_cli.SOURCE_WORKERS)
+        self.summarizer = DaemonExecutor(SUMMARY_WORKERS)
+        self.pages = {}
+        self.summary_futures = {}
+        self.messages = queue.SimpleQueue()
+        self.streams = sys.stdout, sys.stderr
+        sys.stdout = CapturedOutput(sys.stdout, self.messages)
+        sys.stderr = CapturedOutput(sys.stderr, self.messages)
+
+    def start(self, urls):
+        for url in urls:
+            if url in self.pages:
+                continue
+            self.pages[url] = self.loader.submit(self._load, url)
+            if self.summaries is True:
+                self.summary_futures[url] = \
+                    self.summarizer.submit(self._summarize, url)
+
+    def _load(self, url):
+        _capture.enabled = True
+        item, _ = self.helper._timed_load_source(url)
+        return item
+
+    def _summarize(self, url):
+        _capture.enabled = True
+        item = self.pages[url].result()
+        if item is None:
+            return None
+        # A separate client: requests run concurrently and clients keep
+        # per-call state.
+        client = type(self.helper)(self.helper.MODEL)
+        items = item if isinstance(item, list) else [item]
+        data = client.append_to_data(items, SUMMARY_PROMPT)
+        content, _, _ = client._send(data, None)
+        if content is None:
+            return None
+        return data, content
+
+    def page(self, url):
+        future = self.pages.get(url)
+        return None if future is None else future.result()
+
+    def summary(self, url):
+        future = self.summary_futures.get(url)
+        if future is None:
+            return None
+        if not future.done():
+            with console.status("Summarizing..."):
+                return future.result()
+        return future.result()
+
+    def print_messages(self):
+        # Errors and warnings of the prefetch threads so far.
+        while True:
+            try:
+                text = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            self.streams[0].write(text)
+        self.streams[0].flush()
+
+    def shutdown(self):
+        self.loader.shutdown()
+        self.summarizer.shutdown()
+        sys.stdout, sys.stderr = self.streams
+        self.print_messages()
+
+
 def reset_terminal():
     sys.stdout.write('\x1bc')
     sys.stdout.flush()
@@ -88,7 +250,28 @@ def select_list(title, explanation, items, default):
     ).run()
 
 
-def search(query):
+def show_result(prefetcher, url):
+    summary = prefetcher.summary(url)
+    prefetcher.print_messages()
+    if summary is not None:
+        # The page and its summary become the first turn of the chat.
+        data, content = summary
+        search_helper.conversation = deque([
+            search_helper._build_user_message(data),
+            search_helper._build_model_message(content)])
+        console.print(separator)
+        console.print(Markdown(f"**({search_helper.MODEL}):**"))
+        console.print(Markdown(content))
+        search_helper.talk(None, sources=[url])
+        return True
+
+    item = prefetcher.page(url)
+    prefetcher.print_messages()
+    return search_helper.process_sources(
+        [url], None if item is None else {url: item})
+
+
+def search(query, prefetch=PREFETCH, summaries=PREFETCH_SUMMARIES):
 
     param = {
         "q": query
@@ -102,10 +285,20 @@ def search(query):
 
     startIndex = 0
 
+    prefetcher = Prefetcher(search_helper, summaries)
+    try:
+        return browse(base_url, headers, query, startIndex, prefetcher,
+                      prefetch)
+    finally:
+        prefetcher.shutdown()
+
+
+def browse(base_url, headers, query, startIndex, prefetcher, prefetch):
+
     while True:
 
         url = base_url + f"&start={startIndex}"
-        response = requests.get(url, headers=headers, timeout=(10.0, 10.0))
+        response = transport.get(url, headers=headers, timeout=(10.0, 10.0))
 
         search_results = {}
         if response.status_code == 200:
@@ -128,6 +321,9 @@ def search(query):
         for item in search_results['items']:
             links.append((item['link'], item['title']))
 
+        if prefetch is True:
+            prefetcher.start([link for link, _ in links])
+
         prevIndex = -1
         nextIndex = -1
 
@@ -168,7 +364,7 @@ def search(query):
             console.print(selected_title)
             print(result)
             search_helper.clear()
-            if search_helper.process_sources([result]) is False:
+            if show_result(prefetcher, result) is False:
                 prompt("Press the enter key to continue. ")
 
     return True
@@ -181,10 +377,19 @@ if __name__ == "__main__":
     parser.add_argument('query',
                         nargs='*',
                         help="Specify query keywords.")
+    parser.add_argument('--no-prefetch',
+                        action='store_true',
+                        help="Fetch a result page only when it is selected.")
+    parser.add_argument('--summaries',
+                        action='store_true',
+                        default=PREFETCH_SUMMARIES,
+                        help="Summarize every result page in advance.")
 
     args = parser.parse_args()
 
     if len(args.query) == 0:
         print('Query string is not specified.')
     else:
-        search(' '.join(args.query))
+        search(' '.join(args.query),
+               prefetch=not args.no_prefetch,
+               summaries=args.summaries and not args.no_prefetch)
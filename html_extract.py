@@ -0,0 +1,353 @@
+import codecs
+import html.parser
+import os
+import re
+
+# Constants
+# main: the article text without navigation, footers and other boilerplate;
+# text: all visible text.
+HTML_EXTRACTOR = os.getenv("LLM_HTML_EXTRACTOR", "main")
+# auto: lxml when it is installed, else the standard library parser.
+HTML_PARSER = os.getenv("LLM_HTML_PARSER", "auto")
+EXTRACTORS = ["main", "text"]
+PARSERS = ["auto", "lxml", "html.parser"]
+# Text inside <article> or <main> is trusted when there is at least this much.
+MAIN_MIN_CHARS = 200
+# Blocks at least this long with few links are content.
+GOOD_BLOCK_CHARS = 80
+GOOD_LINK_DENSITY = 0.25
+BAD_LINK_DENSITY = 0.5
+# Short blocks and headings are kept near content blocks.
+CONTEXT_BLOCKS = 3
+META_SCAN_BYTES = 4096
+# Shorter undeclared non-UTF-8 content is decoded as windows-1252, like
+# browsers do; guesses from a few bytes are unreliable.
+DETECT_MIN_BYTES = 256
+
+SKIP_TAGS = {"script", "style", "noscript", "template", "svg", "canvas",
+             "iframe", "object", "head", "select", "button"}
+BOILERPLATE_TAGS = {"nav", "header", "footer", "aside", "form", "menu",
+                    "dialog"}
+BOILERPLATE_ROLES = {"navigation", "banner", "contentinfo", "complementary",
+                     "search", "menu", "dialog"}
+BLOCK_TAGS = {"p", "div", "section", "article", "main", "li", "ul", "ol",
+              "dl", "dt", "dd", "table", "tr", "td", "th", "caption",
+              "h1", "h2", "h3", "h4", "h5", "h6", "pre", "blockquote",
+              "figure", "figcaption", "br", "hr", "address", "details",
+              "summary", "body"}
+HEADING_TAGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input",
+             "link", "meta", "source", "track", "wbr"}
+UNLIKELY = re.compile(r'comment|footer|sidebar|menu|navbar|nav-|-nav|'
+                      + r'breadcrumb|share|social|sponsor|advert|promo|'
+                      + r'cookie|banner|popup|modal|newsletter|subscribe|'
+                      + r'related|pagination|masthead|skip-link', re.I)
+LIKELY = re.compile(r'article|content|main|post|entry|story|text|body',
+                    re.I)
+META_CHARSET = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?\s*([\w.:-]+)',
+                          re.I)
+# Labels that browsers decode as windows-1252.
+WINDOWS_1252 = {"iso-8859-1", "iso8859-1", "latin1", "latin-1", "ascii",
+                "us-ascii"}
+BOMS = [
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+
+def header_charset(content_type):
+    # "text/html; charset=ISO-8859-1" -> "iso-8859-1"
+    for param in (content_type or '').split(';')[1:]:
+        name, _, value = param.partition('=')
+        if name.strip().lower() == 'charset':
+            return value.strip().strip('"\'').lower() or None
+    return None
+
+
+def _codec(label):
+    if label is None:
+        return None
+    label = label.lower()
+    if label in WINDOWS_1252:
+        return "cp1252"
+    try:
+        return codecs.lookup(label).name
+    except LookupError:
+        return None
+
+
+def detect_charset(content, content_type=None, html=False):
+    # Byte order mark, then the Content-Type header, then <meta> (HTML),
+    # then UTF-8 if it decodes, then charset_normalizer if installed,
+    # else windows-1252.
+    for bom, encoding in BOMS:
+        if content.startswith(bom):
+            return encoding
+    encoding = _codec(header_charset(content_type))
+    if encoding is not None:
+        return encoding
+    if html:
+        match = META_CHARSET.search(content[:META_SCAN_BYTES])
+        if match is not None:
+            encoding = _codec(match.group(1).decode('ascii', 'replace'))
+            if encoding is not None:
+                return encoding
+    try:
+        content.decode('utf-8')
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    if len(content) < DETECT_MIN_BYTES:
+        return "cp1252"
+    try:
+        import charset_normalizer
+    except ImportError:
+        return "cp1252"
+    # UTF-16 and UTF-32 without a byte order mark are too rare to guess.
+    best = charset_normalizer.from_bytes(
+        content[:65536],
+        cp_exclusion=["utf_16", "utf_16_be", "utf_16_le",
+                      "utf_32", "utf_32_be", "utf_32_le"]).best()
+    return "cp1252" if best is None else best.encoding
+
+
+def decode(content, content_type=None, html=False):
+    if isinstance(content, str):
+        return content
+    encoding = detect_charset(content, content_type, html)
+    return content.decode(encoding, errors='replace')
+
+
+def _unlikely(tag, attrs):
+    if tag in ("html", "body", "article", "main"):
+        return False
+    if attrs.get('aria-hidden') == 'true' or 'hidden' in attrs:
+        return True
+    if (attrs.get('role') or '').lower() in BOILERPLATE_ROLES:
+        return True
+    hint = f"{attrs.get('class') or ''} {attrs.get('id') or ''}"
+    return UNLIKELY.search(hint) is not None and \
+        LIKELY.search(hint) is None
+
+
+class BlockCollector():
+
+    # Parser target (the lxml target interface; the standard library parser
+    # is adapted to it). Collects the text of block level elements together
+    # with the number of characters inside links.
+
+    def __init__(self, main=True):
+        self.main = main
+        self.stack = []
+        self.skip = 0
+        self.links = 0
+        self.headings = 0
+        self.pre = 0
+        self.in_main = 0
+        self.in_title = False
+        self.title = ''
+        self.buffer = []
+        self.link_chars = 0
+        self.blocks = []
+
+    def _flush(self):
+        if len(self.buffer) == 0:
+            return
+        text = ''.join(self.buffer)
+        self.buffer = []
+        link_chars = self.link_chars
+        self.link_chars = 0
+        if self.pre > 0:
+            text = text.strip('\n')
+        else:
+            text = ' '.join(text.split())
+        if text == '':
+            return
+        self.blocks.append((text, link_chars, self.headings > 0,
+                            self.in_main > 0))
+
+    def start(self, tag, attrs):
+        tag = tag.lower()
+        if tag == 'title' and self.title == '' and \
+                all(open_tag != 'svg' for open_tag, _ in self.stack):
+            self.in_title = True
+        if tag in VOID_TAGS:
+            if tag in BLOCK_TAGS and self.skip == 0:
+                self._flush()
+            return
+        skip = tag in SKIP_TAGS or self.main and (
+            tag in BOILERPLATE_TAGS or _unlikely(tag, attrs))
+        if tag in BLOCK_TAGS and self.skip == 0:
+            self._flush()
+        flags = 0
+        if skip:
+            self.skip += 1
+            flags |= 1
+        if tag == 'a':
+            self.links += 1
+            flags |= 2
+        if tag in HEADING_TAGS:
+            self.headings += 1
+            flags |= 4
+        if tag == 'pre':
+            self.pre += 1
+            flags |= 8
+        if tag in ('article', 'main') or attrs.get('role') == 'main':
+            self.in_main += 1
+            flags |= 16
+        self.stack.append((tag, flags))
+
+    def end(self, tag):
+        tag = tag.lower()
+        if tag == 'title':
+            self.in_title = False
+        if not any(open_tag == tag for open_tag, _ in self.stack):
+            return
+        # Elements left open inside this one are closed with it.
+        while len(self.stack) > 0:
+            open_tag, flags = self.stack[-1]
+            if open_tag in BLOCK_TAGS and self.skip == 0:
+                self._flush()
+            self.stack.pop()
+            if flags & 1:
+                self.skip -= 1
+            if flags & 2:
+                self.links -= 1
+            if flags & 4:
+                self.headings -= 1
+            if flags & 8:
+                self.pre -= 1
+            if flags & 16:
+                self.in_main -= 1
+            if open_tag == tag:
+                break
+
+    def data(self, text):
+        if self.in_title:
+            self.title += text
+            return
+        if self.skip > 0:
+            return
+        self.buffer.append(text)
+        if self.links > 0:
+            self.link_chars += len(text.strip())
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        self._flush()
+        return self
+
+
+class _StandardParser(html.parser.HTMLParser):
+
+    def __init__(self, target):
+        super().__init__(convert_charrefs=True)
+        self.target = target
+
+    def handle_starttag(self, tag, attrs):
+        self.target.start(tag, dict(attrs))
+
+    def handle_startendtag(self, tag, attrs):
+        self.target.start(tag, dict(attrs))
+        if tag not in VOID_TAGS:
+            self.target.end(tag)
+
+    def handle_endtag(self, tag):
+        self.target.end(tag)
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+
+def _lxml_available():
+    try:
+        import lxml.etree  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def parser_name(parser=HTML_PARSER):
+    if parser == "auto":
+        return "lxml" if _lxml_available() else "html.parser"
+    return parser
+
+
+def parse(text, main=True, parser=HTML_PARSER):
+    # Returns the BlockCollector for text.
+    if parser_name(parser) == "lxml":
+        from lxml import etree
+        lxml_parser = etree.HTMLParser(target=BlockCollector(main))
+        try:
+            lxml_parser.feed(text)
+            return lxml_parser.close()
+        except etree.LxmlError:
+            # Documents lxml rejects (e.g. empty ones) go through the
+            # standard library parser.
+            pass
+    collector = BlockCollector(main)
+    standard_parser = _StandardParser(collector)
+    standard_parser.feed(text)
+    standard_parser.close()
+    return collector.close()
+
+
+def select_blocks(blocks):
+    # Inside <article>/<main> every block that is not mostly links is kept.
+    # Elsewhere blocks are classified by length and link density; headings
+    # and short blocks are kept when content blocks are close.
+    main = [block for block in blocks if block[3]]
+    if sum(len(block[0]) for block in main) >= MAIN_MIN_CHARS:
+        return [text for text, link_chars, _, _ in main
+                if link_chars <= len(text) * BAD_LINK_DENSITY]
+
+    labels = []
+    for text, link_chars, heading, _ in blocks:
+        density = link_chars / len(text)
+        if density > BAD_LINK_DENSITY:
+            labels.append("bad")
+        elif len(text) >= GOOD_BLOCK_CHARS and \
+                density <= GOOD_LINK_DENSITY:
+            labels.append("good")
+        elif heading:
+            labels.append("heading")
+        else:
+            labels.append("short")
+    good = [i for i, label in enumerate(labels) if label == "good"]
+    if len(good) == 0:
+        return [block[0] for block, label in zip(blocks, labels)
+                if label != "bad"]
+
+    def near(i, after_only=False):
+        first = i + 1 if after_only else i - CONTEXT_BLOCKS
+        return any(first <= j <= i + CONTEXT_BLOCKS and j != i
+                   for j in good)
+
+    selected = []
+    for i, (block, label) in enumerate(zip(blocks, labels)):
+        if label == "good" or \
+                label == "heading" and near(i, after_only=True) or \
+                label == "short" and good[0] < i < good[-1] and near(i):
+            selected.append(block[0])
+    return selected
+
+
+def extract(content, content_type="text/html", extractor=HTML_EXTRACTOR,
+            parser=HTML_PARSER):
+    # content is bytes (decoded with the declared or detected charset) or
+    # str. Returns the page text, blocks separated by blank lines.
+    text = decode(content, content_type, html=True)
+    collector = parse(text, extractor == "main", parser)
+    if extractor == "main":
+        texts = select_blocks(collector.blocks)
+    else:
+        texts = [block[0] for block in collector.blocks]
+    title = ' '.join(collector.title.split())
+    if title != '' and (len(texts) == 0 or texts[0] != title):
+        texts.insert(0, title)
+    return '\n\n'.join(texts)
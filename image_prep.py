@@ -0,0 +1,148 @@
+import base64
+import io
+import os
+import source_cache
+import threading
+
+# Constants
+IMAGE_PREPROCESS = os.getenv("LLM_IMAGE_PREPROCESS", "1") != "0"
+# Longest side in pixels (0: the client's default, which matches how its
+# provider tiles images).
+IMAGE_MAX_DIMENSION = int(os.getenv("LLM_IMAGE_MAX_DIMENSION", "0"))
+# jpeg, webp or png. Images with transparency are kept as PNG unless the
+# format is webp.
+IMAGE_FORMAT = os.getenv("LLM_IMAGE_FORMAT", "jpeg")
+IMAGE_QUALITY = int(os.getenv("LLM_IMAGE_QUALITY", "85"))
+# Images decoded at the same time (each needs width * height * 4 bytes).
+IMAGE_WORKERS = int(os.getenv("LLM_IMAGE_WORKERS", "4"))
+FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+    "png": ("PNG", "image/png"),
+}
+
+_workers = threading.BoundedSemaphore(max(1, IMAGE_WORKERS))
+_stats = {"images": 0, "resized": 0, "reencoded": 0, "cached": 0,
+          "unchanged": 0, "bytes_in": 0, "bytes_out": 0}
+_stats_lock = threading.Lock()
+
+
+def available():
+    try:
+        import PIL.Image  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def fit(width, height, max_dimension, max_short_side=None):
+    # Size scaled down (never up) so that the longer side is at most
+    # max_dimension and the shorter side at most max_short_side.
+    scale = 1.0
+    if max_dimension and max(width, height) > max_dimension:
+        scale = max_dimension / max(width, height)
+    if max_short_side and min(width, height) * scale > max_short_side:
+        scale = max_short_side / min(width, height)
+    if scale >= 1.0:
+        return width, height
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def variant(max_dimension, max_short_side=None):
+    # Processed and unprocessed images must not share cache entries.
+    preprocess = IMAGE_PREPROCESS and available()
+    return f"image|max={max_dimension}|short={max_short_side}" \
+        + f"|format={IMAGE_FORMAT}|quality={IMAGE_QUALITY}" \
+        + f"|preprocess={preprocess}"
+
+
+def _has_alpha(image):
+    return image.mode in ("RGBA", "LA", "PA") or \
+        image.mode == "P" and "transparency" in image.info
+
+
+def process(data, mime_type, max_dimension, max_short_side=None,
+            reencode=False):
+    # Returns (data, mime type, resized): downscaled, orientation applied,
+    # re-encoded without metadata. The original is returned when Pillow
+    # cannot read it, for animations, and (unless reencode is set) when
+    # re-encoding does not make an unresized image smaller.
+    from PIL import Image, ImageOps
+    try:
+        with _workers, Image.open(io.BytesIO(data)) as image:
+            if getattr(image, "n_frames", 1) > 1:
+                return data, mime_type, False
+            image = ImageOps.exif_transpose(image)
+            alpha = _has_alpha(image)
+            # Palette images are resized with nearest neighbour and
+            # JPEG has no CMYK or 16 bit modes.
+            if image.mode not in ("RGB", "RGBA", "L"):
+                image = image.convert("RGBA" if alpha else "RGB")
+            size = fit(image.width, image.height,
+                       max_dimension, max_short_side)
+            resized = size != (image.width, image.height)
+            if resized:
+                image = image.resize(size, Image.LANCZOS)
+
+            name = IMAGE_FORMAT if IMAGE_FORMAT in FORMATS else "jpeg"
+            if alpha and name == "jpeg":
+                name = "png"
+            pil_format, output_type = FORMATS[name]
+            output = io.BytesIO()
+            if pil_format == "PNG":
+                image.save(output, pil_format, optimize=True)
+            else:
+                image.save(output, pil_format, quality=IMAGE_QUALITY)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return data, mime_type, False
+
+    encoded = output.getvalue()
+    if not resized and not reencode and len(encoded) >= len(data):
+        return data, mime_type, False
+    return encoded, output_type, resized
+
+
+def _count(**counts):
+    with _stats_lock:
+        for key, value in counts.items():
+            _stats[key] += value
+
+
+def prepare(data, mime_type, max_dimension, max_short_side=None,
+            digest=None):
+    # Returns (base64, mime type). Results are cached under the hash of the
+    # original bytes and the settings.
+    if IMAGE_MAX_DIMENSION > 0:
+        max_dimension = IMAGE_MAX_DIMENSION
+    if IMAGE_PREPROCESS is False or not available():
+        return base64.b64encode(data).decode('utf-8'), mime_type
+
+    cache = source_cache.get_cache()
+    if digest is None:
+        digest = source_cache.digest_bytes(data)
+    key = source_cache.content_key(digest,
+                                   variant(max_dimension, max_short_side))
+    entry = cache.get(key)
+    if entry is not None:
+        _count(images=1, cached=1, bytes_in=len(data),
+               bytes_out=entry["size"])
+        return entry["content"], entry["content_type"]
+
+    output, output_type, resized = process(data, mime_type,
+                                           max_dimension, max_short_side)
+    content = base64.b64encode(output).decode('utf-8')
+    _count(images=1, bytes_in=len(data), bytes_out=len(output),
+           resized=int(resized),
+           reencoded=int(output is not data),
+           unchanged=int(output is data))
+    cache.put(key, {"content": content,
+                    "content_type": output_type,
+                    "size": len(output)})
+    return content, output_type
+
+
+def stats():
+    with _stats_lock:
+        result = dict(_stats)
+    result["saved"] = result["bytes_in"] - result["bytes_out"]
+    return result
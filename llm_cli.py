@@ -1,39 +1,123 @@
 import argparse
 import base64
-import filetype
+import batch
+import contextlib
+import context_window
+import conversation_store
+import image_prep
 import json
+import log_writer
+import metrics
 import os
-import requests
+import pdf_extract
+import resilience
+import retrieval
+import source_cache
+import streaming_body
 import sys
+import threading
+import time
+import transport
+import urllib.parse
 
-from bs4 import BeautifulSoup
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from prompt_toolkit.history import FileHistory
-from prompt_toolkit.history import InMemoryHistory
-from prompt_toolkit.key_binding import KeyBindings
-from prompt_toolkit.shortcuts import prompt
-from pypdf import PdfReader
-from rich.console import Console
-from rich.markdown import Markdown
-from rich.rule import Rule
 
 # Constants
 INPUT_HISTORY = os.getenv("LLM_PROMPT_HISTORY", None)
 CHAT_LOG = os.getenv("LLM_CHAT_LOG", None)
 REQUEST_DEBUG_LOG = os.getenv("LLM_REQUEST_DEBUG_LOG", None)
 PDF_AS_IMAGE = False
+PDF_HYBRID = False
 PLAIN_TEXT = False
+STREAM = False
+STREAM_REFRESH_INTERVAL = 0.1
+SOURCE_WORKERS = int(os.getenv("LLM_SOURCE_WORKERS", "8"))
+SOURCE_WORKERS_PER_HOST = int(os.getenv("LLM_SOURCE_WORKERS_PER_HOST", "2"))
 
-# prompt_toolkit
-kb = KeyBindings()
+# html_extract, filetype, pypdf, prompt_toolkit and rich are imported where
+# they are used: piping a prompt through stdin needs none of them.
 
 # rich
-console = Console()
-md_separator = Rule()
+console = None
+
+
+def get_console():
+    global console
+    if console is None:
+        from rich.console import Console
+        console = Console()
+    return console
+
+
+def print_separator():
+    from rich.rule import Rule
+    get_console().print(Rule())
+
+
+# prompt_toolkit
+def key_bindings():
+    from prompt_toolkit.key_binding import KeyBindings
+    kb = KeyBindings()
+
+    @kb.add('c-delete')
+    def _(event):
+        raise KeyboardInterrupt
+
+    @kb.add('c-j')
+    def _(event):
+        event.current_buffer.insert_text('\n')
+
+    return kb
 
-# session
-session = requests.Session()
+# progress display shared by concurrent transfers (stderr keeps -s clean)
+progress = None
+progress_users = 0
+progress_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def progress_task(description, total):
+    global progress, progress_users
+    with progress_lock:
+        if progress is None:
+            from rich.console import Console
+            from rich.progress import BarColumn, DownloadColumn, Progress
+            from rich.progress import TextColumn, TransferSpeedColumn
+            progress = Progress(TextColumn("{task.description}"),
+                                BarColumn(),
+                                DownloadColumn(),
+                                TransferSpeedColumn(),
+                                console=Console(stderr=True),
+                                transient=True)
+            progress.start()
+        progress_users += 1
+        display = progress
+        task = display.add_task(description, total=total)
+    try:
+        yield lambda completed: display.update(task, completed=completed)
+    finally:
+        with progress_lock:
+            display.remove_task(task)
+            progress_users -= 1
+            if progress_users == 0:
+                display.stop()
+                progress = None
+
+
+# per-host fetch limits
+host_semaphores = {}
+host_semaphores_lock = threading.Lock()
+
+
+def host_semaphore(url):
+    host = urllib.parse.urlsplit(url).hostname
+    with host_semaphores_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = \
+                threading.BoundedSemaphore(SOURCE_WORKERS_PER_HOST)
+        return host_semaphores[host]
 
 
 class Chat():
@@ -44,27 +128,50 @@ class Chat():
 
     last_usage = None
 
+    # HTTP status of the last provider call (None: no response).
+    last_status = None
+
+    # Retries of each provider call (batch mode retries whole prompts).
+    retries = resilience.RETRIES
+
     stdout = False
 
     grounding = False
 
     conversation = deque()
 
-    def __init__(self, model):
-        self.MODEL = model
+    source_timings = None
 
-    @kb.add('c-delete')
-    def _(event):
-        raise KeyboardInterrupt
+    context_window = None
 
-    @kb.add('c-j')
-    def _(event):
-        event.current_buffer.insert_text('\n')
+    last_turn = None
+
+    # BM25 index of large text sources (None: sources are sent whole).
+    retrieval_index = None
+
+    # Images are downscaled to these sizes (pixels, None: no limit).
+    image_max_dimension = 2048
+
+    image_max_short_side = None
+
+    def __init__(self, model):
+        self.MODEL = model
 
     def clear(self):
         self.last_usage = None
         self.conversation.clear()
 
+    def clone(self):
+        # A client with the same options (set from the command line) and
+        # no conversation, for calls made concurrently with this one.
+        client = type(self)(self.MODEL)
+        client.grounding = self.grounding
+        client.stdout = self.stdout
+        client.retries = self.retries
+        client.image_max_dimension = self.image_max_dimension
+        client.image_max_short_side = self.image_max_short_side
+        return client
+
     def append_to_data(self, data, content, content_type=None, file_url=None):
         if data is None:
             data = []
@@ -93,7 +200,75 @@ class Chat():
                 sum += i['file_size']
         return sum
 
+    def _send_stream(self, data, conversation):
+        # Fallback for backends without a streaming implementation.
+        content, usage, grounding = self._send(data, conversation)
+        if content is not None:
+            yield content
+        return content, usage, grounding
+
+    def fit_context(self, data):
+        if self.context_window is None:
+            return
+        make_message = getattr(self, '_build_user_message', None)
+        self.context_window.fit(
+            self.conversation,
+            reserve=self.context_window.estimate_data(data),
+            make_message=None if make_message is None else
+            lambda text: make_message(self.append_to_data(None, text)),
+            summarize=self.summarize)
+
+    def summarize(self, text):
+        content, _, _ = self._send(self.append_to_data(None, text), None)
+        return content
+
+    def retrieve(self, data):
+        # Adds the indexed chunks that best match the text of data.
+        if self.retrieval_index is None or len(self.retrieval_index) == 0:
+            return data
+        query = ' '.join(item['content'] for item in data
+                         if 'file_url' not in item
+                         and isinstance(item.get('content'), str)
+                         and 'text' in (item.get('content_type') or 'text'))
+        with metrics.span("retrieve"):
+            excerpts = self.retrieval_index.search(query)
+        if len(excerpts) == 0:
+            return data
+        return self.append_to_data(None,
+                                   retrieval.format_excerpts(excerpts)) \
+            + data
+
     def send_and_print(self, data):
+        data = self.retrieve(data)
+        self.fit_context(data)
+
+        # Messages added by a failed turn are removed again, so that the
+        # history never ends with an unanswered request.
+        mark = len(self.conversation)
+        turn = metrics.begin_turn(self.MODEL)
+        response = None
+        try:
+            if STREAM is True:
+                response = self.stream_and_print(data)
+            else:
+                response = self.print_response(data)
+        finally:
+            metrics.end_turn(turn, self.last_usage)
+            self.last_turn = turn
+            if response is None:
+                self.rollback(mark)
+
+        if self.context_window is not None:
+            self.context_window.calibrate(self.conversation, self.last_usage)
+        return response is not None
+
+    def rollback(self, mark):
+        # Drops everything after the first mark messages; repeating it is
+        # harmless.
+        while len(self.conversation) > mark:
+            self.conversation.pop()
+
+    def print_response(self, data):
         response, self.last_usage, self.grounding = \
             self._send(data, self.conversation)
         if response is None:
@@ -101,14 +276,71 @@ class Chat():
             return
 
         global PLAIN_TEXT
+        with metrics.span("render"):
+            if PLAIN_TEXT is True:
+                print(f"({self.MODEL})")
+                print(response)
+            else:
+                from rich.markdown import Markdown
+                console = get_console()
+                markdown = Markdown(f"**({self.MODEL}):**")
+                console.print(markdown)
+                markdown = Markdown(response)
+                console.print(markdown)
+        return response
+
+    def stream_and_print(self, data):
+        deltas = self._send_stream(data, self.conversation)
+
         if PLAIN_TEXT is True:
             print(f"({self.MODEL})")
-            print(response)
+            result = self._consume_stream(
+                deltas, lambda text, delta: print(delta, end='', flush=True))
+            print()
         else:
-            markdown = Markdown(f"**({self.MODEL}):**")
-            console.print(markdown)
-            markdown = Markdown(response)
-            console.print(markdown)
+            from rich.live import Live
+            from rich.markdown import Markdown
+            console = get_console()
+            console.print(Markdown(f"**({self.MODEL}):**"))
+            with Live(Markdown(''),
+                      console=console,
+                      auto_refresh=False,
+                      vertical_overflow='visible') as live:
+                last_refresh = 0.0
+
+                def render(text, delta):
+                    nonlocal last_refresh
+                    now = time.monotonic()
+                    if now - last_refresh >= STREAM_REFRESH_INTERVAL:
+                        live.update(Markdown(text), refresh=True)
+                        last_refresh = now
+
+                result = self._consume_stream(deltas, render)
+                if result[0] is not None:
+                    live.update(Markdown(result[0]), refresh=True)
+
+        response, self.last_usage, self.grounding = result
+        if response is None:
+            print("Oops! Something went wrong.")
+        return response
+
+    def _consume_stream(self, deltas, on_delta):
+        text = ''
+        rendering = 0.0
+        try:
+            while True:
+                try:
+                    delta = next(deltas)
+                except StopIteration as e:
+                    if e.value is None:
+                        return None, None, None
+                    return e.value
+                text += delta
+                start = time.perf_counter()
+                on_delta(text, delta)
+                rendering += time.perf_counter() - start
+        finally:
+            metrics.record("render", rendering)
 
     def talk(self, data, sources=None):
 
@@ -117,6 +349,11 @@ class Chat():
 
         data_size = self.calc_data_size(data)
 
+        from prompt_toolkit.history import FileHistory
+        from prompt_toolkit.history import InMemoryHistory
+        from prompt_toolkit.shortcuts import prompt
+        kb = key_bindings()
+
         if INPUT_HISTORY is None:
             prompt_history = InMemoryHistory()
         else:
@@ -125,7 +362,7 @@ class Chat():
         while True:
 
             try:
-                console.print(md_separator)
+                print_separator()
                 user_input = prompt('> ',
                                     history=prompt_history,
                                     key_bindings=kb,
@@ -133,7 +370,7 @@ class Chat():
                                     enable_system_prompt=True,
                                     enable_open_in_editor=True)
                 if user_input != '':
-                    console.print(md_separator)
+                    print_separator()
                 user_input = user_input.strip()
             except UnicodeDecodeError as e:
                 print(e)
@@ -150,19 +387,26 @@ class Chat():
                 continue
             if user_input in ['.h', '.hist', '.history']:
                 print(json.dumps(list(self.conversation),
-                                 indent=2, ensure_ascii=False))
+                                 indent=2, ensure_ascii=False,
+                                 default=streaming_body.describe))
                 continue
             if user_input in ['.i', '.info']:
-                print(f"model: {self.MODEL}")
-                print(f"sources: {sources}")
-                print(f"passed data size: {data_size}")
-                print("last usage: ", end="")
-                print(json.dumps(self.last_usage,
-                                 indent=2, ensure_ascii=False))
-                if self.grounding is not None:
-                    print("grounding: ", end="")
-                    print(json.dumps(self.grounding,
-                                     indent=2, ensure_ascii=False))
+                self.print_info(sources, data_size)
+                continue
+            if user_input in ['.o', '.older']:
+                if self.llm_history_file is None:
+                    print("No history file.")
+                    continue
+                count = self.conversation.load_older()
+                print(f"Loaded {count} older messages.")
+                continue
+            if user_input == '.compact':
+                if self.llm_history_file is None:
+                    print("No history file.")
+                    continue
+                if self.conversation.compact() is True:
+                    print("History compacted to "
+                          + f"{self.conversation.log.records} records.")
                 continue
             if user_input in ['.p', '.plain']:
                 if len(self.conversation) == 0:
@@ -188,34 +432,178 @@ class Chat():
             if user_input == '':
                 continue
             else:
-                data = self.append_to_data(data, user_input)
-                self.send_and_print(data)
-            data = []
+                # After a failed turn the sources are sent again with the
+                # next question.
+                if self.send_and_print(
+                        self.append_to_data(list(data), user_input)) is True:
+                    data = []
 
         if self.llm_history_file is not None:
-            self.deque_to_json(self.conversation, self.llm_history_file)
+            self.conversation.close()
+
+    def print_info(self, sources, data_size):
+        print(f"model: {self.MODEL}")
+        print(f"sources: {sources}")
+        print(f"passed data size: {data_size}")
+        print("last usage: ", end="")
+        print(json.dumps(self.last_usage,
+                         indent=2, ensure_ascii=False))
+        if self.grounding is not None:
+            print("grounding: ", end="")
+            print(json.dumps(self.grounding,
+                             indent=2, ensure_ascii=False))
+        if self.context_window is not None:
+            print("context window: ", end="")
+            print(json.dumps(self.context_window.stats(self.conversation),
+                             indent=2, ensure_ascii=False))
+        if self.retrieval_index is not None:
+            print("retrieval: ", end="")
+            print(json.dumps(self.retrieval_index.stats(),
+                             indent=2, ensure_ascii=False))
+        if image_prep.stats()["images"] > 0:
+            print("images: ", end="")
+            print(json.dumps(image_prep.stats(),
+                             indent=2, ensure_ascii=False))
+        if self.source_timings is not None:
+            print("source timings:")
+            for source, elapsed, status in self.source_timings:
+                print(f"  {elapsed:8.3f}s {status:8} {source}")
+        print("source cache: ", end="")
+        print(json.dumps(source_cache.get_cache().stats(),
+                         indent=2, ensure_ascii=False))
+        print("connections: ", end="")
+        print(json.dumps(transport.stats(),
+                         indent=2, ensure_ascii=False))
+        for breaker in resilience.breakers():
+            print(f"circuit {breaker.name}: {breaker.state}, "
+                  + f"{breaker.failures} failures, {breaker.trips} trips")
+        if self.last_turn is not None:
+            print("last turn: ", end="")
+            print(json.dumps(self.last_turn.to_dict(),
+                             indent=2, ensure_ascii=False))
+        print("metrics: ", end="")
+        print(json.dumps(metrics.summary(), indent=2, ensure_ascii=False))
+
+    def extraction_variant(self, content_type, pages=None):
+        # Anything that changes extracted output must be part of the key.
+        variant = f"{content_type}|pdf_as_image={PDF_AS_IMAGE}|pages={pages}"
+        if 'pdf' in content_type and PDF_HYBRID is True:
+            variant += "|" + pdf_extract.hybrid_variant() \
+                + "|" + image_prep.variant(self.pdf_page_dimension(),
+                                           self.image_max_short_side)
+        elif 'text/html' in content_type:
+            import html_extract
+            variant += f"|html={html_extract.HTML_EXTRACTOR}"
+        elif 'image/' in content_type:
+            variant += "|" + image_prep.variant(self.image_max_dimension,
+                                                self.image_max_short_side)
+        return variant
+
+    def cached_file_content(self, path, variant, producer):
+        cache = source_cache.get_cache()
+        if cache.enabled is False:
+            with metrics.span("extract"):
+                return producer(path)
+        key = source_cache.content_key(cache.file_digest(path), variant)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry["content"]
+        with metrics.span("extract"):
+            content = producer(path)
+        if content is not None:
+            cache.put(key, {"content": content})
+        return content
 
     def encode_data_from_file(self, file_path):
+        # Large files are encoded while the request body is being sent.
+        if os.path.getsize(file_path) >= \
+                streaming_body.INLINE_STREAM_MIN_BYTES:
+            return streaming_body.Base64File(file_path)
+        return self.cached_file_content(file_path,
+                                        "base64",
+                                        self._encode_data_from_file)
+
+    def prepare_image(self, data, mime_type, digest=None):
+        # Returns (base64, mime type) of the downscaled, re-encoded image.
+        with metrics.span("image"):
+            return image_prep.prepare(data, mime_type,
+                                      self.image_max_dimension,
+                                      self.image_max_short_side,
+                                      digest)
+
+    def encode_image_from_file(self, file_path, mime_type):
+        if image_prep.IMAGE_PREPROCESS is False or \
+                not image_prep.available():
+            return self.encode_data_from_file(file_path), mime_type
+        cache = source_cache.get_cache()
+        digest = cache.file_digest(file_path) if cache.enabled else None
+        with open(file_path, "rb") as f:
+            return self.prepare_image(f.read(), mime_type, digest)
+
+    def _encode_data_from_file(self, file_path):
         with open(file_path, "rb") as data:
             return base64.b64encode(data.read()).decode('utf-8')
 
-    def read_pdf_from_file(self, file_name):
-        reader = PdfReader(file_name)
-        text = ''
-        for page in reader.pages:
-            text += '\n' + page.extract_text()
+    def encode_pdf_from_file(self, file_path, pages=None):
+        if pages is None:
+            return self.encode_data_from_file(file_path)
+        return self.cached_file_content(
+                file_path,
+                f"base64|pages={pages}",
+                lambda path: base64.b64encode(
+                    pdf_extract.slice_pdf(path, pages)).decode('utf-8'))
+
+    def read_pdf_from_file(self, file_name, pages=None):
+        return self.cached_file_content(
+                file_name,
+                self.extraction_variant("pdf", pages),
+                lambda path: self._read_pdf_from_file(path, pages))
+
+    def _read_pdf_from_file(self, file_name, pages=None):
+        text = pdf_extract.extract_text(file_name, pages)
         if text != '':
             return text
         else:
             print("Empty PDF.")
             return None
 
-    def read_pdf_from_byte_stream(self, byte_stream):
-        reader = PdfReader(byte_stream)
+    def read_pdf_from_byte_stream(self, byte_stream, pages=None):
+        return pdf_extract.extract_text(byte_stream.read(), pages)
+
+    def pdf_page_dimension(self):
+        if image_prep.IMAGE_MAX_DIMENSION > 0:
+            return image_prep.IMAGE_MAX_DIMENSION
+        return self.image_max_dimension
+
+    def read_pdf_pages(self, source, pages=None):
+        # Hybrid mode: a text item for each run of text pages and an image
+        # item after each scanned or figure page.
+        items = []
         text = ''
-        for page in reader.pages:
-            text += '\n' + page.extract_text()
-        return text
+        for number, kind, page_text, data, mime_type in \
+                pdf_extract.iter_hybrid_pages(source, pages,
+                                              self.pdf_page_dimension(),
+                                              self.image_max_short_side):
+            text += f"\n[page {number}]\n{page_text}"
+            if data is not None:
+                items.append({"content": text, "content_type": "text/plain"})
+                items.append({
+                    "content": base64.b64encode(data).decode('utf-8'),
+                    "content_type": mime_type
+                })
+                text = ''
+        if text.strip() != '':
+            items.append({"content": text, "content_type": "text/plain"})
+        if len(items) == 0:
+            print("Empty PDF.")
+            return None
+        return items
+
+    def read_pdf_pages_from_file(self, file_name, pages=None):
+        return self.cached_file_content(
+                file_name,
+                self.extraction_variant("pdf", pages),
+                lambda path: self.read_pdf_pages(path, pages))
 
     def read_text_from_file(self, file_name):
         text = ''
@@ -223,13 +611,32 @@ class Chat():
             text = file.read()
         return text
 
-    def fetch_url_content(self, url):
+    def fetch_url_content(self, url, pages=None):
+        cache = source_cache.get_cache()
+        url_key = source_cache.url_key(url)
+        entry = cache.get(url_key)
+
         headers = {}
+        if entry is not None:
+            if entry.get('etag') is not None:
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified') is not None:
+                headers['If-Modified-Since'] = entry['last_modified']
         try:
-            response = session.get(url,
-                                   headers=headers,
-                                   timeout=(10.0, 10.0))
-            response.raise_for_status()
+            with host_semaphore(url), metrics.span("fetch"):
+                response = transport.get(url,
+                                         headers=headers,
+                                         timeout=(10.0, 10.0))
+                if response.status_code == 304 and entry is not None:
+                    cached = cache.get(source_cache.content_key(
+                        entry['digest'],
+                        self.extraction_variant(entry['content_type'],
+                                                pages)))
+                    if cached is not None:
+                        cache.count_revalidation()
+                        return cached['content'], cached['content_type']
+                    response = transport.get(url, timeout=(10.0, 10.0))
+                response.raise_for_status()
         except Exception as e:
             print(e)
             return None, None
@@ -238,76 +645,186 @@ class Chat():
 
         content = response.content
 
+        if cache.enabled is False:
+            with metrics.span("extract"):
+                return self.extract_content(content, content_type, pages)
+
+        digest = source_cache.digest_bytes(content)
+        key = source_cache.content_key(
+            digest, self.extraction_variant(content_type, pages))
+        cached = cache.get(key)
+        if cached is not None:
+            result = cached['content'], cached['content_type']
+        else:
+            with metrics.span("extract"):
+                result = self.extract_content(content, content_type, pages)
+            if result[0] is not None:
+                cache.put(key, {
+                    "content": result[0],
+                    "content_type": result[1]
+                })
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if result[0] is not None and \
+                (etag is not None or last_modified is not None):
+            cache.put(url_key, {
+                "etag": etag,
+                "last_modified": last_modified,
+                "digest": digest,
+                "content_type": content_type
+            })
+        return result
+
+    def extract_content(self, content, content_type, pages=None):
+        import html_extract
         if 'application/pdf' in content_type:
-            if PDF_AS_IMAGE is True:
-                return base64.b64encode(
-                    BytesIO(content).read()).decode('utf-8'), content_type
+            if PDF_HYBRID is True:
+                return self.read_pdf_pages(content, pages), 'multipart/mixed'
+            elif PDF_AS_IMAGE is True:
+                if pages is not None:
+                    content = pdf_extract.slice_pdf(content, pages)
+                return base64.b64encode(content).decode('utf-8'), \
+                        content_type
             else:
-                return self.read_pdf_from_byte_stream(BytesIO(content)), \
+                return self.read_pdf_from_byte_stream(BytesIO(content),
+                                                      pages), \
                         'text/plain'
         elif 'text/html' in content_type:
-            soup = BeautifulSoup(content, 'html.parser')
-            return soup.get_text(' ', strip=True), content_type
+            return html_extract.extract(content, content_type), content_type
         elif 'text/plain' in content_type:
-            return content.decode('utf-8'), content_type
+            return html_extract.decode(content, content_type), content_type
         elif 'image/' in content_type:
-            return base64.b64encode(
-                BytesIO(content).read()).decode('utf-8'), content_type
+            return self.prepare_image(content,
+                                      content_type.split(';')[0].strip())
         else:
             print(f"Unavailable content type: {content_type}")
             return None, None
 
-    def process_sources(self, sources):
+    def is_file_source(self, source):
+        if os.path.exists(source):
+            return True
+        path, pages = pdf_extract.split_page_selector(source)
+        return pages is not None and os.path.exists(path)
+
+    def load_source(self, source):
+        file_url = None
+        file_size = 0
+        content = None
+        content_type = None
+        pages = None
+        if not os.path.exists(source):
+            path, pages = pdf_extract.split_page_selector(source)
+            if pages is not None and (source.startswith("http") or
+                                      os.path.exists(path)):
+                source = path
+            else:
+                pages = None
+        if source.startswith("http"):
+            content, content_type = self.fetch_url_content(source, pages)
+        elif os.path.exists(source):
+            import filetype
+            kind = filetype.guess(source)
+            if kind and kind.extension == 'pdf':
+                if PDF_HYBRID is True:
+                    content = self.read_pdf_pages_from_file(source, pages)
+                    content_type = "multipart/mixed"
+                elif PDF_AS_IMAGE is True:
+                    content = self.encode_pdf_from_file(source, pages)
+                    content_type = "application/pdf"
+                else:
+                    content = self.read_pdf_from_file(source, pages)
+                    content_type = "text/plain"
+            elif kind and 'image/' in kind.mime:
+                content, content_type = \
+                    self.encode_image_from_file(source, kind.mime)
+            elif kind and 'audio/' in kind.mime:
+                content = self.encode_data_from_file(source)
+                content_type = kind.mime
+            elif kind and ('video/' in kind.mime):
+                file_url, file_size = self._upload_file(source)
+                if file_url is None:
+                    print(f"Error: failed to upload {source}")
+                    return None
+                content_type = kind.mime
+            else:
+                content = self.read_text_from_file(source)
+        else:
+            content = source
+            content_type = "text/plain"
+
+        if file_url is not None:
+            return {
+                "content_type": content_type,
+                "file_url": file_url,
+                "file_size": file_size,
+            }
+        elif isinstance(content, list):
+            # Hybrid PDFs are loaded as several items.
+            return content
+        elif content is not None:
+            return {
+                "content": content,
+                "content_type": content_type
+            }
+        return None
+
+    def _timed_load_source(self, source):
+        start = time.perf_counter()
+        try:
+            item = self.load_source(source)
+        except Exception as e:
+            print(f"Error: failed to load {source}: {e}")
+            item = None
+        elapsed = time.perf_counter() - start
+        return item, elapsed
+
+    def load_sources(self, sources, preloaded=None):
+        # URLs and files are loaded concurrently; results keep source order.
+        # Sources in preloaded (source -> item) are not loaded again.
+        if preloaded is None:
+            preloaded = {}
         data = []
+        documents = []
+        timings = []
         direct_prompt = True
-        for source in sources:
-            file_url = None
-            file_size = 0
-            if source.startswith("http"):
-                content, content_type = self.fetch_url_content(source)
-                direct_prompt = False
-            elif os.path.exists(source):
-                content_type = None
-                kind = filetype.guess(source)
-                if kind and kind.extension == 'pdf':
-                    if PDF_AS_IMAGE is True:
-                        content = self.encode_data_from_file(source)
-                        content_type = "application/pdf"
-                    else:
-                        content = self.read_pdf_from_file(source)
-                        content_type = "text/plain"
-                elif kind and ('image/' in kind.mime or
-                               'audio/' in kind.mime):
-                    content = self.encode_data_from_file(source)
-                    content_type = kind.mime
-                elif kind and ('video/' in kind.mime):
-                    file_url, file_size = self._upload_file(source)
-                    if file_url is None:
-                        print("Error: failed to upload {source}")
-                        continue
-                    content_type = kind.mime
+        with ThreadPoolExecutor(max_workers=SOURCE_WORKERS) as executor:
+            futures = [None if source in preloaded else
+                       executor.submit(self._timed_load_source, source)
+                       for source in sources]
+            for source, future in zip(sources, futures):
+                if future is None:
+                    item, elapsed = preloaded[source], 0.0
                 else:
-                    content = self.read_text_from_file(source)
-                direct_prompt = False
-            else:
-                content = source
-                content_type = "text/plain"
-
-            if file_url is not None:
-                data.append({
-                    "content_type": content_type,
-                    "file_url": file_url,
-                    "file_size": file_size,
-                })
-            elif content is not None:
-                data.append({
-                    "content": content,
-                    "content_type": content_type
-                })
+                    item, elapsed = future.result()
+                items = item if isinstance(item, list) else [item]
+                if source.startswith("http") or \
+                        self.is_file_source(source):
+                    direct_prompt = False
+                    timings.append((source,
+                                    elapsed,
+                                    "ok" if item is not None else "failed"))
+                    if item is not None and \
+                            self.retrieval_index is not None:
+                        documents.extend((source, part['content'])
+                                         for part in items
+                                         if retrieval.indexable(part))
+                        items = [part for part in items
+                                 if not retrieval.indexable(part)]
+                if item is not None:
+                    data.extend(items)
+        if len(documents) > 0:
+            with metrics.span("index"):
+                self.retrieval_index.add_documents(documents)
+        self.source_timings = timings
+        return data, direct_prompt
+
+    def process_sources(self, sources, preloaded=None):
+        data, direct_prompt = self.load_sources(sources, preloaded)
 
         if direct_prompt is True:
             if self.stdout is False:
-                console.print(md_separator)
+                print_separator()
             self.send_and_print(data)
             if self.stdout is False:
                 self.talk(None, sources=sources)
@@ -322,59 +839,53 @@ class Chat():
         if CHAT_LOG is None:
             return
 
-        with open(CHAT_LOG, 'a', encoding='utf-8') as file:
-            if "role" in message and "parts" in message:
-                file.write("----------\n")
-                role = message["role"]
-                text = ""
-                for part in message["parts"]:
-                    if "text" in part:
-                        text = part["text"]
-                file.write(f"({role}):\n")
-                file.write(text)
-                file.write("\n")
-
-    def write_request_debug_log(self, headers, data, response):
+        if "role" in message and "parts" in message:
+            role = message["role"]
+            text = ""
+            for part in message["parts"]:
+                if "text" in part:
+                    text = part["text"]
+            log_writer.get_writer(CHAT_LOG).write(
+                f"----------\n({role}):\n{text}\n")
+
+    def write_request_debug_log(self, headers, data, response, chunks=None):
         if REQUEST_DEBUG_LOG is None:
             return
 
-        with open(REQUEST_DEBUG_LOG, 'w', encoding='utf-8') as file:
-            file.write('--- (request) ---\n')
-            file.write(
-                "headers: "
-                + f"{json.dumps(headers, ensure_ascii=False, indent=2)}\n")
-            file.write(
-                f"data: {json.dumps(data, ensure_ascii=False, indent=2)}\n")
-            file.write('\n')
-            file.write("--- (response) ---\n")
-            file.write(f"status: {response.status_code}\n")
-            file.write(
-                "headers: "
-                + f"{json.dumps(dict(response.headers), indent=2)}\n")
-            json_str = response.json()
-            file.write(
-                "content: "
-                + f"{json.dumps(json_str, ensure_ascii=False, indent=2)}\n")
-            file.write('\n')
-
-    def deque_to_json(self, deque_obj, filepath):
-        try:
-            with open(filepath, 'w+', encoding='utf-8') as f:
-                json.dump(list(deque_obj), f, indent=2, ensure_ascii=False)
-        except (IOError, TypeError) as e:
-            print(f"Error: Failed to save json. {e}")
+        # Only cheap references are taken here; the record is formatted
+        # on the log writer thread.
+        status = response.status_code
+        response_headers = dict(response.headers)
+        body = response.text if chunks is None else None
 
-    def json_to_deque(self, filepath):
-        if os.path.isfile(filepath) is False:
-            return None
+        def format_record():
+            if chunks is None:
+                try:
+                    content = json.loads(body)
+                except ValueError:
+                    content = body
+            else:
+                content = chunks
+            return (
+                '--- (request) ---\n'
+                + "headers: "
+                + f"{json.dumps(headers, ensure_ascii=False, indent=2)}\n"
+                + "data: "
+                + json.dumps(log_writer.redact(data),
+                             ensure_ascii=False, indent=2,
+                             default=streaming_body.describe)
+                + "\n"
+                + '\n'
+                + "--- (response) ---\n"
+                + f"status: {status}\n"
+                + "headers: "
+                + f"{json.dumps(response_headers, indent=2)}\n"
+                + "content: "
+                + json.dumps(log_writer.redact(content),
+                             ensure_ascii=False, indent=2)
+                + "\n\n")
 
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return deque(data)
-        except (FileNotFoundError, json.JSONDecodeError, TypeError) as e:
-            print(f"Error: Failed to load json. {e}")
-            return None
+        log_writer.get_writer(REQUEST_DEBUG_LOG).write(format_record)
 
     # CLI Interface
     def main(self):
@@ -396,10 +907,19 @@ class Chat():
         parser.add_argument('--hist',
                             '--history-file',
                             help="Chat history file.")
+        parser.add_argument('--history-tail',
+                            type=int,
+                            default=conversation_store.HISTORY_TAIL,
+                            help="Load only the newest messages of the "
+                                 + "history file (0: all).")
         parser.add_argument('-i',
                             '--pdf-as-image',
                             action='store_true',
                             help="Read pdf as image.")
+        parser.add_argument('--pdf-hybrid',
+                            action='store_true',
+                            help="Send PDF pages as text, and scanned or "
+                                 + "figure pages as images.")
         parser.add_argument('-p',
                             '--plain_text',
                             action='store_true',
@@ -408,6 +928,59 @@ class Chat():
                             '--stdout',
                             action='store_true',
                             help="Redirect the output to STDOUT.")
+        parser.add_argument('--no-cache',
+                            action='store_true',
+                            help="Bypass the source cache.")
+        parser.add_argument('--context-budget',
+                            type=int,
+                            default=context_window.CONTEXT_BUDGET,
+                            help="Token budget for the conversation "
+                                 + "sent with each request (0: unlimited).")
+        parser.add_argument('--context-policy',
+                            choices=context_window.POLICIES,
+                            default=context_window.CONTEXT_POLICY,
+                            help="How to shrink the conversation when "
+                                 + "the budget is exceeded.")
+        parser.add_argument('-r',
+                            '--retrieve',
+                            action='store_true',
+                            help="Index large text sources and send only "
+                                 + "the chunks relevant to each question.")
+        parser.add_argument('--top-k',
+                            type=int,
+                            default=retrieval.RETRIEVAL_TOP_K,
+                            help="Chunks retrieved per question.")
+        parser.add_argument('--retrieval-budget',
+                            type=int,
+                            default=retrieval.RETRIEVAL_BUDGET,
+                            help="Estimated tokens of retrieved chunks "
+                                 + "per question.")
+        parser.add_argument('--stream',
+                            action='store_true',
+                            help="Stream the response as it is generated.")
+        parser.add_argument('--batch',
+                            nargs='?',
+                            const='-',
+                            metavar='FILE',
+                            help="Answer each line of a JSONL file "
+                                 + "(default: stdin) as a separate prompt.")
+        parser.add_argument('--batch-output',
+                            metavar='FILE',
+                            help="Append batch results to FILE and skip "
+                                 + "prompts already answered there.")
+        parser.add_argument('--concurrency',
+                            type=int,
+                            default=batch.BATCH_CONCURRENCY,
+                            help="Concurrent requests in batch mode.")
+        parser.add_argument('--rate',
+                            type=float,
+                            default=batch.BATCH_RATE,
+                            help="Requests per second in batch mode "
+                                 + "(0: unlimited).")
+        parser.add_argument('--as-completed',
+                            action='store_true',
+                            help="Write batch results as they complete "
+                                 + "instead of in input order.")
         args = parser.parse_args()
 
         self.grounding = args.grounding
@@ -416,17 +989,45 @@ class Chat():
             global PDF_AS_IMAGE
             PDF_AS_IMAGE = True
 
+        if args.pdf_hybrid is True:
+            global PDF_HYBRID
+            PDF_HYBRID = True
+
         if args.plain_text is True:
             global PLAIN_TEXT
             PLAIN_TEXT = True
 
+        if args.context_budget > 0:
+            self.context_window = context_window.ContextWindow(
+                args.context_budget, args.context_policy)
+
+        if args.no_cache is True:
+            source_cache.get_cache().enabled = False
+
+        if args.retrieve is True:
+            self.retrieval_index = retrieval.RetrievalIndex(
+                args.top_k, args.retrieval_budget)
+
+        if args.stream is True:
+            global STREAM
+            STREAM = True
+
         self.stdout = args.stdout
 
+        if args.batch is not None:
+            batch.run_batch(self.clone,
+                            type(self).__name__.lower(),
+                            args.batch,
+                            args.batch_output,
+                            concurrency=args.concurrency,
+                            rate=args.rate,
+                            ordered=not args.as_completed)
+            return
+
         if args.hist is not None:
             self.llm_history_file = args.hist
-            hist = self.json_to_deque(self.llm_history_file)
-            if hist is not None:
-                self.conversation = hist
+            self.conversation = conversation_store.open_conversation(
+                self.llm_history_file, args.history_tail)
 
         if sys.stdin.isatty():
             if args.sources is None or len(args.sources) == 0:
@@ -434,6 +1035,10 @@ class Chat():
             else:
                 self.process_sources(args.sources)
         else:
+            # A single request: HTTP/2 would only add httpx's import and
+            # setup time.
+            if os.getenv("LLM_HTTP2") is None:
+                transport.HTTP2 = False
             stdin_input = sys.stdin.read()
             message = f"{stdin_input}"
             data = self.append_to_data(None, message)
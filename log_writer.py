@@ -0,0 +1,148 @@
+import atexit
+import hashlib
+import os
+import queue
+import re
+import threading
+
+# Constants
+LOG_QUEUE_SIZE = int(os.getenv("LLM_LOG_QUEUE_SIZE", "1000"))
+# Rotate a log file once it reaches this size (0: never).
+LOG_MAX_BYTES = int(os.getenv("LLM_LOG_MAX_BYTES", "0"))
+LOG_BACKUPS = int(os.getenv("LLM_LOG_BACKUPS", "3"))
+# "placeholder" replaces base64 payloads with their hash and length,
+# "full" writes them out.
+LOG_BINARY = os.getenv("LLM_LOG_BINARY", "placeholder")
+LOG_BINARY_MIN_CHARS = int(os.getenv("LLM_LOG_BINARY_MIN_CHARS", "1024"))
+# Records written per flush at most.
+BATCH_SIZE = 64
+
+BASE64_PATTERN = re.compile(r'(data:[\w.+-]+/[\w.+-]+;base64,)?'
+                            + r'[A-Za-z0-9+/_-]+={0,2}')
+
+_writers = {}
+_writers_lock = threading.Lock()
+_STOP = object()
+
+
+def placeholder(value):
+    digest = hashlib.sha256(value.encode('ascii')).hexdigest()
+    return f"<base64 sha256={digest} chars={len(value)}>"
+
+
+def redact(obj):
+    # Copy of obj with large base64 strings replaced by placeholders.
+    if LOG_BINARY == "full":
+        return obj
+    if isinstance(obj, dict):
+        return {key: redact(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [redact(value) for value in obj]
+    if isinstance(obj, str) and len(obj) >= LOG_BINARY_MIN_CHARS and \
+            BASE64_PATTERN.fullmatch(obj) is not None:
+        return placeholder(obj)
+    return obj
+
+
+class LogWriter():
+
+    # Appends text to a file from a background thread. Records are either
+    # strings or callables returning a string, so that formatting also
+    # happens off the calling thread. When the queue is full, records are
+    # dropped and counted rather than blocking the caller.
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS,
+                 queue_size=LOG_QUEUE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.dropped = 0
+        self.written = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._file = None
+        self._thread = threading.Thread(target=self._run,
+                                        name=f"log-writer:{path}",
+                                        daemon=True)
+        self._thread.start()
+
+    def write(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=5):
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        return self._file
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                source = f"{self.path}.{i}"
+                if os.path.exists(source):
+                    os.replace(source, f"{self.path}.{i + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.unlink(self.path)
+
+    def _write_batch(self, records):
+        f = self._open()
+        for record in records:
+            text = record() if callable(record) else record
+            if self.max_bytes > 0 and f.tell() > 0 and \
+                    f.tell() + len(text) > self.max_bytes:
+                self._rotate()
+                f = self._open()
+            f.write(text)
+            self.written += 1
+        if self.dropped > 0:
+            f.write(f"[{self.dropped} log records dropped]\n")
+            self.dropped = 0
+        f.flush()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            records = [self._queue.get()]
+            while len(records) < BATCH_SIZE:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in records:
+                stop = True
+                records = [r for r in records if r is not _STOP]
+            try:
+                self._write_batch(records)
+            except Exception as e:
+                print(f"Error: Failed to write log {self.path}. {e}")
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def get_writer(path):
+    with _writers_lock:
+        writer = _writers.get(path)
+        if writer is None:
+            writer = LogWriter(path)
+            _writers[path] = writer
+        return writer
+
+
+def close_all():
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.close()
+
+
+atexit.register(close_all)
@@ -0,0 +1,161 @@
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Constants
+METRICS_LOG = os.getenv("LLM_METRICS_LOG", None)
+METRICS_PROM = os.getenv("LLM_METRICS_PROM", None)
+
+_local = threading.local()
+_lock = threading.Lock()
+_spans = {}
+_totals = {
+    "turns": 0,
+    "bytes_sent": 0,
+    "bytes_received": 0,
+    "prompt_tokens": 0,
+    "completion_tokens": 0,
+}
+
+
+class Turn():
+
+    def __init__(self, model):
+        self.model = model
+        self.started = time.time()
+        self.spans = []
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.usage = None
+
+    def to_dict(self):
+        spans = {}
+        for name, seconds in self.spans:
+            spans[name] = round(spans.get(name, 0.0) + seconds, 6)
+        return {
+            "time": self.started,
+            "model": self.model,
+            "spans": spans,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "usage": self.usage,
+        }
+
+
+def token_counts(usage):
+    # (prompt, completion) from Gemini usageMetadata or OpenAI usage.
+    if usage is None:
+        return 0, 0
+    if 'promptTokenCount' in usage or 'candidatesTokenCount' in usage:
+        return usage.get('promptTokenCount', 0), \
+            usage.get('candidatesTokenCount', 0)
+    return usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0)
+
+
+def current_turn():
+    return getattr(_local, "turn", None)
+
+
+def begin_turn(model):
+    turn = Turn(model)
+    _local.turn = turn
+    return turn
+
+
+def end_turn(turn, usage):
+    _local.turn = None
+    turn.usage = usage
+    prompt, completion = token_counts(usage)
+    with _lock:
+        _totals["turns"] += 1
+        _totals["prompt_tokens"] += prompt
+        _totals["completion_tokens"] += completion
+    if METRICS_LOG is not None:
+        try:
+            with open(METRICS_LOG, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(turn.to_dict(), ensure_ascii=False))
+                f.write('\n')
+        except OSError as e:
+            print(f"Error: Failed to write metrics. {e}")
+
+
+def record(name, seconds):
+    turn = current_turn()
+    if turn is not None:
+        turn.spans.append((name, seconds))
+    with _lock:
+        stats = _spans.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0})
+        stats["count"] += 1
+        stats["sum"] += seconds
+        stats["max"] = max(stats["max"], seconds)
+
+
+@contextlib.contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def add_bytes(sent=0, received=0):
+    turn = current_turn()
+    if turn is not None:
+        turn.bytes_sent += sent
+        turn.bytes_received += received
+    with _lock:
+        _totals["bytes_sent"] += sent
+        _totals["bytes_received"] += received
+
+
+def summary():
+    with _lock:
+        spans = {}
+        for name, stats in _spans.items():
+            spans[name] = {
+                "count": stats["count"],
+                "mean": round(stats["sum"] / stats["count"], 6),
+                "max": round(stats["max"], 6),
+            }
+        return {"totals": dict(_totals), "spans": spans}
+
+
+def prometheus_text():
+    lines = ["# TYPE llm_span_seconds summary"]
+    with _lock:
+        for name, stats in sorted(_spans.items()):
+            lines.append(f'llm_span_seconds_sum{{span="{name}"}} '
+                         + f'{stats["sum"]:.6f}')
+            lines.append(f'llm_span_seconds_count{{span="{name}"}} '
+                         + f'{stats["count"]}')
+        lines.append("# TYPE llm_turns_total counter")
+        lines.append(f'llm_turns_total {_totals["turns"]}')
+        lines.append("# TYPE llm_bytes_total counter")
+        lines.append('llm_bytes_total{direction="sent"} '
+                     + f'{_totals["bytes_sent"]}')
+        lines.append('llm_bytes_total{direction="received"} '
+                     + f'{_totals["bytes_received"]}')
+        lines.append("# TYPE llm_tokens_total counter")
+        lines.append('llm_tokens_total{kind="prompt"} '
+                     + f'{_totals["prompt_tokens"]}')
+        lines.append('llm_tokens_total{kind="completion"} '
+                     + f'{_totals["completion_tokens"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path=None):
+    path = path or METRICS_PROM
+    if path is None:
+        return
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(prometheus_text())
+    except OSError as e:
+        print(f"Error: Failed to write metrics. {e}")
+
+
+atexit.register(write_prometheus)
@@ -2,29 +2,30 @@
 
 import llm_cli
 import json
+import metrics
 import os
-import requests
+import resilience
+import streaming_body
+import time
 
 API_KEY = os.getenv("OPENAI_API_KEY")
 if API_KEY is None:
     print("OPENAI_API_KEY environment variable must be set.")
     exit(1)
 MODEL = os.getenv("OPENAI_MODEL")
-if MODEL is None:
-    print("OPENAI_MODEL environment variable must be set.")
-    exit(1)
-API_URL = 'https://api.openai.com/v1/chat/completions'
+API_BASE = os.getenv("OPENAI_API_BASE", 'https://api.openai.com')
+API_URL = API_BASE + '/v1/chat/completions'
 
 
 class OPENAI(llm_cli.Chat):
 
-    def _send(self, data, conversation):
+    # High detail images are scaled to fit 2048 x 2048, then to 768 px on
+    # the shorter side, and billed per 512 px tile.
+    image_max_dimension = 2048
 
-        if conversation is None:
-            messages = []
-        else:
-            messages = list(conversation)
+    image_max_short_side = 768
 
+    def _build_user_message(self, data):
         user_message = {
             "role": "user",
             "content": [
@@ -38,36 +39,64 @@ class OPENAI(llm_cli.Chat):
                     "text": item['content']
                 })
             else:
-                image_url = f"data:{item['content_type']}"
-                image_url += f";base64,{item['content']}"
+                prefix = f"data:{item['content_type']};base64,"
+                if isinstance(item['content'], streaming_body.Base64File):
+                    image_url = item['content'].with_prefix(prefix)
+                else:
+                    image_url = prefix + item['content']
                 user_message['content'].append({
                     "type": "image_url",
                     "image_url": {
                         "url": image_url
                     }
                 })
+        return user_message
+
+    def _build_model_message(self, content):
+        return {"role": "assistant", "content": content}
+
+    def _build_request(self, data, conversation):
+
+        if conversation is None:
+            messages = []
+        else:
+            messages = list(conversation)
+
+        user_message = self._build_user_message(data)
 
         messages.append(user_message)
         if conversation is not None:
             conversation.append(user_message)
 
-        try:
-            headers = {
-                'Content-Type': 'application/json',
-                'Authorization': f'Bearer {API_KEY}',
-            }
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {API_KEY}',
+        }
 
-            data = {
-                'model': MODEL,
-                'messages': messages,
-            }
+        return headers, self._build_body(messages)
 
+    def _build_body(self, messages):
+        # Request body for messages; no logging or conversation changes.
+        return {
+            'model': self.MODEL,
+            'messages': messages,
+        }
+
+    def _send(self, data, conversation):
+
+        headers, data = self._build_request(data, conversation)
+        self.last_status = None
+
+        try:
             content = ''
 
-            response = requests.post(API_URL,
-                                     headers=headers,
-                                     data=json.dumps(data))
+            with metrics.span("provider_call"):
+                response = resilience.post(API_URL,
+                                           headers=headers,
+                                           retries=self.retries,
+                                           data=streaming_body.dumps(data))
 
+            self.last_status = response.status_code
             self.write_request_debug_log(headers, data, response)
 
             if response.status_code != 200:
@@ -83,7 +112,69 @@ class OPENAI(llm_cli.Chat):
 
             usage = result['usage']
 
-            model_message = {"role": "assistant", "content": content}
+            model_message = self._build_model_message(content)
+
+            if conversation is not None:
+                conversation.append(model_message)
+
+        except Exception as e:
+            print(f"ERROR:{e}")
+            return None, None, None
+        return content, usage, None
+
+    def _send_stream(self, data, conversation):
+
+        headers, data = self._build_request(data, conversation)
+        self.last_status = None
+        data['stream'] = True
+        data['stream_options'] = {'include_usage': True}
+
+        parts = []
+        usage = None
+        response = None
+        try:
+            start = time.perf_counter()
+            response = resilience.post(API_URL,
+                                       headers=headers,
+                                       retries=self.retries,
+                                       data=streaming_body.dumps(data),
+                                       stream=True)
+
+            self.last_status = response.status_code
+            if response.status_code != 200:
+                self.write_request_debug_log(headers, data, response)
+                json_str = json.dumps(response.json(),
+                                      ensure_ascii=False,
+                                      indent=2)
+                print(json_str)
+                return None, None, None
+
+            response.encoding = 'utf-8'
+            chunks = []
+            for line in response.iter_lines(decode_unicode=True):
+                metrics.add_bytes(received=len(line) + 1)
+                if not line or not line.startswith('data:'):
+                    continue
+                line = line[5:].strip()
+                if line == '[DONE]':
+                    break
+                chunk = json.loads(line)
+                chunks.append(chunk)
+
+                if chunk.get('usage') is not None:
+                    usage = chunk['usage']
+                for choice in chunk.get('choices', []):
+                    delta = choice.get('delta', {}).get('content')
+                    if delta:
+                        parts.append(delta)
+                        yield delta
+
+            metrics.record("provider_call", time.perf_counter() - start)
+            self.write_request_debug_log(headers, data, response, chunks)
+
+            content = ''.join(parts)
+
+            model_message = self._build_model_message(content)
 
             if conversation is not None:
                 conversation.append(model_message)
@@ -91,9 +182,15 @@ class OPENAI(llm_cli.Chat):
         except Exception as e:
             print(f"ERROR:{e}")
             return None, None, None
+        finally:
+            if response is not None:
+                response.close()
         return content, usage, None
 
 
 if __name__ == "__main__":
+    if MODEL is None:
+        print("OPENAI_MODEL environment variable must be set.")
+        exit(1)
     openai = OPENAI(MODEL)
     openai.main()
@@ -4,13 +4,14 @@ import argparse
 import datetime
 import json
 import os
-import requests
+import transport
 
 API_KEY = os.getenv("OPENAI_API_KEY")
 if API_KEY is None:
     print("OPENAI_API_KEY environment variable must be set.")
     exit(1)
-API_URL = "https://api.openai.com/v1/models"
+API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com")
+API_URL = API_BASE + "/v1/models"
 
 parser = argparse.ArgumentParser()
 parser.add_argument("models", nargs="*")
@@ -23,7 +24,7 @@ verbose = args.v
 headers = {
         "Authorization": f"Bearer {API_KEY}"
         }
-response = requests.get(API_URL, headers=headers)
+response = transport.get(API_URL, headers=headers)
 
 if response.status_code == 200:
     result = response.json()
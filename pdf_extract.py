@@ -0,0 +1,257 @@
+import os
+import process_pool
+
+from collections import deque
+from io import BytesIO
+
+# Constants
+# Processes of the shared pool (process_pool) one PDF may keep busy.
+PDF_WORKERS = int(os.getenv("LLM_PDF_WORKERS", str(os.cpu_count() or 1)))
+PDF_PAGES_PER_TASK = int(os.getenv("LLM_PDF_PAGES_PER_TASK", "16"))
+# Hybrid mode: pages with less text and an embedded image of at least
+# PDF_FIGURE_MIN_PIXELS are sent as images (scans, slides).
+PDF_TEXT_MIN_CHARS = int(os.getenv("LLM_PDF_TEXT_MIN_CHARS", "200"))
+# Hybrid mode: pages with less text and such an image are sent as text and
+# image (figures, charts).
+PDF_FIGURE_MAX_CHARS = int(os.getenv("LLM_PDF_FIGURE_MAX_CHARS", "1500"))
+# Smaller images (logos, icons) do not make a page visual.
+PDF_FIGURE_MIN_PIXELS = int(os.getenv("LLM_PDF_FIGURE_MIN_PIXELS",
+                                      "150000"))
+# Hybrid mode with a renderer: pages with little text whose content
+# stream is at least this long are vector drawings and sent as images.
+PDF_DRAWING_MIN_BYTES = int(os.getenv("LLM_PDF_DRAWING_MIN_BYTES", "20000"))
+# Rendering is slower than text extraction, so hybrid tasks are smaller.
+PDF_HYBRID_PAGES_PER_TASK = 4
+
+
+def split_page_selector(source):
+    # "manual.pdf#pages=10-40" -> ("manual.pdf", "10-40")
+    path, sep, fragment = source.rpartition('#')
+    if sep == '' or not fragment.startswith('pages='):
+        return source, None
+    return path, fragment[len('pages='):]
+
+
+def select_pages(pages, page_count):
+    # 1-based, inclusive: "3", "10-40", "1,5-7", "90-" (to the end)
+    if pages is None or pages == '':
+        return list(range(page_count))
+    indices = []
+    for part in pages.split(','):
+        part = part.strip()
+        if part == '':
+            continue
+        first, sep, last = part.partition('-')
+        try:
+            start = int(first) if first != '' else 1
+            end = int(last) if last != '' else page_count
+            if sep == '':
+                end = start
+        except ValueError:
+            raise ValueError(f"Invalid page range: {part}")
+        start = max(start, 1)
+        end = min(end, page_count)
+        indices.extend(range(start - 1, end))
+    return indices
+
+
+def _open(source):
+    # pypdf is imported here so loading this module stays cheap.
+    from pypdf import PdfReader
+    if isinstance(source, (bytes, bytearray)):
+        return PdfReader(BytesIO(source))
+    return PdfReader(source)
+
+
+def _extract_range(source, indices):
+    reader = _open(source)
+    return [reader.pages[i].extract_text() for i in indices]
+
+
+def _map_ranges(function, source, indices, pages_per_task, workers, *args):
+    # Runs function(source, page range, *args) on the process pool and
+    # yields the results of each range in page order.
+    tasks = [indices[i:i + pages_per_task]
+             for i in range(0, len(indices), pages_per_task)]
+    executor = process_pool.get_executor()
+    pending = deque()
+    try:
+        # Keep a bounded window of page ranges in flight.
+        for task in tasks:
+            pending.append(executor.submit(function, source, task, *args))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def iter_page_texts(source, pages=None, workers=PDF_WORKERS):
+    # source is a file path or the PDF bytes; yields page texts in order.
+    reader = _open(source)
+    indices = select_pages(pages, len(reader.pages))
+
+    if workers <= 1 or len(indices) < PDF_PAGES_PER_TASK * 2:
+        for i in indices:
+            yield reader.pages[i].extract_text()
+        return
+
+    yield from _map_ranges(_extract_range, source, indices,
+                           PDF_PAGES_PER_TASK, workers)
+
+
+def renderer_available():
+    try:
+        import pypdfium2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def hybrid_variant():
+    return f"hybrid|text={PDF_TEXT_MIN_CHARS}|figure={PDF_FIGURE_MAX_CHARS}" \
+        + f"|pixels={PDF_FIGURE_MIN_PIXELS}|drawing={PDF_DRAWING_MIN_BYTES}" \
+        + f"|render={renderer_available()}"
+
+
+def _image_pixels(page):
+    # Pixel counts of the images placed directly on the page, read from the
+    # XObject dictionaries without decoding the images.
+    resources = page.get('/Resources')
+    xobjects = resources.get_object().get('/XObject') \
+        if resources is not None else None
+    if xobjects is None:
+        return []
+    pixels = []
+    for xobject in xobjects.get_object().values():
+        xobject = xobject.get_object()
+        if xobject.get('/Subtype') == '/Image':
+            pixels.append(int(xobject.get('/Width', 0))
+                          * int(xobject.get('/Height', 0)))
+    return pixels
+
+
+def _content_bytes(page):
+    contents = page.get_contents()
+    return 0 if contents is None else len(contents.get_data())
+
+
+def classify_page(text, pixels, drawing=False):
+    # "text": the text is sent, "image": the page image (scanned or visual
+    # pages), "figure": both. Blank and short pages without a large image
+    # or a drawing stay text.
+    chars = len(text.strip())
+    large_image = max(pixels, default=0) >= PDF_FIGURE_MIN_PIXELS
+    if chars < PDF_TEXT_MIN_CHARS:
+        if large_image or drawing:
+            return "image"
+        return "text"
+    if chars < PDF_FIGURE_MAX_CHARS and large_image:
+        return "figure"
+    return "text"
+
+
+def _render_page(document, index, max_dimension):
+    page = document[index]
+    try:
+        width, height = page.get_size()
+        # Page sizes are in points; scale 1 renders at 72 dpi.
+        scale = min(2.0, max_dimension / max(width, height, 1))
+        bitmap = page.render(scale=scale)
+        output = BytesIO()
+        bitmap.to_pil().save(output, "PNG")
+        return output.getvalue(), "image/png"
+    finally:
+        page.close()
+
+
+def _embedded_image(page):
+    # Without a renderer, the largest image on the page stands in for it;
+    # for a scanned page that is the scan.
+    import mimetypes
+    best = None
+    for image in page.images:
+        if best is None or len(image.data) > len(best.data):
+            best = image
+    if best is None:
+        return None, None
+    return best.data, mimetypes.guess_type(best.name)[0] or "image/png"
+
+
+def _hybrid_range(source, indices, max_dimension, max_short_side):
+    import image_prep
+    reader = _open(source)
+    document = None
+    if renderer_available():
+        import pypdfium2
+        document = pypdfium2.PdfDocument(source)
+    results = []
+    try:
+        for i in indices:
+            page = reader.pages[i]
+            text = page.extract_text()
+            drawing = document is not None and \
+                len(text.strip()) < PDF_TEXT_MIN_CHARS and \
+                _content_bytes(page) >= PDF_DRAWING_MIN_BYTES
+            kind = classify_page(text, _image_pixels(page), drawing)
+            data, mime_type = None, None
+            if kind != "text":
+                try:
+                    if document is not None:
+                        data, mime_type = _render_page(document, i,
+                                                       max_dimension)
+                    else:
+                        data, mime_type = _embedded_image(page)
+                except Exception as e:
+                    # pypdf cannot decode every image filter (e.g. JBIG2).
+                    print(f"Error: page {i + 1}: {e}")
+                if data is None:
+                    kind = "text"
+                elif image_prep.IMAGE_PREPROCESS is True and \
+                        image_prep.available():
+                    data, mime_type, _ = image_prep.process(
+                        data, mime_type, max_dimension, max_short_side,
+                        reencode=True)
+            # A rendered page shows its text; an embedded image may not.
+            if kind == "image" and document is not None:
+                text = ''
+            results.append((i + 1, kind, text, data, mime_type))
+    finally:
+        if document is not None:
+            document.close()
+    return results
+
+
+def iter_hybrid_pages(source, pages=None, max_dimension=2048,
+                      max_short_side=None, workers=PDF_WORKERS):
+    # Yields (page number, kind, text, image bytes, image mime type) in page
+    # order; see classify_page. Pages are classified, rendered and encoded
+    # on the process pool.
+    reader = _open(source)
+    indices = select_pages(pages, len(reader.pages))
+
+    if workers <= 1 or len(indices) < PDF_HYBRID_PAGES_PER_TASK * 2:
+        yield from _hybrid_range(source, indices, max_dimension,
+                                 max_short_side)
+        return
+
+    yield from _map_ranges(_hybrid_range, source, indices,
+                           PDF_HYBRID_PAGES_PER_TASK, workers,
+                           max_dimension, max_short_side)
+
+
+def extract_text(source, pages=None):
+    return ''.join('\n' + text for text in iter_page_texts(source, pages))
+
+
+def slice_pdf(source, pages):
+    from pypdf import PdfWriter
+    reader = _open(source)
+    writer = PdfWriter()
+    for i in select_pages(pages, len(reader.pages)):
+        writer.add_page(reader.pages[i])
+    output = BytesIO()
+    writer.write(output)
+    return output.getvalue()
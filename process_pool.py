@@ -0,0 +1,26 @@
+import atexit
+import os
+import threading
+
+# Constants
+# Size of the process pool shared by PDF extraction and retrieval indexing.
+PROCESS_WORKERS = int(os.getenv("LLM_PROCESS_WORKERS",
+                                str(os.cpu_count() or 1)))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # Sources are loaded from worker threads, where fork is unsafe.
+                _executor = ProcessPoolExecutor(
+                    max_workers=PROCESS_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn"))
+                atexit.register(_executor.shutdown, cancel_futures=True)
+    return _executor
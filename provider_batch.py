@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+
+# Runs a JSONL prompt file through the OpenAI Batch API or the Gemini
+# batch mode. Jobs are recorded in a job file, so an interrupted run picks
+# up polling (or downloading) where it stopped.
+#
+#   python provider_batch.py -m openai:gpt-4o-mini prompts.jsonl -o out.jsonl
+#   python provider_batch.py -m gemini:gemini-2.0-flash prompts.jsonl \
+#       -o out.jsonl --price-input 0.10 --price-output 0.40
+
+import argparse
+import backoff
+import batch
+import fanout
+import json
+import metrics
+import os
+import sys
+import tempfile
+import time
+import transport
+
+# Constants
+POLL_TIMEOUT = float(os.getenv("LLM_BATCH_POLL_TIMEOUT",
+                               str(25 * 3600)))
+POLL_INITIAL = 5.0
+POLL_MAXIMUM = float(os.getenv("LLM_BATCH_POLL_MAX", "120"))
+# Prices are per million tokens; batch requests are billed at a discount.
+PRICE_INPUT = float(os.getenv("LLM_BATCH_PRICE_INPUT", "0"))
+PRICE_OUTPUT = float(os.getenv("LLM_BATCH_PRICE_OUTPUT", "0"))
+BATCH_DISCOUNT = 0.5
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+class OpenAIBatch():
+
+    def __init__(self, client):
+        import openai
+        self.client = client
+        self.api_base = openai.API_BASE
+        self.headers = {'Authorization': f'Bearer {openai.API_KEY}'}
+
+    def request_line(self, item_id, data):
+        # Built without _build_request, which writes to the chat log.
+        body = self.client._build_body(
+            [self.client._build_user_message(data)])
+        return {
+            "custom_id": item_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": body,
+        }
+
+    def submit(self, path):
+        with open(path, 'rb') as f:
+            response = transport.post(
+                f"{self.api_base}/v1/files",
+                headers=self.headers,
+                data={'purpose': 'batch'},
+                files={'file': (os.path.basename(path), f,
+                                'application/jsonl')},
+                timeout=600)
+        response.raise_for_status()
+        file_id = response.json()['id']
+
+        response = transport.post(
+            f"{self.api_base}/v1/batches",
+            headers=self.headers,
+            json={
+                "input_file_id": file_id,
+                "endpoint": "/v1/chat/completions",
+                "completion_window": "24h",
+            })
+        response.raise_for_status()
+        return {"batch": response.json()['id'], "input_file": file_id}
+
+    def status(self, job):
+        # Returns (state, finished, counts).
+        response = transport.get(
+            f"{self.api_base}/v1/batches/{job['batch']}",
+            headers=self.headers)
+        response.raise_for_status()
+        info = response.json()
+        job['output_files'] = [file_id for file_id in
+                               (info.get('output_file_id'),
+                                info.get('error_file_id'))
+                               if file_id is not None]
+        counts = info.get('request_counts') or {}
+        state = info.get('status')
+        finished = state in ("completed", "failed", "expired", "cancelled")
+        return state, finished, (counts.get('completed', 0)
+                                 + counts.get('failed', 0),
+                                 counts.get('total', 0))
+
+    def iter_lines(self, job):
+        for file_id in job.get('output_files', []):
+            response = transport.get(
+                f"{self.api_base}/v1/files/{file_id}/content",
+                headers=self.headers,
+                stream=True)
+            try:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if line:
+                        yield line
+            finally:
+                response.close()
+
+    def parse_result(self, line):
+        record = json.loads(line)
+        result = {"id": record.get('custom_id')}
+        response = record.get('response') or {}
+        body = response.get('body') or {}
+        if record.get('error') is None and \
+                response.get('status_code') == 200:
+            result.update(status="ok",
+                          response=body['choices'][0]['message']['content'],
+                          usage=body.get('usage'))
+        else:
+            result.update(status="error",
+                          http_status=response.get('status_code'),
+                          error=record.get('error') or body.get('error'))
+        return result
+
+
+class GeminiBatch():
+
+    def __init__(self, client):
+        import gemini
+        self.client = client
+        self.api_base = gemini.API_BASE
+        self.api_key = gemini.API_KEY
+
+    def request_line(self, item_id, data):
+        # Built without _build_request, which writes to the chat log.
+        body = self.client._build_body(
+            [self.client._build_user_message(data)])
+        return {"key": item_id, "request": body}
+
+    def submit(self, path):
+        file_uri, _ = self.client._upload_file(path, "application/jsonl")
+        if file_uri is None:
+            raise RuntimeError("Failed to upload the batch input file.")
+        file_name = "files/" + file_uri.split('/')[-1]
+        response = transport.post(
+            self.client._model_url("batchGenerateContent?key="
+                                   + self.api_key),
+            json={"batch": {
+                "display_name": os.path.basename(path),
+                "input_config": {"file_name": file_name},
+            }})
+        response.raise_for_status()
+        return {"batch": response.json()['name'], "input_file": file_name}
+
+    def status(self, job):
+        response = transport.get(
+            f"{self.api_base}/v1beta/{job['batch']}?key={self.api_key}")
+        response.raise_for_status()
+        operation = response.json()
+        metadata = operation.get('metadata', {})
+        output = operation.get('response') or metadata.get('output') or {}
+        if output.get('responsesFile') is not None:
+            job['output_files'] = [output['responsesFile']]
+        elif output.get('inlinedResponses') is not None:
+            job['inlined'] = output['inlinedResponses'] \
+                .get('inlinedResponses', [])
+        stats = metadata.get('batchStats', {})
+        total = int(stats.get('requestCount', 0))
+        pending = int(stats.get('pendingRequestCount', total))
+        state = metadata.get('state', 'BATCH_STATE_PENDING')
+        finished = operation.get('done', False) is True or state in (
+            "BATCH_STATE_SUCCEEDED", "BATCH_STATE_FAILED",
+            "BATCH_STATE_CANCELLED", "BATCH_STATE_EXPIRED")
+        return state, finished, (total - pending, total)
+
+    def iter_lines(self, job):
+        for inlined in job.get('inlined', []):
+            key = (inlined.get('metadata') or {}).get('key')
+            yield json.dumps(dict(inlined, key=key))
+        for file_name in job.get('output_files', []):
+            response = transport.get(
+                f"{self.api_base}/download/v1beta/{file_name}:download"
+                + f"?alt=media&key={self.api_key}",
+                stream=True)
+            try:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if line:
+                        yield line
+            finally:
+                response.close()
+
+    def parse_result(self, line):
+        record = json.loads(line)
+        result = {"id": record.get('key')}
+        response = record.get('response')
+        if response is not None and record.get('error') is None:
+            texts = [part['text']
+                     for candidate in response.get('candidates', [])[:1]
+                     for part in candidate.get('content', {})
+                     .get('parts', [])
+                     if 'text' in part]
+            result.update(status="ok",
+                          response=''.join(texts),
+                          usage=response.get('usageMetadata'))
+        else:
+            result.update(status="error", error=record.get('error'))
+        return result
+
+
+BACKENDS = {
+    "openai": OpenAIBatch,
+    "gemini": GeminiBatch,
+}
+
+
+def save_job(path, job):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(job, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_job(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_input(backend, input_path):
+    # Provider request lines, built from the prompts the same way as
+    # synchronous requests.
+    count = 0
+    fd, path = tempfile.mkstemp(suffix='.jsonl')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f, \
+            open(input_path, 'r', encoding='utf-8') as lines:
+        for item_id, prompt in batch.read_items(lines):
+            if prompt is None:
+                continue
+            data = backend.client.append_to_data(None, prompt)
+            f.write(json.dumps(backend.request_line(item_id, data),
+                               ensure_ascii=False))
+            f.write('\n')
+            count += 1
+    return path, count
+
+
+def wait_for_job(backend, job, job_path, timeout):
+    last = None
+
+    def check():
+        nonlocal last
+        try:
+            state, finished, (done, total) = backend.status(job)
+        except Exception as e:
+            log(f"Error checking batch status: {e}")
+            return None
+        if (state, done) != last:
+            log(f"batch {job['batch']}: {state} {done}/{total}")
+            last = (state, done)
+        if finished:
+            job['state'] = state
+            save_job(job_path, job)
+            return state
+        return None
+
+    state, waited = backoff.poll(check, timeout,
+                                 initial=POLL_INITIAL,
+                                 factor=1.5,
+                                 maximum=POLL_MAXIMUM)
+    return state, waited
+
+
+def download_results(backend, job, output_path, price_input, price_output):
+    counts = {"ok": 0, "error": 0}
+    prompt_tokens = 0
+    completion_tokens = 0
+    with open(output_path, 'w', encoding='utf-8') as output:
+        for line in backend.iter_lines(job):
+            result = backend.parse_result(line)
+            output.write(json.dumps(result, ensure_ascii=False))
+            output.write('\n')
+            counts[result['status']] += 1
+            prompt, completion = metrics.token_counts(result.get('usage'))
+            prompt_tokens += prompt
+            completion_tokens += completion
+
+    cost = (prompt_tokens * price_input + completion_tokens * price_output) \
+        / 1e6 * BATCH_DISCOUNT
+    summary = f"results: {counts['ok']} ok, {counts['error']} failed, " \
+        + f"{prompt_tokens} prompt tokens, " \
+        + f"{completion_tokens} completion tokens"
+    if price_input > 0 or price_output > 0:
+        summary += f", estimated cost ${cost:.4f}"
+    log(summary)
+    job['results'] = dict(counts,
+                          prompt_tokens=prompt_tokens,
+                          completion_tokens=completion_tokens,
+                          cost=round(cost, 6))
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a JSONL prompt file through a provider batch API.")
+    parser.add_argument('input',
+                        help="JSONL prompts (see --batch in the chat "
+                             + "clients for the format).")
+    parser.add_argument('-m',
+                        '--model',
+                        required=True,
+                        help="provider:model")
+    parser.add_argument('-o',
+                        '--output',
+                        required=True,
+                        help="JSONL results file.")
+    parser.add_argument('--job',
+                        help="Job state file (default: <output>.job.json).")
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=POLL_TIMEOUT,
+                        help="Seconds to wait for the job.")
+    parser.add_argument('--price-input',
+                        type=float,
+                        default=PRICE_INPUT,
+                        help="USD per million prompt tokens.")
+    parser.add_argument('--price-output',
+                        type=float,
+                        default=PRICE_OUTPUT,
+                        help="USD per million completion tokens.")
+    args = parser.parse_args()
+
+    models = fanout.parse_models([args.model])
+    if len(models) != 1:
+        print("Error: --model takes exactly one provider:model.")
+        exit(1)
+    (provider, model), = models
+    backend = BACKENDS[provider](fanout.create_client(provider, model))
+    job_path = args.job or args.output + ".job.json"
+
+    job = load_job(job_path)
+    if job is not None and job.get('input') != os.path.abspath(args.input):
+        print(f"Error: {job_path} belongs to another input file.")
+        exit(1)
+
+    start = time.monotonic()
+    if job is None:
+        path, count = write_input(backend, args.input)
+        try:
+            log(f"Submitting {count} requests to {provider}:{model}...")
+            job = backend.submit(path)
+        except Exception as e:
+            print(f"Error: Failed to submit the batch. {e}")
+            exit(1)
+        finally:
+            os.unlink(path)
+        job.update(provider=provider,
+                   model=model,
+                   input=os.path.abspath(args.input),
+                   requests=count,
+                   submitted=time.time())
+        save_job(job_path, job)
+    else:
+        log(f"Resuming batch {job['batch']}...")
+
+    if job.get('state') is None:
+        state, waited = wait_for_job(backend, job, job_path, args.timeout)
+        if state is None:
+            print(f"Batch {job['batch']} is not finished after "
+                  + f"{waited:.0f} seconds; run again to keep waiting.")
+            exit(1)
+
+    try:
+        download_results(backend, job, args.output,
+                         args.price_input, args.price_output)
+    except Exception as e:
+        print(f"Error: Failed to download the results. {e}")
+        exit(1)
+    job['downloaded'] = time.time()
+    save_job(job_path, job)
+    log(f"batch {job['batch']}: {job['state']}, "
+        + f"{time.monotonic() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import threading
+import time
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class TokenBucket():
+
+    # Allows rate acquisitions per second on average with bursts of up to
+    # capacity. A rate of 0 disables the limit.
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        # Blocks until tokens are available. Returns the seconds waited.
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens
+                                  + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    self.waited += waited
+                    return waited
+                delay = (tokens - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def get_bucket(name, rate, capacity=None):
+    # One bucket per provider, shared by every client in the process.
+    with _buckets_lock:
+        bucket = _buckets.get(name)
+        if bucket is None:
+            bucket = TokenBucket(rate, capacity)
+            _buckets[name] = bucket
+        return bucket
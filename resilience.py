@@ -0,0 +1,178 @@
+import backoff
+import email.utils
+import os
+import re
+import sys
+import threading
+import time
+import transport
+import urllib.parse
+
+import requests
+
+# Constants
+RETRIES = int(os.getenv("LLM_RETRIES", "3"))
+# Longest single wait, whatever Retry-After asks for.
+RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "60"))
+BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "30"))
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+class CircuitBreaker():
+
+    # Opens after `threshold` consecutive failures and rejects calls for
+    # `reset` seconds. Then one trial call is let through (half open):
+    # success closes the circuit, failure opens it again.
+
+    def __init__(self, name, threshold=BREAKER_THRESHOLD,
+                 reset=BREAKER_RESET):
+        self.name = name
+        self.threshold = threshold
+        self.reset = reset
+        self.state = "closed"
+        self.failures = 0
+        self.opened = 0.0
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and \
+                    time.monotonic() - self.opened >= self.reset:
+                self.state = "half_open"
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or \
+                    self.failures >= self.threshold:
+                if self.state != "open":
+                    self.trips += 1
+                self.state = "open"
+                self.opened = time.monotonic()
+
+    def retry_in(self):
+        with self._lock:
+            return max(0.0, self.reset - (time.monotonic() - self.opened))
+
+
+def endpoint(url):
+    # Scheme, host and path; the query holds API keys.
+    parts = urllib.parse.urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}{parts.path}"
+
+
+def get_breaker(url):
+    name = endpoint(url)
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name)
+            _breakers[name] = breaker
+        return breaker
+
+
+def breakers():
+    with _breakers_lock:
+        return list(_breakers.values())
+
+
+def is_retryable(status):
+    return status == 429 or status in (500, 502, 503, 504)
+
+
+def retry_after(response):
+    # Seconds from a Retry-After header (delta or HTTP date), or from the
+    # RetryInfo detail of a Google API error body.
+    value = response.headers.get('Retry-After')
+    if value is not None:
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+            return max(0.0, date.timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    try:
+        details = response.json().get('error', {}).get('details', [])
+    except (ValueError, AttributeError):
+        return None
+    for detail in details if isinstance(details, list) else []:
+        delay = detail.get('retryDelay') if isinstance(detail, dict) \
+            else None
+        if isinstance(delay, str):
+            match = re.fullmatch(r'([\d.]+)s', delay)
+            if match is not None:
+                return float(match.group(1))
+    return None
+
+
+def request(method, url, retries=RETRIES, **kwargs):
+    # transport.request with retries on 429, 5xx and connection errors.
+    # Waits follow Retry-After when the server sends one, otherwise
+    # jittered exponential backoff. Returns the last response; raises the
+    # last connection error, or CircuitOpenError while the endpoint's
+    # circuit is open.
+    breaker = get_breaker(url)
+    delays = backoff.delays(initial=1.0, maximum=RETRY_MAX_DELAY)
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            raise CircuitOpenError(
+                f"{breaker.name} is unavailable after repeated failures; "
+                + f"retry in {breaker.retry_in():.0f} s.")
+        attempt += 1
+        error = None
+        response = None
+        try:
+            response = transport.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            error = e
+
+        if error is None and not is_retryable(response.status_code):
+            if response.status_code < 500:
+                breaker.record_success()
+            return response
+
+        # Rate limiting says nothing about the endpoint's health.
+        if error is not None or response.status_code != 429:
+            breaker.record_failure()
+
+        if attempt > retries:
+            if error is not None:
+                raise error
+            return response
+
+        delay = None if response is None else retry_after(response)
+        if delay is None:
+            delay = next(delays)
+        delay = min(delay, RETRY_MAX_DELAY)
+        reason = error if error is not None \
+            else f"HTTP {response.status_code}"
+        print(f"{reason}; retrying in {delay:.1f} s "
+              + f"({attempt}/{retries})...", file=sys.stderr)
+        if response is not None:
+            response.close()
+        time.sleep(delay)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
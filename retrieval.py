@@ -0,0 +1,218 @@
+import heapq
+import math
+import os
+import process_pool
+import re
+import source_cache
+import threading
+
+from collections import Counter, defaultdict
+
+# Constants
+# Text sources at least this long are indexed instead of being sent whole.
+RETRIEVAL_MIN_CHARS = int(os.getenv("LLM_RETRIEVAL_MIN_CHARS", "20000"))
+RETRIEVAL_TOP_K = int(os.getenv("LLM_RETRIEVAL_TOP_K", "8"))
+# Estimated tokens of excerpts added to one request.
+RETRIEVAL_BUDGET = int(os.getenv("LLM_RETRIEVAL_BUDGET", "4000"))
+CHUNK_CHARS = int(os.getenv("LLM_RETRIEVAL_CHUNK_CHARS", "1500"))
+CHUNK_OVERLAP = int(os.getenv("LLM_RETRIEVAL_CHUNK_OVERLAP", "200"))
+# Processes of the shared pool (process_pool) indexing may keep busy.
+INDEX_WORKERS = int(os.getenv("LLM_INDEX_WORKERS", str(os.cpu_count() or 1)))
+CHUNKS_PER_TASK = 256
+CHARS_PER_TOKEN = 4.0
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def chunk_text(text, size=CHUNK_CHARS, overlap=CHUNK_OVERLAP):
+    # Chunks of about size characters, cut at a paragraph, sentence or word
+    # boundary where possible; neighbours share about overlap characters.
+    chunks = []
+    start = 0
+    length = len(text)
+    while start < length:
+        end = min(length, start + size)
+        if end < length:
+            for separator in ("\n\n", "\n", ". ", " "):
+                cut = text.rfind(separator, start + size // 2, end)
+                if cut != -1:
+                    end = cut + len(separator)
+                    break
+        chunk = text[start:end].strip()
+        if chunk != '':
+            chunks.append(chunk)
+        if end >= length:
+            break
+        next_start = text.find(' ', end - overlap, end)
+        start = end if next_start == -1 else next_start + 1
+    return chunks
+
+
+def count_terms(chunks):
+    return [dict(Counter(tokenize(chunk))) for chunk in chunks]
+
+
+def index_key(digest):
+    return source_cache.content_key(
+        digest, f"bm25|chunk={CHUNK_CHARS}|overlap={CHUNK_OVERLAP}")
+
+
+class RetrievalIndex():
+
+    # Okapi BM25 over the chunks of every added document. Term counts of a
+    # document are stored in the source cache under its content hash, so a
+    # document is only chunked and counted once.
+
+    def __init__(self, top_k=RETRIEVAL_TOP_K, budget=RETRIEVAL_BUDGET,
+                 workers=INDEX_WORKERS):
+        self.top_k = top_k
+        self.budget = budget
+        self.workers = workers
+        self.sources = []
+        self.digests = set()
+        self.chunks = []
+        self.lengths = []
+        self.postings = defaultdict(list)
+        self.total_length = 0
+        self.last_search = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def _build(self, documents):
+        # Returns {digest: entry}; documents missing from the cache are
+        # counted in parallel, in ranges of CHUNKS_PER_TASK chunks.
+        cache = source_cache.get_cache()
+        entries = {}
+        tasks = []
+        for digest, text in documents.items():
+            entry = cache.get(index_key(digest))
+            if entry is not None:
+                entries[digest] = entry
+                continue
+            chunks = chunk_text(text)
+            entries[digest] = {"chunks": chunks, "terms": []}
+            for i in range(0, len(chunks), CHUNKS_PER_TASK):
+                tasks.append((digest, chunks[i:i + CHUNKS_PER_TASK]))
+
+        if self.workers <= 1 or len(tasks) < 2:
+            results = [count_terms(chunks) for _, chunks in tasks]
+        else:
+            executor = process_pool.get_executor()
+            results = [future.result() for future in
+                       [executor.submit(count_terms, chunks)
+                        for _, chunks in tasks]]
+        built = set()
+        for (digest, _), terms in zip(tasks, results):
+            entries[digest]["terms"].extend(terms)
+            built.add(digest)
+        for digest in built:
+            cache.put(index_key(digest), entries[digest])
+        return entries
+
+    def add_documents(self, documents):
+        # documents: [(source, text)]. Documents already in the index are
+        # skipped.
+        pending = {}
+        names = {}
+        for source, text in documents:
+            digest = source_cache.digest_bytes(text.encode('utf-8'))
+            if digest in self.digests or digest in pending:
+                continue
+            pending[digest] = text
+            names[digest] = source
+        if len(pending) == 0:
+            return 0
+
+        entries = self._build(pending)
+        with self._lock:
+            for digest, entry in entries.items():
+                document = len(self.sources)
+                self.sources.append(names[digest])
+                self.digests.add(digest)
+                for chunk, terms in zip(entry["chunks"], entry["terms"]):
+                    chunk_id = len(self.chunks)
+                    self.chunks.append((document, chunk))
+                    length = sum(terms.values())
+                    self.lengths.append(length)
+                    self.total_length += length
+                    for term, count in terms.items():
+                        self.postings[term].append((chunk_id, count))
+        return len(entries)
+
+    def search(self, query, top_k=None, budget=None):
+        # Returns [(source, chunk)] in document order: the best scoring
+        # chunks that fit into budget tokens. Without query terms, the
+        # beginning of the documents is returned.
+        top_k = self.top_k if top_k is None else top_k
+        budget = self.budget if budget is None else budget
+        with self._lock:
+            count = len(self.chunks)
+            if count == 0:
+                return []
+            average = self.total_length / count
+            terms = set(tokenize(query))
+            scores = defaultdict(float)
+            for term in terms:
+                postings = self.postings.get(term)
+                if postings is None:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5)
+                               / (len(postings) + 0.5))
+                for chunk_id, tf in postings:
+                    scores[chunk_id] += idf * tf * (BM25_K1 + 1) / (
+                        tf + BM25_K1 * (1 - BM25_B + BM25_B
+                                        * self.lengths[chunk_id] / average))
+            if len(scores) > 0:
+                ranked = [chunk_id for chunk_id, _ in heapq.nlargest(
+                    top_k, scores.items(), key=lambda item: item[1])]
+            else:
+                ranked = range(min(top_k, count))
+
+            selected = []
+            used = 0.0
+            for chunk_id in ranked:
+                tokens = len(self.chunks[chunk_id][1]) / CHARS_PER_TOKEN
+                if used + tokens > budget and len(selected) > 0:
+                    continue
+                selected.append(chunk_id)
+                used += tokens
+            self.last_search = {"query_terms": len(terms),
+                                "matched_chunks": len(scores),
+                                "selected": len(selected),
+                                "tokens": round(used)}
+            return [(self.sources[self.chunks[chunk_id][0]],
+                     self.chunks[chunk_id][1])
+                    for chunk_id in sorted(selected)]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "documents": len(self.sources),
+                "chunks": len(self.chunks),
+                "terms": len(self.postings),
+                "top_k": self.top_k,
+                "budget": self.budget,
+                "last_search": self.last_search,
+            }
+
+
+def indexable(item):
+    content = item.get('content')
+    return 'file_url' not in item and isinstance(content, str) \
+        and 'text' in (item.get('content_type') or 'text') \
+        and len(content) >= RETRIEVAL_MIN_CHARS
+
+
+def format_excerpts(excerpts):
+    text = "Excerpts from the sources that are relevant to the question:\n"
+    for source, chunk in excerpts:
+        text += f"\n[{source}]\n{chunk}\n"
+    return text
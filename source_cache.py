@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+# Constants
+CACHE_DIR = os.getenv("LLM_CACHE_DIR",
+                      os.path.join(os.path.expanduser("~"),
+                                   ".cache", "llm-cli"))
+CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES",
+                                str(512 * 1024 * 1024)))
+
+
+def digest_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def digest_file(path):
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _key(*parts):
+    return digest_bytes("\0".join(parts).encode("utf-8"))
+
+
+def url_key(url):
+    return _key("url", url)
+
+
+def content_key(digest, variant):
+    return _key("content", digest, variant)
+
+
+class SourceCache():
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.directory = os.path.join(directory, "sources")
+        self.max_bytes = max_bytes
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key):
+        if self.enabled is False:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            # The modification time is the recency used for eviction.
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        if self.enabled is False:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            size = os.path.getsize(tmp_path)
+            try:
+                size -= os.path.getsize(path)
+            except OSError:
+                pass
+            os.replace(tmp_path, path)
+        except (OSError, TypeError) as e:
+            print(f"Error: Failed to write cache. {e}")
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        # Drop least recently used entries down to 90% of the budget.
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._size = total
+
+    def count_revalidation(self):
+        with self._lock:
+            self.revalidated += 1
+
+    def file_digest(self, path):
+        # Hashing is skipped when size and mtime are unchanged.
+        stat = os.stat(path)
+        key = _key("file", os.path.abspath(path),
+                   str(stat.st_size), str(stat.st_mtime_ns))
+        entry = self.get(key)
+        if entry is not None:
+            return entry["digest"]
+        digest = digest_file(path)
+        self.put(key, {"digest": digest})
+        return digest
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidated": self.revalidated,
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SourceCache()
+    return _cache
@@ -0,0 +1,107 @@
+import base64
+import json
+import metrics
+import mmap
+import os
+import secrets
+
+# Constants
+INLINE_STREAM_MIN_BYTES = int(os.getenv("LLM_INLINE_STREAM_MIN_BYTES",
+                                        str(4 * 1024 * 1024)))
+# A multiple of 3 so that chunks encode without padding.
+ENCODE_CHUNK_SIZE = 3 * 256 * 1024
+
+
+class Base64File():
+
+    # Stands in for the base64 text of a file inside a request payload.
+    # The file is memory-mapped and encoded chunk by chunk while the
+    # request body is sent.
+
+    def __init__(self, path, prefix=''):
+        self.path = path
+        self.prefix = prefix
+        self.size = os.path.getsize(path)
+
+    def __len__(self):
+        return len(self.prefix) + 4 * ((self.size + 2) // 3)
+
+    def with_prefix(self, prefix):
+        return Base64File(self.path, prefix)
+
+    def iter_encoded(self):
+        if self.prefix != '':
+            yield self.prefix.encode('ascii')
+        if self.size == 0:
+            return
+        with open(self.path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                for offset in range(0, self.size, ENCODE_CHUNK_SIZE):
+                    yield base64.b64encode(
+                        view[offset:offset + ENCODE_CHUNK_SIZE])
+            finally:
+                view.release()
+
+    def __str__(self):
+        return b''.join(self.iter_encoded()).decode('ascii')
+
+    def __format__(self, format_spec):
+        return format(str(self), format_spec)
+
+    def describe(self):
+        return f"<base64 of {self.path} ({self.size} bytes)>"
+
+
+class JSONBody():
+
+    # JSON request body whose Base64File values are streamed instead of
+    # being built in memory. The length is known up front, so the body is
+    # sent with Content-Length rather than chunked encoding.
+
+    def __init__(self, payload):
+        self.streams = []
+        token = secrets.token_hex(8)
+
+        def placeholder(obj):
+            if isinstance(obj, Base64File):
+                self.streams.append(obj)
+                return f"{token}:{len(self.streams) - 1}"
+            raise TypeError(f"Object of type {type(obj).__name__} "
+                            + "is not JSON serializable")
+
+        with metrics.span("serialize"):
+            text = json.dumps(payload, default=placeholder)
+        self.segments = []
+        for i in range(len(self.streams)):
+            before, _, text = text.partition(f'"{token}:{i}"')
+            self.segments.append(before.encode('utf-8'))
+        self.segments.append(text.encode('utf-8'))
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments) \
+            + sum(len(stream) + 2 for stream in self.streams)
+
+    def __iter__(self):
+        for segment, stream in zip(self.segments, self.streams):
+            yield segment + b'"'
+            yield from stream.iter_encoded()
+            yield b'"'
+        yield self.segments[-1]
+
+
+def dumps(payload):
+    # Plain JSON text unless the payload holds streamed attachments.
+    body = JSONBody(payload)
+    if len(body.streams) == 0:
+        return body.segments[0].decode('utf-8')
+    return body
+
+
+def describe(obj):
+    # json.dumps default= for logs and history views.
+    if isinstance(obj, Base64File):
+        return obj.describe()
+    raise TypeError(f"Object of type {type(obj).__name__} "
+                    + "is not JSON serializable")
@@ -0,0 +1,82 @@
+import os
+import sys
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+import conversation_store  # noqa: E402
+
+
+def user(text):
+    return {"role": "user", "parts": [{"text": text}]}
+
+
+def model(text):
+    return {"role": "model", "parts": [{"text": text}]}
+
+
+def function_call(name):
+    return {"role": "model",
+            "parts": [{"functionCall": {"name": name, "args": {}}}]}
+
+
+def function_response(name):
+    return {"role": "user",
+            "parts": [{"functionResponse": {"name": name,
+                                            "response": {"ok": True}}}]}
+
+
+class HistoryTailTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "history.jsonl")
+
+    def write(self, messages):
+        conversation = conversation_store.open_conversation(self.path, 0)
+        conversation.extend(messages)
+        conversation.close()
+
+    def load(self, tail):
+        conversation = conversation_store.open_conversation(self.path, tail)
+        self.addCleanup(conversation.close)
+        return conversation
+
+    def test_odd_tail_starts_with_user_message(self):
+        messages = [user("q1"), model("a1"), user("q2"), model("a2"),
+                    user("q3"), model("a3")]
+        self.write(messages)
+        conversation = self.load(3)
+        self.assertEqual(list(conversation), messages[4:])
+        self.assertEqual(conversation.older, messages[:4])
+
+    def test_tail_skips_function_response(self):
+        messages = [user("q1"), function_call("search"),
+                    function_response("search"), model("a1"),
+                    user("q2"), model("a2")]
+        self.write(messages)
+        conversation = self.load(4)
+        self.assertEqual(list(conversation), messages[4:])
+
+    def test_even_tail_keeps_whole_turns(self):
+        messages = [user("q1"), model("a1"), user("q2"), model("a2")]
+        self.write(messages)
+        self.assertEqual(list(self.load(2)), messages[2:])
+        self.assertEqual(list(self.load(0)), messages)
+
+    def test_load_older_moves_whole_turns(self):
+        messages = [user("q1"), model("a1"), user("q2"), model("a2"),
+                    user("q3"), model("a3")]
+        self.write(messages)
+        conversation = self.load(2)
+        self.assertEqual(conversation.load_older(1), 0)
+        self.assertEqual(conversation.load_older(3), 2)
+        self.assertEqual(list(conversation), messages[2:])
+        self.assertEqual(conversation[0]["role"], "user")
+
+
+if __name__ == "__main__":
+    unittest.main()
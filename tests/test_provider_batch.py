@@ -0,0 +1,127 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TESTS_DIR)
+MOCK_SERVER = os.path.join(ROOT_DIR, 'bench', 'mock_server.py')
+# Seconds until a batch job of the mock server completes; long enough
+# for at least one status check to see it pending.
+BATCH_DELAY = 1.0
+PROMPTS = [{"id": "a", "prompt": "First question."},
+           {"id": "b", "prompt": "Second question."},
+           {"id": "c", "prompt": "Third question."}]
+
+
+def setUpModule():
+    global server, base_url, cache_dir
+    server = subprocess.Popen([sys.executable, MOCK_SERVER,
+                               '--port', '0',
+                               '--response-tokens', '5',
+                               '--batch-delay', str(BATCH_DELAY)],
+                              stdout=subprocess.PIPE, text=True)
+    line = server.stdout.readline()
+    if not line.startswith('Listening on '):
+        server.kill()
+        raise RuntimeError("Mock server failed to start.")
+    base_url = line.split()[-1]
+    cache_dir = tempfile.TemporaryDirectory()
+
+    # The client modules read their endpoints when they are imported.
+    os.environ.update({
+        "GOOGLE_API_KEY": "test",
+        "GEMINI_MODEL": "test-model",
+        "OPENAI_API_KEY": "test",
+        "OPENAI_MODEL": "test-model",
+        "GEMINI_API_BASE": base_url,
+        "OPENAI_API_BASE": base_url,
+        "GEMINI_CONTEXT_CACHE": "0",
+        "LLM_CACHE_DIR": cache_dir.name,
+        # source_cache may already be imported with the default directory.
+        "GEMINI_UPLOAD_REGISTRY": os.path.join(cache_dir.name,
+                                               'uploads.json'),
+    })
+    sys.path.insert(0, ROOT_DIR)
+
+
+def tearDownModule():
+    server.terminate()
+    server.wait()
+    server.stdout.close()
+    cache_dir.cleanup()
+
+
+class ProviderBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        import provider_batch
+        self.provider_batch = provider_batch
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.input_path = os.path.join(self.directory.name, 'prompts.jsonl')
+        with open(self.input_path, 'w', encoding='utf-8') as f:
+            for prompt in PROMPTS:
+                f.write(json.dumps(prompt) + '\n')
+        self.output_path = os.path.join(self.directory.name, 'out.jsonl')
+        self.job_path = self.output_path + '.job.json'
+
+    def backend(self, provider):
+        import fanout
+        client = fanout.create_client(provider, "test-model")
+        return self.provider_batch.BACKENDS[provider](client)
+
+    def run_job(self, provider):
+        # Submit, poll until the job is finished, download the results.
+        provider_batch = self.provider_batch
+        backend = self.backend(provider)
+        path, count = provider_batch.write_input(backend, self.input_path)
+        try:
+            job = backend.submit(path)
+        finally:
+            os.unlink(path)
+        self.assertEqual(count, len(PROMPTS))
+        self.assertIn('batch', job)
+
+        state, finished, (done, total) = backend.status(job)
+        self.assertFalse(finished)
+        self.assertEqual(total, len(PROMPTS))
+
+        initial = provider_batch.POLL_INITIAL
+        provider_batch.POLL_INITIAL = 0.2
+        try:
+            state, _ = provider_batch.wait_for_job(backend, job,
+                                                   self.job_path, 30)
+        finally:
+            provider_batch.POLL_INITIAL = initial
+        self.assertIsNotNone(state)
+        self.assertEqual(provider_batch.load_job(self.job_path)['state'],
+                         state)
+
+        counts = provider_batch.download_results(backend, job,
+                                                 self.output_path, 1.0, 2.0)
+        self.assertEqual(counts, {"ok": len(PROMPTS), "error": 0})
+        with open(self.output_path, 'r', encoding='utf-8') as f:
+            results = [json.loads(line) for line in f]
+        self.assertEqual(sorted(result['id'] for result in results),
+                         [prompt['id'] for prompt in PROMPTS])
+        for result in results:
+            self.assertEqual(result['status'], "ok")
+            self.assertNotEqual(result['response'], '')
+        self.assertGreater(job['results']['prompt_tokens'], 0)
+        self.assertEqual(job['results']['completion_tokens'],
+                         5 * len(PROMPTS))
+        self.assertGreater(job['results']['cost'], 0)
+        return state
+
+    def test_openai(self):
+        self.assertEqual(self.run_job("openai"), "completed")
+
+    def test_gemini(self):
+        self.assertEqual(self.run_job("gemini"), "BATCH_STATE_SUCCEEDED")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,377 @@
+import datetime
+import json
+import metrics
+import os
+import socket
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Constants
+CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "600"))
+POOL_CONNECTIONS = int(os.getenv("LLM_POOL_CONNECTIONS", "10"))
+POOL_MAXSIZE = int(os.getenv("LLM_POOL_MAXSIZE", "10"))
+HTTP2 = os.getenv("LLM_HTTP2", "1") != "0"
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def _count(host, key):
+    with _stats_lock:
+        host_stats = _stats.setdefault(host, {"requests": 0,
+                                              "connections": 0})
+        host_stats[key] += 1
+
+
+def _timed_new_conn(conn, new_conn):
+    # Resolves the host separately so that DNS and TCP connect times can
+    # be recorded, then connects to the resolved addresses in order.
+    start = time.perf_counter()
+    if not hasattr(conn, "_dns_host"):
+        # urllib3 versions without _dns_host: DNS is part of tcp_connect.
+        sock = new_conn()
+        conn.tcp_connected = time.perf_counter()
+        metrics.record("tcp_connect", conn.tcp_connected - start)
+        return sock
+    try:
+        addresses = []
+        for info in socket.getaddrinfo(conn._dns_host, conn.port,
+                                       0, socket.SOCK_STREAM):
+            if info[4][0] not in addresses:
+                addresses.append(info[4][0])
+    except OSError:
+        addresses = []
+    resolved = time.perf_counter()
+    metrics.record("dns", resolved - start)
+
+    if len(addresses) == 0:
+        sock = new_conn()
+    else:
+        dns_host = conn._dns_host
+        try:
+            for i, address in enumerate(addresses):
+                conn._dns_host = address
+                try:
+                    sock = new_conn()
+                    break
+                except Exception:
+                    if i == len(addresses) - 1:
+                        raise
+        finally:
+            conn._dns_host = dns_host
+    conn.tcp_connected = time.perf_counter()
+    metrics.record("tcp_connect", conn.tcp_connected - resolved)
+    return sock
+
+
+class _TimedHTTPConnection(HTTPConnection):
+
+    def _new_conn(self):
+        return _timed_new_conn(self, super()._new_conn)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+
+    tcp_connected = None
+
+    def _new_conn(self):
+        return _timed_new_conn(self, super()._new_conn)
+
+    def connect(self):
+        super().connect()
+        if self.tcp_connected is not None:
+            metrics.record("tls_handshake",
+                           time.perf_counter() - self.tcp_connected)
+            self.tcp_connected = None
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+
+    ConnectionCls = _TimedHTTPConnection
+
+    def _new_conn(self):
+        _count(self.host, "connections")
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+
+    ConnectionCls = _TimedHTTPSConnection
+
+    def _new_conn(self):
+        _count(self.host, "connections")
+        return super()._new_conn()
+
+
+class _CountingAdapter(HTTPAdapter):
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+class _ConnectionTrace():
+
+    # httpcore trace callback of one HTTP/2 request: records the connection
+    # setup phases. httpcore resolves the host inside connect_tcp, so in
+    # this path DNS time is part of tcp_connect.
+
+    PHASES = {"connection.connect_tcp": "tcp_connect",
+              "connection.start_tls": "tls_handshake"}
+
+    def __init__(self):
+        self.started = {}
+
+    def __call__(self, event_name, info):
+        name, _, stage = event_name.rpartition('.')
+        phase = self.PHASES.get(name)
+        if phase is None:
+            return
+        if stage == "started":
+            self.started[name] = time.perf_counter()
+        elif stage == "complete" and name in self.started:
+            metrics.record(phase,
+                           time.perf_counter() - self.started.pop(name))
+
+
+class _H2Response():
+
+    # Presents an httpx response through the subset of the
+    # requests.Response interface used by the callers.
+
+    def __init__(self, response, elapsed):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.elapsed = elapsed
+
+    @property
+    def encoding(self):
+        return self._response.encoding
+
+    @encoding.setter
+    def encoding(self, value):
+        self._response.encoding = value
+
+    @property
+    def content(self):
+        try:
+            return self._response.read()
+        except Exception as e:
+            raise _translate(e) from e
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors='replace')
+
+    def json(self):
+        # Streamed responses are read first, as requests does.
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size=None):
+        try:
+            yield from self._response.iter_bytes(chunk_size)
+        except Exception as e:
+            raise _translate(e) from e
+
+    def iter_lines(self, decode_unicode=False):
+        try:
+            if decode_unicode is True:
+                yield from self._response.iter_lines()
+            else:
+                for line in self._response.iter_lines():
+                    yield line.encode(self.encoding)
+        except Exception as e:
+            raise _translate(e) from e
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(
+                f"{self.status_code} Error for url: {self._response.url}",
+                response=self)
+
+    def close(self):
+        self._response.close()
+
+
+def _translate(e):
+    import httpx
+    if isinstance(e, httpx.TimeoutException):
+        return requests.exceptions.Timeout(str(e))
+    if isinstance(e, httpx.HTTPError):
+        return requests.exceptions.ConnectionError(str(e))
+    return e
+
+
+def _http2_available():
+    try:
+        import h2  # noqa: F401
+        import httpx  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _body_size(kwargs):
+    data = kwargs.get("data")
+    if data is None and kwargs.get("json") is not None:
+        return len(json.dumps(kwargs["json"]))
+    if isinstance(data, str):
+        return len(data.encode('utf-8'))
+    if data is not None and hasattr(data, "__len__") and \
+            not isinstance(data, dict):
+        return len(data)
+    return 0
+
+
+class Transport():
+
+    def __init__(self,
+                 connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT,
+                 http2=None):
+        self.timeout = (connect_timeout, read_timeout)
+        if http2 is None:
+            http2 = HTTP2
+        self.http2 = http2 and _http2_available()
+        if self.http2 is True:
+            import httpx
+            self._client = httpx.Client(
+                http2=True,
+                follow_redirects=True,
+                limits=httpx.Limits(
+                    max_connections=POOL_CONNECTIONS * POOL_MAXSIZE,
+                    max_keepalive_connections=POOL_MAXSIZE))
+            self._streams = {}
+        else:
+            self._client = requests.Session()
+            adapter = _CountingAdapter(pool_connections=POOL_CONNECTIONS,
+                                       pool_maxsize=POOL_MAXSIZE)
+            self._client.mount("http://", adapter)
+            self._client.mount("https://", adapter)
+
+    def request(self, method, url, timeout=None, stream=False, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        host = urllib.parse.urlsplit(url).hostname
+        _count(host, "requests")
+        metrics.add_bytes(sent=_body_size(kwargs))
+        if self.http2 is True:
+            response = self._request_h2(method, url, host, timeout,
+                                        stream, **kwargs)
+        else:
+            response = self._client.request(method, url,
+                                            timeout=timeout,
+                                            stream=stream,
+                                            **kwargs)
+        if response.elapsed is not None:
+            metrics.record("ttfb", response.elapsed.total_seconds())
+        if stream is False:
+            metrics.add_bytes(received=len(response.content))
+        return response
+
+    def _request_h2(self, method, url, host, timeout, stream, **kwargs):
+        import httpx
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        data = kwargs.pop("data", None)
+        if isinstance(data, (str, bytes)):
+            kwargs["content"] = data
+        elif hasattr(data, "read"):
+            kwargs["content"] = iter(lambda: data.read(1 << 16), b"")
+        elif data is not None and not isinstance(data, dict):
+            kwargs["content"] = data
+            if hasattr(data, "__len__"):
+                headers = dict(kwargs.get("headers") or {})
+                headers["Content-Length"] = str(len(data))
+                kwargs["headers"] = headers
+        elif data is not None:
+            kwargs["data"] = data
+        try:
+            request = self._client.build_request(method, url,
+                                                 timeout=timeout,
+                                                 **kwargs)
+            request.extensions["trace"] = _ConnectionTrace()
+            start = time.perf_counter()
+            response = self._client.send(request, stream=True)
+            elapsed = datetime.timedelta(
+                seconds=time.perf_counter() - start)
+            network_stream = response.extensions.get("network_stream")
+            with _stats_lock:
+                seen = self._streams.setdefault(host, set())
+                if id(network_stream) not in seen:
+                    seen.add(id(network_stream))
+                    _stats[host]["connections"] += 1
+            if stream is False:
+                response.read()
+        except Exception as e:
+            raise _translate(e) from e
+        return _H2Response(response, elapsed)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def close(self):
+        self._client.close()
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = Transport()
+    return _transport
+
+
+def request(method, url, **kwargs):
+    return get_transport().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return get_transport().get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    return get_transport().post(url, **kwargs)
+
+
+def patch(url, **kwargs):
+    return get_transport().patch(url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return get_transport().delete(url, **kwargs)
+
+
+def stats():
+    with _stats_lock:
+        result = {}
+        for host, host_stats in _stats.items():
+            result[host] = dict(host_stats)
+            result[host]["reused"] = max(
+                0, host_stats["requests"] - host_stats["connections"])
+        return result
@@ -0,0 +1,120 @@
+import datetime
+import json
+import os
+import re
+import source_cache
+import tempfile
+import threading
+import time
+
+# Constants
+REGISTRY_PATH = os.getenv("GEMINI_UPLOAD_REGISTRY",
+                          os.path.join(source_cache.CACHE_DIR,
+                                       "uploads.json"))
+# Uploads closer than this to their expiration are not reused.
+EXPIRATION_MARGIN = 600
+
+
+def parse_time(value):
+    # RFC 3339 as returned by the Files API, e.g.
+    # "2025-01-01T00:00:00.123456789Z"
+    if value is None:
+        return None
+    value = re.sub(r'(\.\d{6})\d+', r'\1', value).replace('Z', '+00:00')
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+
+def entry_from_file_info(file_info, num_bytes):
+    return {
+        "name": file_info.get("name"),
+        "file_uri": file_info.get("uri"),
+        "mime_type": file_info.get("mimeType"),
+        "size": num_bytes,
+        "state": file_info.get("state"),
+        "expiration_time": parse_time(file_info.get("expirationTime")),
+    }
+
+
+def is_reusable(entry):
+    if entry.get("state") != "ACTIVE" or entry.get("file_uri") is None:
+        return False
+    expiration = entry.get("expiration_time")
+    return expiration is not None and \
+        expiration - time.time() > EXPIRATION_MARGIN
+
+
+class UploadRegistry():
+
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = path
+        self.reused = 0
+        self.revalidated = 0
+        self.uploaded = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, entries):
+        try:
+            directory = os.path.dirname(self.path)
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entries, f, indent=2, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Error: Failed to save upload registry. {e}")
+
+    def get(self, digest):
+        with self._lock:
+            return self._load().get(digest)
+
+    def put(self, digest, entry):
+        with self._lock:
+            entries = self._load()
+            # Expired uploads are dropped whenever the registry is written.
+            now = time.time()
+            entries = {k: v for k, v in entries.items()
+                       if v.get("expiration_time") is None
+                       or v["expiration_time"] > now}
+            entries[digest] = entry
+            self._save(entries)
+
+    def remove(self, digest):
+        with self._lock:
+            entries = self._load()
+            if entries.pop(digest, None) is not None:
+                self._save(entries)
+
+    def count(self, key):
+        with self._lock:
+            setattr(self, key, getattr(self, key) + 1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "uploaded": self.uploaded,
+                "reused": self.reused,
+                "revalidated": self.revalidated,
+            }
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = UploadRegistry()
+    return _registry